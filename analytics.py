@@ -0,0 +1,229 @@
+# analytics.py
+#
+# Compliance statistics, materialized by the loader so reports do not scan
+# raw_measurements at request time:
+#
+#     daily_max_8h   highest 8-hour rolling mean per sensor, pollutant and day
+#                    (windows ending that day, at least 6 of 8 hours present)
+#     annual_stats   per sensor, pollutant and year: coverage, mean,
+#                    percentiles, maxima and counts of limit exceedances
+#
+# Exceedances are counted against LIMITS; a count is NULL when the pollutant
+# has no limit of that kind.
+
+# EU Directive 2008/50/EC limit and target values (µg/m³, CO in mg/m³) as
+# adopted in Italy by D.Lgs. 155/2010, keyed by the Dati Lombardia pollutant
+# name. `*_allowed` is the number of exceedances permitted per calendar year.
+LIMITS = {
+    "PM10": {"daily_limit": 50, "daily_allowed": 35},
+    "PM10 (SM2005)": {"daily_limit": 50, "daily_allowed": 35},
+    "Biossido di Azoto": {"hourly_limit": 200, "hourly_allowed": 18},
+    "Biossido di Zolfo": {"hourly_limit": 350, "hourly_allowed": 24,
+                          "daily_limit": 125, "daily_allowed": 3},
+    "Ozono": {"max_8h_limit": 120, "max_8h_allowed": 25},
+    "Monossido di Carbonio": {"max_8h_limit": 10, "max_8h_allowed": 0},
+}
+LIMIT_KINDS = ("hourly", "daily", "max_8h")
+
+# An 8-hour mean counts only with at least this many hourly readings
+MIN_8H_HOURS = 6
+
+
+def limits_cte():
+    """LIMITS as an inline `limits` table for the statements below."""
+    def number(value):
+        return "NULL::double precision" if value is None else f"{float(value)}::double precision"
+
+    rows = ", ".join(
+        "('{}'::varchar, {})".format(
+            pollutant.replace("'", "''"),
+            ", ".join(number(spec.get(f"{kind}_limit")) for kind in LIMIT_KINDS)
+        )
+        for pollutant, spec in LIMITS.items()
+    )
+    return f"limits (pollutant, hourly_limit, daily_limit, max_8h_limit) AS (VALUES {rows})"
+
+
+def max_8h_pollutants():
+    return [p for p, spec in LIMITS.items() if "max_8h_limit" in spec]
+
+
+def create_analytics_tables(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS daily_max_8h (
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            pollutant VARCHAR(50) NOT NULL,
+            day DATE NOT NULL,
+            max_8h_mean DOUBLE PRECISION,
+            PRIMARY KEY (sensor_id, pollutant, day)
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS annual_stats (
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            pollutant VARCHAR(50) NOT NULL,
+            year INTEGER NOT NULL,
+            hours BIGINT NOT NULL,
+            days INTEGER,
+            mean DOUBLE PRECISION,
+            p50 DOUBLE PRECISION,
+            p90 DOUBLE PRECISION,
+            p98 DOUBLE PRECISION,
+            max_hourly DOUBLE PRECISION,
+            max_daily_mean DOUBLE PRECISION,
+            max_8h_mean DOUBLE PRECISION,
+            hourly_exceedances INTEGER,
+            daily_exceedances INTEGER,
+            max_8h_exceedances INTEGER,
+            PRIMARY KEY (sensor_id, pollutant, year)
+        );
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS annual_stats_pollutant_year_idx
+        ON annual_stats (pollutant, year);
+    ''')
+
+
+def annual_stats_sql(scope=None):
+    """
+    Upsert annual_stats for every (sensor, pollutant, year), or only those
+    listed in the temp table `scope` (sensor_id, pollutant, year).
+    """
+    def within(alias, col):
+        if scope is None:
+            return ""
+        return (f"JOIN {scope} t ON t.sensor_id = {alias}.sensor_id AND t.pollutant = {alias}.pollutant "
+                f"AND {alias}.{col} >= make_date(t.year, 1, 1) AND {alias}.{col} < make_date(t.year + 1, 1, 1)")
+
+    return f'''
+        INSERT INTO annual_stats (
+            sensor_id, pollutant, year, hours, days, mean, p50, p90, p98,
+            max_hourly, max_daily_mean, max_8h_mean,
+            hourly_exceedances, daily_exceedances, max_8h_exceedances
+        )
+        WITH {limits_cte()},
+        hourly AS (
+            SELECT r.sensor_id, r.pollutant, EXTRACT(YEAR FROM r.timestamp)::int AS year,
+                   COUNT(r.value) AS hours,
+                   AVG(r.value) AS mean,
+                   MAX(r.value) AS max_hourly,
+                   percentile_cont(ARRAY[0.5, 0.9, 0.98]) WITHIN GROUP (ORDER BY r.value) AS pct,
+                   COUNT(*) FILTER (WHERE r.value > l.hourly_limit) AS exceedances
+            FROM raw_measurements r
+            {within("r", "timestamp")}
+            LEFT JOIN limits l ON l.pollutant = r.pollutant
+            GROUP BY 1, 2, 3
+        ),
+        daily AS (
+            SELECT m.sensor_id, m.pollutant, EXTRACT(YEAR FROM m.timestamp)::int AS year,
+                   COUNT(m.daily_avg) AS days,
+                   MAX(m.daily_avg) AS max_daily_mean,
+                   COUNT(*) FILTER (WHERE m.daily_avg > l.daily_limit) AS exceedances
+            FROM measurements m
+            {within("m", "timestamp")}
+            LEFT JOIN limits l ON l.pollutant = m.pollutant
+            GROUP BY 1, 2, 3
+        ),
+        eight AS (
+            SELECT e.sensor_id, e.pollutant, EXTRACT(YEAR FROM e.day)::int AS year,
+                   MAX(e.max_8h_mean) AS max_8h_mean,
+                   COUNT(*) FILTER (WHERE e.max_8h_mean > l.max_8h_limit) AS exceedances
+            FROM daily_max_8h e
+            {within("e", "day")}
+            LEFT JOIN limits l ON l.pollutant = e.pollutant
+            GROUP BY 1, 2, 3
+        )
+        SELECT h.sensor_id, h.pollutant, h.year, h.hours, d.days,
+               ROUND(h.mean::numeric, 3)::double precision,
+               h.pct[1], h.pct[2], h.pct[3],
+               h.max_hourly, d.max_daily_mean, e.max_8h_mean,
+               CASE WHEN l.hourly_limit IS NOT NULL THEN h.exceedances END,
+               CASE WHEN l.daily_limit IS NOT NULL THEN COALESCE(d.exceedances, 0) END,
+               CASE WHEN l.max_8h_limit IS NOT NULL THEN COALESCE(e.exceedances, 0) END
+        FROM hourly h
+        LEFT JOIN daily d ON d.sensor_id = h.sensor_id AND d.pollutant = h.pollutant AND d.year = h.year
+        LEFT JOIN eight e ON e.sensor_id = h.sensor_id AND e.pollutant = h.pollutant AND e.year = h.year
+        LEFT JOIN limits l ON l.pollutant = h.pollutant
+        ON CONFLICT (sensor_id, pollutant, year) DO UPDATE
+        SET hours = EXCLUDED.hours,
+            days = EXCLUDED.days,
+            mean = EXCLUDED.mean,
+            p50 = EXCLUDED.p50,
+            p90 = EXCLUDED.p90,
+            p98 = EXCLUDED.p98,
+            max_hourly = EXCLUDED.max_hourly,
+            max_daily_mean = EXCLUDED.max_daily_mean,
+            max_8h_mean = EXCLUDED.max_8h_mean,
+            hourly_exceedances = EXCLUDED.hourly_exceedances,
+            daily_exceedances = EXCLUDED.daily_exceedances,
+            max_8h_exceedances = EXCLUDED.max_8h_exceedances;
+    '''
+
+
+def refresh_analytics(cur):
+    """Rebuild both tables from scratch."""
+    cur.execute("TRUNCATE daily_max_8h, annual_stats;")
+    pollutants = max_8h_pollutants()
+    if pollutants:
+        cur.execute(f'''
+            INSERT INTO daily_max_8h (sensor_id, pollutant, day, max_8h_mean)
+            SELECT sensor_id, pollutant, timestamp::date,
+                   MAX(mean_8h) FILTER (WHERE n_8h >= {MIN_8H_HOURS})
+            FROM (
+                SELECT sensor_id, pollutant, timestamp,
+                       AVG(value) OVER w AS mean_8h,
+                       COUNT(value) OVER w AS n_8h
+                FROM raw_measurements
+                WHERE pollutant = ANY(%s)
+                WINDOW w AS (PARTITION BY sensor_id, pollutant ORDER BY timestamp
+                             RANGE BETWEEN INTERVAL '7 hours' PRECEDING AND CURRENT ROW)
+            ) windows
+            GROUP BY 1, 2, 3;
+        ''', (pollutants,))
+    cur.execute(annual_stats_sql())
+
+
+def merge_analytics(cur):
+    """
+    Recompute only what the current incremental batch (`inserted_rows`) can
+    change: the days whose 8-hour windows include a new hour, then every
+    sensor/pollutant/year those hours and days fall in.
+    """
+    pollutants = max_8h_pollutants()
+    cur.execute('''
+        CREATE TEMP TABLE touched_8h ON COMMIT DROP AS
+        SELECT DISTINCT i.sensor_id, i.pollutant, v.day
+        FROM inserted_rows i
+        CROSS JOIN LATERAL (VALUES (i.timestamp::date),
+                                   ((i.timestamp + INTERVAL '7 hours')::date)) v(day)
+        WHERE i.pollutant = ANY(%s);
+    ''', (pollutants,))
+    cur.execute(f'''
+        INSERT INTO daily_max_8h (sensor_id, pollutant, day, max_8h_mean)
+        SELECT t.sensor_id, t.pollutant, t.day,
+               MAX(w.mean_8h) FILTER (WHERE w.n_8h >= {MIN_8H_HOURS} AND w.timestamp >= t.day)
+        FROM touched_8h t
+        CROSS JOIN LATERAL (
+            SELECT r.timestamp,
+                   AVG(r.value) OVER win AS mean_8h,
+                   COUNT(r.value) OVER win AS n_8h
+            FROM raw_measurements r
+            WHERE r.sensor_id = t.sensor_id
+              AND r.pollutant = t.pollutant
+              AND r.timestamp >= t.day - INTERVAL '7 hours'
+              AND r.timestamp < t.day + 1
+            WINDOW win AS (ORDER BY r.timestamp
+                           RANGE BETWEEN INTERVAL '7 hours' PRECEDING AND CURRENT ROW)
+        ) w
+        GROUP BY t.sensor_id, t.pollutant, t.day
+        ON CONFLICT (sensor_id, pollutant, day) DO UPDATE
+        SET max_8h_mean = EXCLUDED.max_8h_mean;
+    ''')
+    cur.execute('''
+        CREATE TEMP TABLE touched_years ON COMMIT DROP AS
+        SELECT DISTINCT sensor_id, pollutant, EXTRACT(YEAR FROM timestamp)::int AS year
+        FROM inserted_rows
+        UNION
+        SELECT sensor_id, pollutant, EXTRACT(YEAR FROM day)::int FROM touched_8h;
+    ''')
+    cur.execute(annual_stats_sql("touched_years"))
@@ -0,0 +1,37 @@
+# api_client.py
+#
+# Helpers for loading API responses straight into pandas DataFrames. When
+# pyarrow is available the measurement endpoints are asked for an Arrow IPC
+# stream, which becomes a DataFrame without building per-row Python objects.
+
+import io
+
+import pandas as pd
+import requests
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def fetch_frame(url, params=None, timeout=60):
+    """GET `url` and return the body as a DataFrame, preferring Arrow over JSON."""
+    params = dict(params or {})
+    if pa is not None:
+        params.setdefault("format", "arrow")
+    resp = requests.get(url, params=params, stream=True, timeout=timeout)
+    resp.raise_for_status()
+
+    content_type = resp.headers.get("Content-Type", "").split(";")[0]
+    if content_type == ARROW_MIMETYPE:
+        resp.raw.decode_content = True
+        return pa.ipc.open_stream(resp.raw).read_pandas()
+    if content_type == "application/vnd.apache.parquet":
+        return pd.read_parquet(io.BytesIO(resp.content))
+    if content_type == "text/csv":
+        return pd.read_csv(io.BytesIO(resp.content))
+    return pd.DataFrame(resp.json())
@@ -1,236 +1,731 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
-import psycopg2
 import logging
+import os
+
+import metrics
+import serialization
+from change_feed import ChangeFeed, event_stream
+from columnar import COLUMNAR_FORMATS, MIMETYPES, UnsupportedFormat, negotiate_format, stream_columnar, stream_table
+from db import DB_CONFIG, PoolTimeout, create_pool, execute_prepared, explain_prepared, open_stream
+from export_jobs import EXPORT_FORMATS, ExportJobs, ExportQueueFull, parse_export
+from interpolation import surface_png
+from parquet_store import STORAGE_BACKENDS, ParquetBackend
+from queries import (
+    DATE_RANGE_SQL, METADATA_COVERAGE_SQL, METADATA_POLLUTANTS_SQL, METADATA_SENSORS_SQL,
+    SENSOR_COVERAGE_SQL, SENSOR_SQL, SENSORS_SQL, SNAPSHOT_SENSORS_SQL, SNAPSHOT_SQL,
+    SURFACE_DAY_SQL, SURFACE_SQL, SurfaceDay, SurfaceGrid,
+    annual_stats_query, batch_measurements_query, batch_payload,
+    bbox_query, coverage_payload, limits_payload, measurements_query, metadata_payload,
+    nearest_query, page_cursor, parse_shape, parse_surface_day, radius_query,
+    raw_measurements_query, rolling_query, rows_payload, sensor_measurements_query,
+    snapshot_payload, surface_day_payload, surface_payload,
+)
+from response_cache import DatasetVersion, ResponseCache, cached_response
 
 app = Flask(__name__)
-CORS(app)  # allow cross-origin requests
-logging.basicConfig(level=logging.DEBUG)
+CORS(app, expose_headers=["X-Next-Cursor", "ETag"])  # allow cross-origin requests
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
+# Rows fetched from the server-side cursor and written per response chunk
+STREAM_BATCH_ROWS = 5000
+
+# One pool shared by every handler; sized with DB_POOL_MIN / DB_POOL_MAX
+pool = create_pool()
+
+# Responses of read-only endpoints are cached per dataset version, which the
+# loader bumps on commit. RESPONSE_CACHE_DIR enables a store shared by workers.
+dataset_version = DatasetVersion(pool, ttl=float(os.environ.get("DATASET_VERSION_TTL", 5)))
+response_cache = ResponseCache(
+    max_bytes=int(float(os.environ.get("RESPONSE_CACHE_MB", 64)) * 1024 * 1024),
+    store_path=(os.path.join(os.environ["RESPONSE_CACHE_DIR"], "responses.sqlite3")
+                if os.environ.get("RESPONSE_CACHE_DIR") else None),
+    store_max_bytes=int(float(os.environ.get("RESPONSE_CACHE_STORE_MB", 512)) * 1024 * 1024),
+)
+cached = cached_response(response_cache, dataset_version.current)
+
+# Where /api/raw_measurements and /api/measurements read from by default;
+# a request can pick the other one with ?backend=postgres|parquet
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+parquet_backend = ParquetBackend(os.environ.get("PARQUET_STORE_DIR", "parquet_store"))
+
+# Bulk extracts run as background jobs writing to EXPORT_DIR
+export_jobs = ExportJobs(
+    os.environ.get("EXPORT_DIR", "exports"),
+    workers=int(os.environ.get("EXPORT_WORKERS", 2)),
+    max_queued=int(os.environ.get("EXPORT_MAX_QUEUED", 16)),
+    max_bytes=int(float(os.environ.get("EXPORT_MAX_MB", 10240)) * 1024 * 1024),
+    max_age=float(os.environ.get("EXPORT_MAX_AGE_HOURS", 72)) * 3600,
+    statement_timeout=float(os.environ.get("EXPORT_STATEMENT_TIMEOUT", 600)),
+)
+
+# Loads announced by manage_data.py / ingest_service.py, relayed to browsers on
+# /api/events; each one also moves the response cache to the new version at once
+change_feed = ChangeFeed(DB_CONFIG, on_change=dataset_version.set)
+
+
+def explain_statement(sql, params):
+    """EXPLAIN ANALYZE of a statement from a slow request, on a pooled connection."""
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            return explain_prepared(cur, sql, params)
+        finally:
+            cur.close()
+            conn.rollback()
+
+
+# Latency, SQL time, rows and bytes per route on /metrics, plus the slow-request
+# log when SLOW_REQUEST_MS is set
+metrics.instrument_flask(app, explain=explain_statement)
+metrics.Gauges("db_pool", "Connection pool", pool.stats)
+metrics.Gauges("response_cache", "Response cache", response_cache.stats)
+metrics.Gauges("export_jobs", "Export jobs by status", export_jobs.stats)
+metrics.Gauges("change_feed", "Change feed", change_feed.stats)
+
+# orjson for every JSON body, gzip/brotli by Accept-Encoding; registered after
+# the metrics hooks so they count the compressed bytes
+serialization.install(app)
+
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(e):
+    logging.warning("Connection pool exhausted: %s", e)
+    return jsonify({"error": str(e)}), 503
+
+
+@app.errorhandler(UnsupportedFormat)
+def unsupported_format(e):
+    return jsonify({"error": str(e)}), 406
+
+
+@app.errorhandler(ExportQueueFull)
+def export_queue_full(e):
+    return jsonify({"error": str(e)}), 503
+
+
+@app.route("/api/pool", methods=["GET"])
+def pool_stats():
+    return jsonify(pool.stats())
 
 
-def get_db_connection():
-    return psycopg2.connect(
-        host="localhost",
-        database="SE",
-        user="SE",
-        password="191919"
-    )
+@app.route("/api/cache", methods=["GET"])
+def cache_stats():
+    return jsonify({"dataset_version": dataset_version.current(), **response_cache.stats()})
+
+
+@app.route("/api/events", methods=["GET"])
+def dataset_events():
+    """Server-sent events, one per load that changed the data; see change_feed.py."""
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        last_event_id = None
+    body = event_stream(change_feed, last_event_id, dataset_version.current())
+    # Each open stream holds a server thread; X-Accel-Buffering stops nginx holding events back
+    return Response(body, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def fetch_rows(cur, sql, params=()):
+    execute_prepared(cur, sql, params)
+    return [c[0] for c in cur.description], cur.fetchall()
+
+
+def fetch_dicts(cur, sql, params=()):
+    return rows_payload(*fetch_rows(cur, sql, params))
 
 
 @app.route("/api/sensors", methods=["GET"])
+@cached
 def list_sensors():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT
-                sensor_id,
-                station_name,
-                province,
-                latitude,
-                longitude,
-                ST_AsGeoJSON(geom)::json AS geometry
-            FROM sensors;
-        """)
-        cols = [c[0] for c in cur.description]
-        sensors = [dict(zip(cols, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return jsonify(sensors)
+        shape = parse_shape(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cols, rows = fetch_rows(cur, SENSORS_SQL)
+            cur.close()
+        return jsonify(rows_payload(cols, rows, shape))
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception("Failed to fetch sensors")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/sensors/<sensor_id>", methods=["GET"])
+@cached
 def get_sensor(sensor_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT
-                sensor_id,
-                station_name,
-                province,
-                latitude,
-                longitude,
-                ST_AsGeoJSON(geom)::json AS geometry
-            FROM sensors
-            WHERE sensor_id = %s;
-        """, (sensor_id,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        if not row:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            rows = fetch_dicts(cur, SENSOR_SQL, (sensor_id,))
+            cur.close()
+        if not rows:
             return jsonify({"error": "sensor not found"}), 404
-        keys = ["sensor_id", "station_name", "province", "latitude", "longitude", "geometry"]
-        return jsonify(dict(zip(keys, row)))
+        return jsonify(rows[0])
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception(f"Failed to fetch sensor {sensor_id}")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/date_range", methods=["GET"])
+@cached
 def get_date_range():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # If you want hourly range, use raw_measurements; for daily, switch to measurements
-        cur.execute("""
-            SELECT
-                MIN(timestamp)::date AS first_date,
-                MAX(timestamp)::date AS last_date
-            FROM raw_measurements;
-        """)
-        first_date, last_date = cur.fetchone()
-        cur.close()
-        conn.close()
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, DATE_RANGE_SQL)
+            first_date, last_date = cur.fetchone()
+            cur.close()
         return jsonify({
             "first_date": first_date.isoformat(),
             "last_date": last_date.isoformat()
         })
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception("Failed to fetch date range")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/sensors/<sensor_id>/coverage", methods=["GET"])
+@cached
+def sensor_coverage(sensor_id):
+    """
+    Returns the data coverage of one sensor per pollutant: first/last reading,
+    row count, gap count (breaks of more than an hour) and missing hours.
+    """
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            rows = fetch_dicts(cur, SENSOR_COVERAGE_SQL, (sensor_id,))
+            cur.close()
+        if not rows:
+            return jsonify({"error": "no coverage found"}), 404
+        return jsonify(coverage_payload(rows))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch coverage for sensor {sensor_id}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/metadata", methods=["GET"])
+@cached
+def get_metadata():
+    """
+    Everything the dashboard needs to build its controls, in one small
+    response: pollutants, sensor list, overall date bounds and per-pollutant
+    coverage. Answered from sensor_pollutants and the loader-maintained
+    pollutant_catalog, never from the measurement tables.
+    """
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, METADATA_POLLUTANTS_SQL)
+            pollutants = [row[0] for row in cur.fetchall()]
+            sensors = fetch_dicts(cur, METADATA_SENSORS_SQL)
+            coverage = fetch_dicts(cur, METADATA_COVERAGE_SQL)
+            cur.close()
+        return jsonify(metadata_payload(pollutants, sensors, coverage))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch metadata")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/map_snapshots/<pollutant>", methods=["GET"])
+@cached
+def get_map_snapshot(pollutant):
+    """
+    The loader-built daily_avg snapshot of one pollutant: `grid` is a base64
+    sensor x day matrix of little-endian float32 (row-major, NaN for missing
+    days), `sensors` its row index and `first_date` the first column's day.
+    """
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, SNAPSHOT_SQL, (pollutant,))
+            snapshot = cur.fetchone()
+            if snapshot is None:
+                cur.close()
+                return jsonify({"error": "no snapshot for this pollutant"}), 404
+            sensors = fetch_dicts(cur, SNAPSHOT_SENSORS_SQL, (pollutant,))
+            cur.close()
+        return jsonify(snapshot_payload(pollutant, snapshot, sensors))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch map snapshot for {pollutant}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/surfaces/<pollutant>", methods=["GET"])
+@cached
+def get_surface_grid(pollutant):
+    """Bounds, size, date range and value scale of a pollutant's interpolated surfaces."""
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, SURFACE_SQL, (pollutant,))
+            header = cur.fetchone()
+            cur.close()
+        if header is None:
+            return jsonify({"error": "no surfaces for this pollutant"}), 404
+        return jsonify(surface_payload(pollutant, SurfaceGrid(*header)))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch surface grid for {pollutant}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/surfaces/<pollutant>/<day>", methods=["GET"])
+@cached
+def get_surface(pollutant, day):
+    """
+    The IDW-interpolated daily_avg surface of one pollutant and day.
+    format=png (default): an image for map overlays, Plasma colors, transparent
+    where no sensor is in range. format=json: the quantized uint8 grid, base64.
+    """
+    fmt = request.args.get("format", "png")
+    try:
+        day = parse_surface_day(day)
+        if fmt not in ("png", "json"):
+            raise ValueError("format must be png or json")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, SURFACE_DAY_SQL, (pollutant, day))
+            row = cur.fetchone()
+            cur.close()
+        if row is None:
+            return jsonify({"error": "no surface for this pollutant and day"}), 404
+        row = SurfaceDay(*row)
+        if fmt == "json":
+            return jsonify(surface_day_payload(pollutant, day, row))
+        return Response(surface_png(row.grid, row.width, row.height), mimetype="image/png")
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch surface for {pollutant} on {day}")
+        return jsonify({"error": str(e)}), 500
+
+
+def stream_response(conn, cur, first, fmt):
+    """
+    Build a streaming Response from an open server-side cursor whose first
+    batch has already been fetched. The connection goes back to the pool when
+    the response is closed, including when the client disconnects.
+    """
+    cols = [c[0] for c in cur.description]
+
+    def release():
+        try:
+            cur.close()
+        except Exception:
+            pass
+        pool.putconn(conn)
+
+    def batches():
+        batch = first
+        try:
+            while batch:
+                yield batch
+                batch = cur.fetchmany(STREAM_BATCH_ROWS)
+        except Exception:
+            logging.exception("Response stream aborted")
+            metrics.mark_failed()
+
+    def generate_json():
+        sep = "\n" if fmt == "ndjson" else ","
+        if fmt == "json":
+            yield "["
+        leading = ""
+        for batch in batches():
+            chunk = sep.join(app.json.dumps(dict(zip(cols, row))) for row in batch)
+            if fmt == "ndjson":
+                yield chunk + "\n"
+            else:
+                yield leading + chunk
+                leading = ","
+        if fmt == "json":
+            yield "]"
+
+    if fmt in COLUMNAR_FORMATS:
+        body = stream_columnar(fmt, cols, batches())
+    else:
+        body = generate_json()
+    response = Response(body, mimetype=MIMETYPES[fmt])
+    response.call_on_close(release)
+    return response
+
+
+def stream_query(sql, params, fmt, what):
+    """Run `sql` on a server-side cursor and stream the result as `fmt`."""
+    conn = None
+    try:
+        conn = pool.getconn()
+        cur = open_stream(conn, sql, params, itersize=STREAM_BATCH_ROWS)
+        first = cur.fetchmany(STREAM_BATCH_ROWS)
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
+        if conn is not None:
+            pool.putconn(conn)
+        return jsonify({"error": str(e)}), 500
+    return stream_response(conn, cur, first, fmt)
+
+
+def storage_backend():
+    backend = request.args.get("backend", STORAGE_BACKEND)
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"backend must be one of {', '.join(STORAGE_BACKENDS)}")
+    return backend
+
+
+def table_response(table, fmt, next_cursor=None, shape="rows"):
+    """Answer with a pyarrow Table read from the Parquet store."""
+    if fmt in COLUMNAR_FORMATS:
+        response = Response(stream_table(fmt, table), mimetype=MIMETYPES[fmt])
+    elif fmt == "ndjson":
+        body = "".join(app.json.dumps(row) + "\n" for row in table.to_pylist())
+        response = Response(body, mimetype=MIMETYPES[fmt])
+    elif shape == "columns":
+        response = jsonify(table.to_pydict())
+    else:
+        response = jsonify(table.to_pylist())
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
 @app.route("/api/raw_measurements", methods=["GET"])
 def list_raw_measurements():
-    sensor_id = request.args.get("sensor_id")
-    pollutant = request.args.get("pollutant")
-    start     = request.args.get("start")
-    end       = request.args.get("end")
-
-    filters, params = [], []
-    if sensor_id:
-        filters.append("sensor_id = %s");     params.append(sensor_id)
-    if pollutant:
-        filters.append("pollutant = %s");     params.append(pollutant)
-    if start:
-        filters.append("timestamp >= %s");    params.append(start)
-    if end:
-        filters.append("timestamp < %s::date + INTERVAL '1 day'"); params.append(end)
-    where = ("WHERE " + " AND ".join(filters)) if filters else ""
-
-    sql = f"""
-        SELECT measurement_id,
-               sensor_id,
-               timestamp,
-               pollutant,
-               value
-        FROM raw_measurements
-        {where}
-        ORDER BY timestamp;
-    """
-
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        cols = [c[0] for c in cur.description]
-        rows = [dict(zip(cols, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return jsonify(rows)
+    """
+    Streams hourly rows from `raw_measurements`, oldest first.
+    Optional query params: sensor_id, pollutant, start, end (YYYY-MM-DD),
+    limit (capped at RAW_MAX_ROWS), after (cursor from X-Next-Cursor),
+    format=json|ndjson|arrow|parquet|csv (or the matching Accept header).
+
+    Downsampling, computed in the database:
+      bucket=1h|6h|1d|1w  one row per bucket with value (avg), min, max, count
+      points=N            at most ~N original rows: the first, last, lowest and
+                          highest point of each of N/4 equal time slices (M4),
+                          which draws the same line as the full series
+
+    backend=postgres|parquet picks the store (default STORAGE_BACKEND); the
+    Parquet store serves plain row listings only.
+    """
+    fmt = negotiate_format(request, ("json", "ndjson") + COLUMNAR_FORMATS)
+    try:
+        if storage_backend() == "parquet":
+            table, next_cursor = parquet_backend.raw_measurements(request.args)
+            return table_response(table, fmt, next_cursor)
+        query = raw_measurements_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if query.page is None:
+        return stream_query(query.sql, query.params, fmt, query.what)
+
+    # The page (plus one row) is read before the headers are sent, so the
+    # cursor comes from its last row without a second query
+    conn = None
+    try:
+        conn = pool.getconn()
+        cur = open_stream(conn, query.sql, query.params, itersize=query.page + 1)
+        rows, next_cursor = page_cursor(cur.fetchmany(query.page + 1), query.page)
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception("Failed to fetch raw measurements")
+        if conn is not None:
+            pool.putconn(conn)
+        return jsonify({"error": str(e)}), 500
+
+    response = stream_response(conn, cur, rows, fmt)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+def spatial_response(build, what):
+    """Run the spatial query `build(request.args)` returns and answer with its rows in the requested shape."""
+    try:
+        sql, params = build(request.args)
+        shape = parse_shape(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cols, rows = fetch_rows(cur, sql, params)
+            cur.close()
+        return jsonify(rows_payload(cols, rows, shape))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/spatial/bbox", methods=["GET"])
+@cached
+def sensors_in_bbox():
+    """
+    Sensors inside a lon/lat bounding box, e.g. the map viewport.
+    Required query params: min_lon, min_lat, max_lon, max_lat
+    Optional: pollutant, date (YYYY-MM-DD, needs pollutant; adds daily_avg/min/max)
+    """
+    return spatial_response(bbox_query, "sensors in bounding box")
+
+
+@app.route("/api/spatial/radius", methods=["GET"])
+@cached
+def sensors_in_radius():
+    """
+    Sensors within `radius` metres of a point, nearest first.
+    Required query params: lat, lon, radius
+    Optional: pollutant, date (YYYY-MM-DD, needs pollutant; adds daily_avg/min/max)
+    """
+    return spatial_response(radius_query, "sensors in radius")
+
+
+@app.route("/api/spatial/nearest", methods=["GET"])
+@cached
+def nearest_sensors():
+    """
+    The k sensors nearest to a point, using the GiST index's KNN ordering.
+    Required query params: lat, lon
+    Optional: k (default 5), pollutant, date (YYYY-MM-DD, needs pollutant)
+    """
+    return spatial_response(nearest_query, "nearest sensors")
+
+
 @app.route("/api/measurements", methods=["GET"])
+@cached
 def list_measurements():
     """
     Returns daily aggregates from the precomputed `measurements` table.
-    Optional query params: sensor_id, pollutant, start (YYYY-MM-DD), end (YYYY-MM-DD)
-    """
-    sensor_id = request.args.get("sensor_id")
-    pollutant = request.args.get("pollutant")
-    start     = request.args.get("start")
-    end       = request.args.get("end")
-
-    filters, params = [], []
-    if sensor_id:
-        filters.append("sensor_id = %s");    params.append(sensor_id)
-    if pollutant:
-        filters.append("pollutant = %s");    params.append(pollutant)
-    if start:
-        filters.append("timestamp >= %s");   params.append(start)
-    if end:
-        filters.append("timestamp < %s::date + INTERVAL '1 day'"); params.append(end)
-    where = ("WHERE " + " AND ".join(filters)) if filters else ""
-
-    sql = f"""
-        SELECT
-            sensor_id,
-            timestamp AS date,
-            pollutant,
-            daily_avg,
-            daily_min,
-            daily_max
-        FROM measurements
-        {where}
-        ORDER BY date;
-    """
-
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        cols = [c[0] for c in cur.description]
-        rows = [dict(zip(cols, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return jsonify(rows)
+    Optional query params: sensor_id, pollutant, start (YYYY-MM-DD), end (YYYY-MM-DD),
+    format=json|arrow|parquet|csv (or the matching Accept header),
+    resolution=day|week|month|year (non-daily rows carry avg, min, max, count),
+    backend=postgres|parquet (the Parquet store serves resolution=day only),
+    shape=rows|columns (JSON as row objects, or {column: [values]})
+    """
+    fmt = negotiate_format(request, ("json",) + COLUMNAR_FORMATS)
+    try:
+        shape = parse_shape(request.args)
+        if storage_backend() == "parquet":
+            return table_response(parquet_backend.measurements(request.args), fmt, shape=shape)
+        sql, params = measurements_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if fmt in COLUMNAR_FORMATS:
+        return stream_query(sql, params, fmt, "daily measurements")
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cols, rows = fetch_rows(cur, sql, params)
+            cur.close()
+        return jsonify(rows_payload(cols, rows, shape))
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception("Failed to fetch daily measurements")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/api/sensors/<sensor_id>/measurements", methods=["GET"])
-def measurements_by_sensor(sensor_id):
+@app.route("/api/measurements/batch", methods=["GET"])
+@cached
+def batch_measurements():
     """
-    Returns daily aggregates for one sensor from the `measurements` table.
-    Optional query params: start, end (YYYY-MM-DD)
+    Daily (or rollup) aggregates for many sensors in one query, for comparison views.
+    Query params: sensor_ids (comma-separated) and/or province, at least one of them;
+    optional pollutant, start, end (YYYY-MM-DD), resolution=day|week|month|year,
+    format=json|arrow|parquet|csv. JSON groups the rows per sensor and pollutant:
+    {"resolution", "series": [{"sensor_id", "station_name", "province", "pollutant",
+    "date": [...], "avg": [...], "min": [...], "max": [...]}]}; the other formats
+    return the same rows flat, ordered by sensor.
     """
-    start = request.args.get("start")
-    end   = request.args.get("end")
+    fmt = negotiate_format(request, ("json",) + COLUMNAR_FORMATS)
+    try:
+        sql, params, resolution = batch_measurements_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    filters = ["sensor_id = %s"]
-    params  = [sensor_id]
-    if start:
-        filters.append("timestamp >= %s");   params.append(start)
-    if end:
-        filters.append("timestamp < %s::date + INTERVAL '1 day'"); params.append(end)
-    where = " AND ".join(filters)
+    if fmt in COLUMNAR_FORMATS:
+        return stream_query(sql, params, fmt, "batch measurements")
 
-    sql = f"""
-        SELECT
-            timestamp::date AS date,
-            pollutant,
-            daily_avg,
-            daily_min,
-            daily_max
-        FROM measurements
-        WHERE {where}
-        ORDER BY date;
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            rows = fetch_dicts(cur, sql, params)
+            cur.close()
+        return jsonify(batch_payload(rows, resolution))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch batch measurements")
+        return jsonify({"error": str(e)}), 500
+
+
+def analytics_response(build, what):
+    """Run the analytics query `build(request.args)` returns and answer with its rows in the requested shape."""
+    try:
+        sql, params = build(request.args)
+        shape = parse_shape(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cols, rows = fetch_rows(cur, sql, params)
+            cur.close()
+        return jsonify(rows_payload(cols, rows, shape))
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/analytics/limits", methods=["GET"])
+def analytics_limits():
+    """The limit values exceedances are counted against, and the yearly allowance of each."""
+    return jsonify(limits_payload())
+
+
+@app.route("/api/analytics/annual", methods=["GET"])
+@cached
+def annual_stats():
+    """
+    Per sensor, pollutant and year, from the loader-maintained `annual_stats`:
+    hours and days with data, mean, p50/p90/p98 of hourly values, hourly,
+    daily-mean and 8-hour-mean maxima, and exceedance counts (NULL when the
+    pollutant has no limit of that kind).
+    Optional query params: sensor_ids (comma-separated), province, pollutant,
+    year or from_year/to_year.
+    """
+    return analytics_response(annual_stats_query, "annual statistics")
+
+
+@app.route("/api/analytics/rolling", methods=["GET"])
+@cached
+def rolling_mean():
+    """
+    Trailing moving average of one sensor's series, with the number of
+    readings `n` in each window.
+    Required query params: sensor_id, pollutant
+    Optional: window (8h, 24h, ... over hourly values; 7d, 30d, ... over daily
+    means; default 24h), start, end (YYYY-MM-DD)
     """
+    return analytics_response(rolling_query, "rolling means")
 
+
+@app.route("/api/sensors/<sensor_id>/measurements", methods=["GET"])
+@cached
+def measurements_by_sensor(sensor_id):
+    """
+    Returns daily aggregates for one sensor from the `measurements` table.
+    Optional query params: start, end (YYYY-MM-DD),
+    resolution=day|week|month|year (non-daily rows carry avg, min, max, count),
+    shape=rows|columns
+    """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(sql, params)
-        cols = [c[0] for c in cur.description]
-        rows = [dict(zip(cols, row)) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        sql, params = sensor_measurements_query(sensor_id, request.args)
+        shape = parse_shape(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cols, rows = fetch_rows(cur, sql, params)
+            cur.close()
         if not rows:
             return jsonify({"error": "no measurements found"}), 404
-        return jsonify(rows)
+        return jsonify(rows_payload(cols, rows, shape))
+    except PoolTimeout:
+        raise
     except Exception as e:
         logging.exception(f"Failed to fetch measurements for sensor {sensor_id}")
         return jsonify({"error": str(e)}), 500
 
 
+def export_status(job):
+    status = job.as_dict()
+    if job.status == "done":
+        status["download"] = f"/api/exports/{job.id}/download"
+    return status
+
+
+@app.route("/api/exports", methods=["POST"])
+def create_export():
+    """
+    Queue a bulk export. JSON body (or query params):
+    start, end (YYYY-MM-DD, required), sensor_ids, pollutants (lists or
+    comma-separated; default all), resolution=hour|day|week|month|year
+    (default hour), format=csv|parquet (default csv, gzip-compressed).
+    The same filters on the same dataset version return the existing job.
+    """
+    try:
+        filters = parse_export(request.get_json(silent=True) or request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    job, created = export_jobs.submit(filters, dataset_version.current())
+    location = f"/api/exports/{job.id}"
+    return jsonify(export_status(job)), 202 if created else 200, {"Location": location}
+
+
+@app.route("/api/exports/<job_id>", methods=["GET"])
+def get_export(job_id):
+    """Status of an export: queued, running (with progress and rows so far), done or failed."""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "export not found"}), 404
+    return jsonify(export_status(job))
+
+
+@app.route("/api/exports/<job_id>/download", methods=["GET"])
+def download_export(job_id):
+    """The finished export file; supports Range requests for resuming."""
+    job = export_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "export not found"}), 404
+    if job.status != "done":
+        return jsonify({"error": f"export is {job.status}", **export_status(job)}), 409
+    extension, mimetype = EXPORT_FORMATS[job.filters["format"]]
+    export_jobs.begin_download(job)
+    try:
+        response = send_file(os.path.abspath(job.path), mimetype=mimetype, as_attachment=True,
+                             download_name=f"export-{job.id}{extension}", conditional=True)
+    except Exception:
+        export_jobs.end_download(job)
+        raise
+    # The file stays out of eviction until the transfer is over
+    response.call_on_close(lambda: export_jobs.end_download(job))
+    return response
+
+
 if __name__ == "__main__":
     # debug=True will show you stack traces in the console
     app.run(host="0.0.0.0", port=5000, debug=True)
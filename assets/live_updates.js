@@ -0,0 +1,24 @@
+// Push updates from the API (see change_feed.py). One EventSource per page
+// listens on /api/events; each change it announces is written to the
+// 'live-event' store, whose callbacks refetch only the map and time series
+// the change touched. The browser reconnects on its own, sending the last
+// version it saw so it gets anything it missed.
+
+var liveSource = null;
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    live: {
+        connect: function(config) {
+            if (!config || !window.EventSource || !window.dash_clientside.set_props) {
+                return 'unsupported';
+            }
+            if (liveSource === null) {
+                liveSource = new EventSource(config.url);
+                liveSource.addEventListener('dataset', function(e) {
+                    window.dash_clientside.set_props('live-event', {data: JSON.parse(e.data)});
+                });
+            }
+            return 'connected';
+        }
+    }
+});
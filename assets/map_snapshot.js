@@ -0,0 +1,111 @@
+// Clientside map rendering from a per-pollutant snapshot (see snapshots.py).
+// The snapshot is decoded once; picking another date only swaps the marker
+// colors and sizes, so scrubbing never calls back to the Dash server.
+// With the surface toggle on, the day's interpolated surface (see
+// interpolation.py) is laid under the markers as an image, and the markers
+// share its color scale.
+
+var decodedSnapshot = {key: null, grid: null};
+
+function snapshotGrid(snapshot) {
+    var key = snapshot.pollutant + '|' + snapshot.first_date + '|' + snapshot.grid.length;
+    if (decodedSnapshot.key !== key) {
+        var raw = atob(snapshot.grid);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) {
+            bytes[i] = raw.charCodeAt(i);
+        }
+        // Float32Array reads in platform byte order, which is little-endian in every browser
+        decodedSnapshot = {key: key, grid: new Float32Array(bytes.buffer)};
+    }
+    return decodedSnapshot.grid;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        showDay: function(snapshot, date, surface, toggle) {
+            if (!snapshot || !date) {
+                return {
+                    data: [],
+                    layout: {
+                        title: {text: 'No data for this pollutant'},
+                        mapbox: {style: 'open-street-map', zoom: 6, center: {lat: 45.6, lon: 9.8}},
+                        height: 500, uirevision: 'map'
+                    }
+                };
+            }
+
+            var grid = snapshotGrid(snapshot);
+            var day = Math.round((Date.parse(date.slice(0, 10)) - Date.parse(snapshot.first_date)) / 86400000);
+            var inRange = day >= 0 && day < snapshot.days;
+
+            var values = snapshot.sensors.map(function(_, row) {
+                var v = inRange ? grid[row * snapshot.days + day] : NaN;
+                return isNaN(v) ? null : v;
+            });
+            var present = values.filter(function(v) { return v !== null; });
+            var peak = present.length ? Math.max.apply(null, present) : 1;
+
+            var lats = snapshot.sensors.map(function(s) { return s.latitude; });
+            var lons = snapshot.sensors.map(function(s) { return s.longitude; });
+
+            var layers = [];
+            var marker = {};
+            var isoDate = date.slice(0, 10);
+            if (surface && toggle && toggle.indexOf('surface') !== -1) {
+                var b = surface.bounds;
+                if (isoDate >= surface.first_date && isoDate <= surface.last_date) {
+                    layers.push({
+                        sourcetype: 'image',
+                        source: surface.url + '/' + isoDate,
+                        // bounds are [west, south, east, north]
+                        coordinates: [[b[0], b[3]], [b[2], b[3]], [b[2], b[1]], [b[0], b[1]]],
+                        opacity: 0.6,
+                        below: 'traces'
+                    });
+                }
+                // Same scale as the surface image, so a marker matches the color around it
+                marker = {cmin: 0, cmax: surface.value_max};
+            }
+
+            return {
+                data: [{
+                    type: 'scattermapbox',
+                    mode: 'markers',
+                    lat: lats,
+                    lon: lons,
+                    text: snapshot.sensors.map(function(s) { return s.station_name; }),
+                    customdata: values,
+                    hovertemplate: '<b>%{text}</b><br>daily_avg=%{customdata:.2f}<extra></extra>',
+                    marker: {
+                        color: values,
+                        // Matches plotly express' size='daily_avg' with size_max=20
+                        size: values.map(function(v) { return v === null || peak <= 0 ? 0 : 20 * v / peak; }),
+                        colorscale: 'Plasma',
+                        cmin: marker.cmin,
+                        cmax: marker.cmax,
+                        showscale: true,
+                        colorbar: {title: {text: 'daily_avg'}}
+                    }
+                }],
+                layout: {
+                    title: {text: present.length ? snapshot.pollutant + ' on ' + isoDate
+                                                 : 'No data for ' + snapshot.pollutant + ' on ' + isoDate},
+                    mapbox: {
+                        style: 'open-street-map',
+                        layers: layers,
+                        zoom: 6,
+                        center: {
+                            lat: lats.reduce(function(a, b) { return a + b; }, 0) / lats.length,
+                            lon: lons.reduce(function(a, b) { return a + b; }, 0) / lons.length
+                        }
+                    },
+                    height: 500,
+                    margin: {l: 0, r: 0, t: 40, b: 0},
+                    // Keep the user's pan and zoom across date and pollutant changes
+                    uirevision: 'map'
+                }
+            };
+        }
+    }
+});
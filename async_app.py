@@ -0,0 +1,581 @@
+# async_app.py
+#
+# Async serving mode for the API: the routes and response shapes of app.py on
+# Starlette and asyncpg. A slow query only holds its own coroutine and pooled
+# connection, so the dashboard's parallel callbacks are not queued behind it.
+# Each request's database work runs under QUERY_TIMEOUT seconds (504 when
+# exceeded) and is cancelled in PostgreSQL as soon as the client disconnects.
+#
+#   uvicorn async_app:app --host 0.0.0.0 --port 5000
+#
+# Only the data routes are served here: the response cache (/api/cache),
+# /metrics, the /api/events change feed and the export jobs are app.py only.
+# Responses are gzip-compressed by Starlette's middleware; brotli is app.py only.
+
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import anyio
+import asyncpg
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from columnar import COLUMNAR_FORMATS, MIMETYPES, ColumnarEncoder, UnsupportedFormat, negotiate_format
+from db import DB_CONFIG, PoolTimeout
+from interpolation import surface_png
+from serialization import COMPRESS_MIN_BYTES, dumps
+from queries import (
+    DATE_RANGE_SQL, METADATA_COVERAGE_SQL, METADATA_POLLUTANTS_SQL, METADATA_SENSORS_SQL,
+    SENSOR_COVERAGE_SQL, SENSOR_SQL, SENSORS_SQL, SNAPSHOT_SENSORS_SQL, SNAPSHOT_SQL,
+    SURFACE_DAY_SQL, SURFACE_SQL, SurfaceDay, SurfaceGrid,
+    annual_stats_query, batch_measurements_query, batch_payload,
+    bbox_query, coverage_payload, limits_payload, measurements_query, metadata_payload,
+    nearest_query, page_cursor, parse_shape, parse_surface_day, radius_query,
+    raw_measurements_query, rolling_query, rows_payload, sensor_measurements_query,
+    snapshot_payload, surface_day_payload, surface_payload,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+# Rows fetched from the server-side cursor and written per response chunk
+STREAM_BATCH_ROWS = 5000
+# Seconds a request's queries may run, and between client-disconnect checks
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT", 30))
+DISCONNECT_POLL = 0.25
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+
+pool = None
+
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was ready."""
+
+
+# Exceptions handled by the app-level handlers below rather than as a 500
+PASSTHROUGH = (PoolTimeout, asyncio.TimeoutError, ClientDisconnected)
+
+
+def json_response(obj, status_code=200):
+    # Sorted keys like Flask's provider, so both servers send byte-identical bodies
+    return Response(dumps(obj, sort_keys=True) + b"\n", status_code=status_code, media_type="application/json")
+
+
+class FormatRequest:
+    """The parts of a Flask request that negotiate_format() reads."""
+
+    def __init__(self, request):
+        self.args = request.query_params
+        self.accept_mimetypes = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+
+
+def parse_interval(text):
+    """'6 hours' (as built by queries.parse_bucket) -> timedelta(hours=6)."""
+    count, unit = text.split()
+    return timedelta(**{unit: int(count)})
+
+
+# asyncpg wants Python values of the parameter's type, while the query
+# builders pass dates and intervals through as the client's strings
+PARAM_TYPES = {
+    "timestamp": datetime.fromisoformat,
+    "date": lambda v: datetime.fromisoformat(v).date(),
+    "interval": parse_interval,
+    "float8": float,
+    "int4": int,
+    "int8": int,
+}
+
+
+def coerce_params(stmt, params):
+    types = [t.name for t in stmt.get_parameters()]
+    return [PARAM_TYPES[t](v) if isinstance(v, str) and t in PARAM_TYPES else v
+            for t, v in zip(types, params)]
+
+
+async def init_connection(conn):
+    # Decode json columns (e.g. ST_AsGeoJSON(...)::json) like psycopg2 does
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(
+        min_size=int(os.environ.get("DB_POOL_MIN", 1)),
+        max_size=int(os.environ.get("DB_POOL_MAX", 10)),
+        init=init_connection,
+        **DB_CONFIG
+    )
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+async def acquire():
+    try:
+        return await pool.acquire(timeout=POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PoolTimeout(f"no database connection available within {POOL_TIMEOUT:.1f}s "
+                          f"({pool.get_max_size()} in use)")
+
+
+async def release(conn, transaction=None):
+    # Shielded: this also runs while a disconnected stream is being cancelled
+    with anyio.CancelScope(shield=True):
+        try:
+            if transaction is not None:
+                await transaction.rollback()
+            await pool.release(conn)
+        except Exception:
+            conn.terminate()
+            await pool.release(conn)
+
+
+async def fetch_rows(sql, params=()):
+    """(column names, records) of `sql`, on a connection of their own."""
+    conn = await acquire()
+    try:
+        stmt = await conn.prepare(sql)
+        cols = [a.name for a in stmt.get_attributes()]
+        return cols, await stmt.fetch(*coerce_params(stmt, params))
+    finally:
+        await release(conn)
+
+
+async def fetch(sql, params=()):
+    """Rows of `sql` as dicts."""
+    return rows_payload(*await fetch_rows(sql, params))
+
+
+async def until_disconnect(request, coro):
+    """
+    Await `coro` under QUERY_TIMEOUT; cancelling it, and with it the running
+    query, if the client disconnects first.
+    """
+    task = asyncio.ensure_future(asyncio.wait_for(coro, QUERY_TIMEOUT))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected(request.url.path)
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def pool_exhausted(request, e):
+    logging.warning("Connection pool exhausted: %s", e)
+    return json_response({"error": str(e)}, 503)
+
+
+async def unsupported_format(request, e):
+    return json_response({"error": str(e)}, 406)
+
+
+async def query_timeout(request, e):
+    logging.warning("Query for %s exceeded %.1fs", request.url.path, QUERY_TIMEOUT)
+    return json_response({"error": f"query exceeded {QUERY_TIMEOUT:.1f}s"}, 504)
+
+
+async def client_disconnected(request, e):
+    logging.info("Client disconnected, cancelled %s", e)
+    # Nobody reads this; 499 is the conventional "client closed request" code
+    return Response(status_code=499)
+
+
+async def pool_stats(request):
+    size, idle = pool.get_size(), pool.get_idle_size()
+    return json_response({
+        "min": pool.get_min_size(),
+        "max": pool.get_max_size(),
+        "size": size,
+        "in_use": size - idle,
+        "idle": idle,
+        "utilization": round((size - idle) / pool.get_max_size(), 3),
+    })
+
+
+async def list_sensors(request):
+    try:
+        shape = parse_shape(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    try:
+        cols, rows = await until_disconnect(request, fetch_rows(SENSORS_SQL))
+        return json_response(rows_payload(cols, rows, shape))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch sensors")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_sensor(request):
+    sensor_id = request.path_params["sensor_id"]
+    try:
+        rows = await until_disconnect(request, fetch(SENSOR_SQL, (sensor_id,)))
+        if not rows:
+            return json_response({"error": "sensor not found"}, 404)
+        return json_response(rows[0])
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch sensor {sensor_id}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_date_range(request):
+    try:
+        rows = await until_disconnect(request, fetch(DATE_RANGE_SQL))
+        return json_response({
+            "first_date": rows[0]["first_date"].isoformat(),
+            "last_date": rows[0]["last_date"].isoformat()
+        })
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch date range")
+        return json_response({"error": str(e)}, 500)
+
+
+async def sensor_coverage(request):
+    sensor_id = request.path_params["sensor_id"]
+    try:
+        rows = await until_disconnect(request, fetch(SENSOR_COVERAGE_SQL, (sensor_id,)))
+        if not rows:
+            return json_response({"error": "no coverage found"}, 404)
+        return json_response(coverage_payload(rows))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch coverage for sensor {sensor_id}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_metadata(request):
+    try:
+        # The three catalog queries run concurrently, each on its own connection
+        pollutants, sensors, coverage = await until_disconnect(request, asyncio.gather(
+            fetch(METADATA_POLLUTANTS_SQL),
+            fetch(METADATA_SENSORS_SQL),
+            fetch(METADATA_COVERAGE_SQL),
+        ))
+        pollutants = [row["pollutant"] for row in pollutants]
+        return json_response(metadata_payload(pollutants, sensors, coverage))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch metadata")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_map_snapshot(request):
+    pollutant = request.path_params["pollutant"]
+    try:
+        snapshot, sensors = await until_disconnect(request, asyncio.gather(
+            fetch(SNAPSHOT_SQL, (pollutant,)),
+            fetch(SNAPSHOT_SENSORS_SQL, (pollutant,)),
+        ))
+        if not snapshot:
+            return json_response({"error": "no snapshot for this pollutant"}, 404)
+        row = snapshot[0]
+        return json_response(snapshot_payload(pollutant, (row["first_date"], row["days"], row["grid"]), sensors))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch map snapshot for {pollutant}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_surface_grid(request):
+    pollutant = request.path_params["pollutant"]
+    try:
+        _, rows = await until_disconnect(request, fetch_rows(SURFACE_SQL, (pollutant,)))
+        if not rows:
+            return json_response({"error": "no surfaces for this pollutant"}, 404)
+        return json_response(surface_payload(pollutant, SurfaceGrid(*rows[0])))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch surface grid for {pollutant}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def get_surface(request):
+    pollutant = request.path_params["pollutant"]
+    fmt = request.query_params.get("format", "png")
+    try:
+        day = parse_surface_day(request.path_params["day"])
+        if fmt not in ("png", "json"):
+            raise ValueError("format must be png or json")
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    try:
+        _, rows = await until_disconnect(request, fetch_rows(SURFACE_DAY_SQL, (pollutant, day)))
+        if not rows:
+            return json_response({"error": "no surface for this pollutant and day"}, 404)
+        row = SurfaceDay(*rows[0])
+        if fmt == "json":
+            return json_response(surface_day_payload(pollutant, day, row))
+        return Response(surface_png(row.grid, row.width, row.height), media_type="image/png")
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch surface for {pollutant} on {day}")
+        return json_response({"error": str(e)}, 500)
+
+
+def encode_json_batches(fmt):
+    """Per-batch encoder for json/ndjson bodies, matching app.stream_response."""
+    state = {"leading": "[" if fmt == "json" else ""}
+
+    def write(cols, rows):
+        if fmt == "ndjson":
+            return b"".join(dumps(dict(zip(cols, row)), sort_keys=True) + b"\n" for row in rows)
+        chunk = state["leading"].encode() + b",".join(
+            dumps(dict(zip(cols, row)), sort_keys=True) for row in rows)
+        state["leading"] = ","
+        return chunk
+
+    def close():
+        if fmt == "ndjson":
+            return b""
+        # An empty result never wrote the opening bracket
+        return ("[]" if state["leading"] == "[" else "]").encode()
+
+    return write, close
+
+
+async def stream_query(sql, params, fmt, what, page=None):
+    """
+    Run `sql` on a server-side cursor and stream the result as `fmt`. The
+    connection is released when the body ends or the client disconnects,
+    which cancels the generator mid-fetch. With `page`, the `page + 1` rows
+    of a RawQuery are read first to set X-Next-Cursor.
+    """
+    conn = await acquire()
+    transaction = conn.transaction()
+    try:
+        await transaction.start()
+        stmt = await conn.prepare(sql)
+        cols = [a.name for a in stmt.get_attributes()]
+        cursor = await stmt.cursor(*coerce_params(stmt, params), timeout=QUERY_TIMEOUT)
+        first = await cursor.fetch(page + 1 if page else STREAM_BATCH_ROWS, timeout=QUERY_TIMEOUT)
+        next_cursor = None
+        if page:
+            first, next_cursor = page_cursor(first, page)
+    except asyncio.TimeoutError:
+        await release(conn, transaction)
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
+        await release(conn, transaction)
+        return json_response({"error": str(e)}, 500)
+
+    if fmt in COLUMNAR_FORMATS:
+        encoder = ColumnarEncoder(fmt, cols)
+        write, close = (lambda cols, rows: encoder.write(rows)), encoder.close
+    else:
+        write, close = encode_json_batches(fmt)
+
+    async def body():
+        try:
+            batch = first
+            while batch:
+                data = write(cols, batch)
+                if data:
+                    yield data
+                batch = await cursor.fetch(STREAM_BATCH_ROWS, timeout=QUERY_TIMEOUT)
+            yield close()
+        except Exception:
+            logging.exception("Response stream aborted")
+        finally:
+            await release(conn, transaction)
+
+    headers = {}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return StreamingResponse(body(), media_type=MIMETYPES[fmt], headers=headers)
+
+
+async def list_raw_measurements(request):
+    fmt = negotiate_format(FormatRequest(request), ("json", "ndjson") + COLUMNAR_FORMATS)
+    try:
+        query = raw_measurements_query(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    return await stream_query(query.sql, query.params, fmt, query.what, query.page)
+
+
+async def spatial_response(request, build, what):
+    try:
+        sql, params = build(request.query_params)
+        shape = parse_shape(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    try:
+        cols, rows = await until_disconnect(request, fetch_rows(sql, params))
+        return json_response(rows_payload(cols, rows, shape))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def sensors_in_bbox(request):
+    return await spatial_response(request, bbox_query, "sensors in bounding box")
+
+
+async def sensors_in_radius(request):
+    return await spatial_response(request, radius_query, "sensors in radius")
+
+
+async def nearest_sensors(request):
+    return await spatial_response(request, nearest_query, "nearest sensors")
+
+
+async def list_measurements(request):
+    fmt = negotiate_format(FormatRequest(request), ("json",) + COLUMNAR_FORMATS)
+    try:
+        sql, params = measurements_query(request.query_params)
+        shape = parse_shape(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    if fmt in COLUMNAR_FORMATS:
+        return await stream_query(sql, params, fmt, "daily measurements")
+
+    try:
+        cols, rows = await until_disconnect(request, fetch_rows(sql, params))
+        return json_response(rows_payload(cols, rows, shape))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch daily measurements")
+        return json_response({"error": str(e)}, 500)
+
+
+async def batch_measurements(request):
+    fmt = negotiate_format(FormatRequest(request), ("json",) + COLUMNAR_FORMATS)
+    try:
+        sql, params, resolution = batch_measurements_query(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    if fmt in COLUMNAR_FORMATS:
+        return await stream_query(sql, params, fmt, "batch measurements")
+
+    try:
+        rows = await until_disconnect(request, fetch(sql, params))
+        return json_response(batch_payload(rows, resolution))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception("Failed to fetch batch measurements")
+        return json_response({"error": str(e)}, 500)
+
+
+async def analytics_response(request, build, what):
+    try:
+        sql, params = build(request.query_params)
+        shape = parse_shape(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    try:
+        cols, rows = await until_disconnect(request, fetch_rows(sql, params))
+        return json_response(rows_payload(cols, rows, shape))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch {what}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def analytics_limits(request):
+    return json_response(limits_payload())
+
+
+async def annual_stats(request):
+    return await analytics_response(request, annual_stats_query, "annual statistics")
+
+
+async def rolling_mean(request):
+    return await analytics_response(request, rolling_query, "rolling means")
+
+
+async def measurements_by_sensor(request):
+    sensor_id = request.path_params["sensor_id"]
+    try:
+        sql, params = sensor_measurements_query(sensor_id, request.query_params)
+        shape = parse_shape(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    try:
+        cols, rows = await until_disconnect(request, fetch_rows(sql, params))
+        if not rows:
+            return json_response({"error": "no measurements found"}, 404)
+        return json_response(rows_payload(cols, rows, shape))
+    except PASSTHROUGH:
+        raise
+    except Exception as e:
+        logging.exception(f"Failed to fetch measurements for sensor {sensor_id}")
+        return json_response({"error": str(e)}, 500)
+
+
+app = Starlette(
+    routes=[
+        Route("/api/pool", pool_stats),
+        Route("/api/sensors", list_sensors),
+        Route("/api/sensors/{sensor_id}", get_sensor),
+        Route("/api/date_range", get_date_range),
+        Route("/api/sensors/{sensor_id}/coverage", sensor_coverage),
+        Route("/api/metadata", get_metadata),
+        Route("/api/map_snapshots/{pollutant}", get_map_snapshot),
+        Route("/api/surfaces/{pollutant}", get_surface_grid),
+        Route("/api/surfaces/{pollutant}/{day}", get_surface),
+        Route("/api/raw_measurements", list_raw_measurements),
+        Route("/api/spatial/bbox", sensors_in_bbox),
+        Route("/api/spatial/radius", sensors_in_radius),
+        Route("/api/spatial/nearest", nearest_sensors),
+        Route("/api/measurements", list_measurements),
+        Route("/api/measurements/batch", batch_measurements),
+        Route("/api/analytics/limits", analytics_limits),
+        Route("/api/analytics/annual", annual_stats),
+        Route("/api/analytics/rolling", rolling_mean),
+        Route("/api/sensors/{sensor_id}/measurements", measurements_by_sensor),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], expose_headers=["X-Next-Cursor", "ETag"]),
+        Middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_BYTES),
+    ],
+    exception_handlers={
+        PoolTimeout: pool_exhausted,
+        UnsupportedFormat: unsupported_format,
+        asyncio.TimeoutError: query_timeout,
+        ClientDisconnected: client_disconnected,
+    },
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("async_app:app", host="0.0.0.0", port=5000,
+                workers=int(os.environ.get("ASYNC_WORKERS", 1)))
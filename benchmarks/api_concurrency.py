@@ -0,0 +1,135 @@
+# benchmarks/api_concurrency.py
+#
+# Throughput and tail latency of a running API server as the number of
+# concurrent dashboard sessions grows. Each simulated session repeats what a
+# dashboard page does: load metadata and a map snapshot, pick a sensor, read
+# its coverage, then draw a downsampled month of hourly data and a year of
+# daily aggregates. Sensors and windows are drawn at random so responses are
+# rarely served from the response cache.
+#
+#   python app.py                       # or: uvicorn async_app:app --port 5000
+#   python -m benchmarks.api_concurrency --sessions 1,4,16,64 --out flask.json
+#   python -m benchmarks.api_concurrency --compare flask.json async.json
+
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+
+API_BASE = "http://localhost:5000/api"
+
+
+def session_urls(base, meta, rng):
+    """The requests of one dashboard page view, in order."""
+    sensor = rng.choice(meta["sensors"])["sensor_id"]
+    pollutant = rng.choice(meta["pollutants"])
+    first = date.fromisoformat(meta["date_range"]["first_date"])
+    last = date.fromisoformat(meta["date_range"]["last_date"])
+    span = max((last - first).days - 365, 1)
+    day = first + timedelta(days=rng.randrange(span))
+    return [
+        ("metadata", f"{base}/metadata"),
+        ("map_snapshot", f"{base}/map_snapshots/{pollutant}"),
+        ("coverage", f"{base}/sensors/{sensor}/coverage"),
+        ("raw_month", f"{base}/raw_measurements?sensor_id={sensor}"
+                      f"&start={day}&end={day + timedelta(days=30)}&points=4000"),
+        ("daily_year", f"{base}/sensors/{sensor}/measurements"
+                       f"?start={day}&end={day + timedelta(days=365)}"),
+    ]
+
+
+def run_level(base, meta, sessions, duration):
+    """Run `sessions` concurrent sessions for `duration` seconds."""
+    timings, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def session(seed):
+        rng = random.Random(seed)
+        http = requests.Session()
+        while time.perf_counter() < stop_at:
+            for name, url in session_urls(base, meta, rng):
+                t0 = time.perf_counter()
+                try:
+                    resp = http.get(url, timeout=120)
+                    resp.content
+                    ok = resp.status_code in (200, 404)
+                except requests.RequestException:
+                    ok = False
+                elapsed = (time.perf_counter() - t0) * 1000
+                with lock:
+                    (timings if ok else errors).append(elapsed)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "sessions": sessions,
+        "requests": len(timings),
+        "errors": len(errors),
+        "throughput_rps": round(len(timings) / wall, 2),
+        "median_ms": round(statistics.median(timings), 2) if timings else None,
+        "p99_ms": round(timings[int(0.99 * (len(timings) - 1))], 2) if timings else None,
+    }
+
+
+def run(base, levels, duration):
+    meta = requests.get(f"{base}/metadata", timeout=60).json()
+    report = {}
+    for sessions in levels:
+        result = run_level(base, meta, sessions, duration)
+        report[str(sessions)] = result
+        print(f"{sessions:4d} sessions  {result['throughput_rps']:8.2f} req/s   "
+              f"median {result['median_ms']} ms   p99 {result['p99_ms']} ms   errors {result['errors']}")
+    return report
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'sessions':>8s} {'req/s before':>13s} {'req/s after':>12s} {'p99 before':>11s} {'p99 after':>10s}")
+    for level, b in before.items():
+        a = after.get(level)
+        if a is None:
+            continue
+        print(f"{level:>8s} {b['throughput_rps']:13.2f} {a['throughput_rps']:12.2f} "
+              f"{b['p99_ms']:11.2f} {a['p99_ms']:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API throughput and p99 latency under concurrent sessions.")
+    parser.add_argument("--base", default=API_BASE, help="API base URL of the server under test")
+    parser.add_argument("--sessions", default="1,2,4,8,16,32",
+                        help="comma-separated concurrent session counts to run")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per level")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="print a comparison of two saved reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.base, [int(n) for n in args.sessions.split(",")], args.duration)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
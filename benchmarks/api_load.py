@@ -0,0 +1,249 @@
+# benchmarks/api_load.py
+#
+# Replays a mix of dashboard and report traffic against a running API server
+# and reports requests/s plus p50/p95/p99 latency per endpoint. Every GET
+# route of app.py that answers with data, the surface overlay included, is
+# in the mix, weighted roughly by how often the dashboard and report users
+# call it. The /api/events stream, the export jobs and /metrics are left out.
+# Parameters are drawn from /api/metadata, so the run
+# works against any loaded database, including one built from
+# benchmarks/generate_dataset.py.
+#
+#   python app.py
+#   python -m benchmarks.api_load --clients 16 --duration 60 --out load.json
+#   python -m benchmarks.api_load --compare before.json after.json
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+
+API_BASE = "http://localhost:5000/api"
+
+
+def percentile(sorted_values, q):
+    return round(sorted_values[int(q * (len(sorted_values) - 1))], 2) if sorted_values else None
+
+
+def traffic(meta):
+    """(name, weight, url builder) for every endpoint; builders take (base, rng)."""
+    sensors = meta["sensors"]
+    pollutants = meta["pollutants"]
+    provinces = sorted({s["province"] for s in sensors if s["province"]})
+    first = date.fromisoformat(meta["date_range"]["first_date"])
+    last = date.fromisoformat(meta["date_range"]["last_date"])
+
+    def sensor(rng):
+        return rng.choice(sensors)
+
+    def day(rng, room=0):
+        return first + timedelta(days=rng.randrange(max((last - first).days - room, 1)))
+
+    def point(rng):
+        s = sensor(rng)
+        return s["latitude"] + rng.uniform(-0.05, 0.05), s["longitude"] + rng.uniform(-0.05, 0.05)
+
+    def raw_window(base, rng):
+        d = day(rng, 30)
+        return (f"{base}/raw_measurements?sensor_id={sensor(rng)['sensor_id']}"
+                f"&start={d}&end={d + timedelta(days=30)}&points=4000")
+
+    def raw_page(base, rng):
+        d = day(rng, 7)
+        return (f"{base}/raw_measurements?pollutant={rng.choice(pollutants)}"
+                f"&start={d}&end={d + timedelta(days=1)}&limit=5000")
+
+    def raw_bucketed(base, rng):
+        d = day(rng, 365)
+        return (f"{base}/raw_measurements?sensor_id={sensor(rng)['sensor_id']}"
+                f"&start={d}&end={d + timedelta(days=365)}&bucket=1d")
+
+    def raw_arrow(base, rng):
+        d = day(rng, 7)
+        return (f"{base}/raw_measurements?sensor_id={sensor(rng)['sensor_id']}"
+                f"&start={d}&end={d + timedelta(days=7)}&format=arrow")
+
+    def daily_pollutant(base, rng):
+        d = day(rng)
+        return f"{base}/measurements?pollutant={rng.choice(pollutants)}&start={d}&end={d}"
+
+    def monthly(base, rng):
+        return f"{base}/measurements?sensor_id={sensor(rng)['sensor_id']}&resolution=month"
+
+    def sensor_year(base, rng):
+        d = day(rng, 365)
+        return f"{base}/sensors/{sensor(rng)['sensor_id']}/measurements?start={d}&end={d + timedelta(days=365)}"
+
+    def batch(base, rng):
+        return (f"{base}/measurements/batch?province={rng.choice(provinces)}"
+                f"&pollutant={rng.choice(pollutants)}&resolution=week")
+
+    def bbox(base, rng):
+        lat, lon = point(rng)
+        return f"{base}/spatial/bbox?min_lon={lon - 0.3}&min_lat={lat - 0.2}&max_lon={lon + 0.3}&max_lat={lat + 0.2}"
+
+    def radius(base, rng):
+        lat, lon = point(rng)
+        return f"{base}/spatial/radius?lat={lat}&lon={lon}&radius=20000&pollutant={rng.choice(pollutants)}"
+
+    def nearest(base, rng):
+        lat, lon = point(rng)
+        return f"{base}/spatial/nearest?lat={lat}&lon={lon}&k=5&pollutant={rng.choice(pollutants)}&date={day(rng)}"
+
+    def annual(base, rng):
+        return (f"{base}/analytics/annual?province={rng.choice(provinces)}"
+                f"&pollutant={rng.choice(pollutants)}&year={day(rng).year}")
+
+    def rolling(base, rng):
+        d = day(rng, 30)
+        return (f"{base}/analytics/rolling?sensor_id={sensor(rng)['sensor_id']}"
+                f"&pollutant={rng.choice(pollutants)}&window=8h&start={d}&end={d + timedelta(days=30)}")
+
+    return [
+        ("metadata", 10, lambda base, rng: f"{base}/metadata"),
+        ("map_snapshot", 8, lambda base, rng: f"{base}/map_snapshots/{rng.choice(pollutants)}"),
+        # With the overlay on, the dashboard reads the grid once per pollutant
+        # and one PNG per day it shows
+        ("surface", 3, lambda base, rng: f"{base}/surfaces/{rng.choice(pollutants)}"),
+        ("surface_png", 8, lambda base, rng: f"{base}/surfaces/{rng.choice(pollutants)}/{day(rng)}"),
+        ("coverage", 8, lambda base, rng: f"{base}/sensors/{sensor(rng)['sensor_id']}/coverage"),
+        ("raw_window", 12, raw_window),
+        ("raw_page", 3, raw_page),
+        ("raw_bucketed", 3, raw_bucketed),
+        ("raw_arrow", 2, raw_arrow),
+        ("daily_pollutant", 4, daily_pollutant),
+        ("monthly", 3, monthly),
+        ("sensor_year", 8, sensor_year),
+        ("batch", 4, batch),
+        ("annual", 4, annual),
+        ("rolling", 2, rolling),
+        ("bbox", 2, bbox),
+        ("radius", 2, radius),
+        ("nearest", 2, nearest),
+        ("sensors", 1, lambda base, rng: f"{base}/sensors"),
+        ("sensor", 2, lambda base, rng: f"{base}/sensors/{sensor(rng)['sensor_id']}"),
+        ("date_range", 1, lambda base, rng: f"{base}/date_range"),
+        ("limits", 1, lambda base, rng: f"{base}/analytics/limits"),
+        ("pool", 1, lambda base, rng: f"{base}/pool"),
+        ("cache", 1, lambda base, rng: f"{base}/cache"),
+    ]
+
+
+def run(base, clients, duration, seed):
+    meta = requests.get(f"{base}/metadata", timeout=60).json()
+    mix = traffic(meta)
+    names = [name for name, _, _ in mix]
+    weights = [weight for _, weight, _ in mix]
+    builders = {name: build for name, _, build in mix}
+
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(i):
+        rng = random.Random(seed + i)
+        http = requests.Session()
+        while time.perf_counter() < stop_at:
+            name = rng.choices(names, weights)[0]
+            url = builders[name](base, rng)
+            t0 = time.perf_counter()
+            try:
+                resp = http.get(url, timeout=120)
+                resp.content
+                # 404 is a valid answer for a sensor without data; /api/cache only exists in app.py
+                ok = resp.status_code < 400 or resp.status_code == 404
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - t0) * 1000
+            with lock:
+                if ok:
+                    timings[name].append(elapsed)
+                else:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    report = {"clients": clients, "duration_s": round(wall, 1), "endpoints": {}}
+    every = []
+    for name in names:
+        values = sorted(timings[name])
+        every.extend(values)
+        report["endpoints"][name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "p50_ms": percentile(values, 0.50),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+        }
+    every.sort()
+    report["total"] = {
+        "requests": len(every),
+        "errors": sum(errors.values()),
+        "throughput_rps": round(len(every) / wall, 2),
+        "p50_ms": percentile(every, 0.50),
+        "p95_ms": percentile(every, 0.95),
+        "p99_ms": percentile(every, 0.99),
+    }
+    return report
+
+
+def print_report(report):
+    print(f"{'endpoint':16s} {'requests':>9s} {'errors':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    rows = list(report["endpoints"].items()) + [("TOTAL", report["total"])]
+    for name, r in rows:
+        print(f"{name:16s} {r['requests']:9d} {r['errors']:7d} "
+              f"{r['p50_ms'] or 0:9.2f} {r['p95_ms'] or 0:9.2f} {r['p99_ms'] or 0:9.2f}")
+    print(f"{report['total']['throughput_rps']:.2f} req/s with {report['clients']} clients")
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'endpoint':16s} {'p95 before':>11s} {'p95 after':>10s} {'p99 before':>11s} {'p99 after':>10s}")
+    rows = list(before["endpoints"].items()) + [("TOTAL", before["total"])]
+    for name, b in rows:
+        a = after["total"] if name == "TOTAL" else after["endpoints"].get(name)
+        if a is None or b["p95_ms"] is None or a["p95_ms"] is None:
+            continue
+        print(f"{name:16s} {b['p95_ms']:11.2f} {a['p95_ms']:10.2f} {b['p99_ms']:11.2f} {a['p99_ms']:10.2f}")
+    print(f"req/s: {before['total']['throughput_rps']:.2f} -> {after['total']['throughput_rps']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay mixed API traffic and report latency percentiles.")
+    parser.add_argument("--base", default=API_BASE, help="API base URL of the server under test")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the request mix")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="print a comparison of two saved reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.base, args.clients, args.duration, args.seed)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# benchmarks/generate_dataset.py
+#
+# Writes a synthetic dataset in the two Dati Lombardia formats that
+# manage_data.py reads: the station registry (one row per sensor) and the
+# hourly sensor readings. Values follow a per-pollutant level with seasonal
+# and daily cycles and log-normal noise. A share of hours is missing
+# entirely, and another share is reported as -9999, the way the real feed
+# marks invalid readings. The same seed always gives the same files.
+#
+#   python -m benchmarks.generate_dataset --sensors 200 --years 2 --out benchmarks/data
+#   python manage_data.py --sensors-csv benchmarks/data/stations.csv \
+#                         --measurements-csv benchmarks/data/measurements.csv
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from manage_data import TIMESTAMP_FORMAT
+
+# Pollutant name -> (unit, typical level, seasonal amplitude, summer peak)
+# Amplitudes are a share of the level; a summer peak flips the yearly cycle.
+POLLUTANTS = {
+    "PM10 (SM2005)": ("µg/m³", 30.0, 0.5, False),
+    "Particelle sospese PM2.5": ("µg/m³", 20.0, 0.5, False),
+    "Biossido di Azoto": ("µg/m³", 35.0, 0.35, False),
+    "Ozono": ("µg/m³", 55.0, 0.7, True),
+    "Biossido di Zolfo": ("µg/m³", 4.0, 0.3, False),
+    "Monossido di Carbonio": ("mg/m³", 0.7, 0.4, False),
+    "Benzene": ("µg/m³", 1.2, 0.4, False),
+}
+
+# Province code -> approximate centre (lat, lng)
+PROVINCES = {
+    "MI": (45.46, 9.19), "BG": (45.70, 9.67), "BS": (45.54, 10.22), "CO": (45.81, 9.09),
+    "CR": (45.13, 10.02), "LC": (45.86, 9.40), "LO": (45.31, 9.50), "MN": (45.16, 10.79),
+    "MB": (45.58, 9.27), "PV": (45.19, 9.16), "SO": (46.17, 9.87), "VA": (45.82, 8.83),
+}
+
+STATION_COLUMNS = [
+    "IdSensore", "NomeTipoSensore", "UnitaMisura", "Idstazione", "NomeStazione", "Quota",
+    "Provincia", "Comune", "Storico", "DataStart", "DataStop", "Utm_Nord", "UTM_Est",
+    "lat", "lng", "location",
+]
+MEASUREMENT_COLUMNS = ["idSensore", "Data", "Valore", "idOperatore", "Stato"]
+
+# Sensors per station, as in the real network
+SENSORS_PER_STATION = 4
+
+
+def build_stations(n_sensors, first_sensor_id, rng):
+    """The station registry: sensors grouped into stations spread over the provinces."""
+    rows = []
+    pollutants = list(POLLUTANTS)
+    n_stations = max(1, -(-n_sensors // SENSORS_PER_STATION))
+    provinces = list(PROVINCES)
+    for station in range(n_stations):
+        province = provinces[station % len(provinces)]
+        lat0, lng0 = PROVINCES[province]
+        lat, lng = lat0 + rng.normal(0, 0.08), lng0 + rng.normal(0, 0.1)
+        name = f"{province} Stazione {station + 1:04d}"
+        kinds = rng.choice(len(pollutants), size=SENSORS_PER_STATION, replace=False)
+        for kind in kinds:
+            if len(rows) == n_sensors:
+                break
+            pollutant = pollutants[kind]
+            rows.append({
+                "IdSensore": first_sensor_id + len(rows),
+                "NomeTipoSensore": pollutant,
+                "UnitaMisura": POLLUTANTS[pollutant][0],
+                "Idstazione": 500 + station,
+                "NomeStazione": name,
+                "Quota": int(rng.integers(50, 400)),
+                "Provincia": province,
+                "Comune": name,
+                "Storico": "N",
+                "DataStart": "01/01/2000",
+                "DataStop": "",
+                "Utm_Nord": int(5_000_000 + (lat - 45) * 111_000),
+                "UTM_Est": int(500_000 + (lng - 9) * 78_000),
+                "lat": round(lat, 6),
+                "lng": round(lng, 6),
+                "location": f"({lat:.6f}, {lng:.6f})",
+            })
+    return pd.DataFrame(rows, columns=STATION_COLUMNS)
+
+
+def sensor_series(pollutant, hours, rng, missing_rate, invalid_rate):
+    """(mask of hours kept, values) for one sensor over `hours`."""
+    _, level, amplitude, summer_peak = POLLUTANTS[pollutant]
+    day_of_year = hours.dayofyear.to_numpy()
+    hour = hours.hour.to_numpy()
+
+    season = np.cos(2 * np.pi * (day_of_year - 15) / 365.25)
+    if summer_peak:
+        season = -season
+        daily = np.maximum(np.sin(np.pi * (hour - 8) / 12), -0.3)  # afternoon photochemistry
+    else:
+        daily = 0.5 * np.cos(2 * np.pi * (hour - 8) / 24) + 0.3 * np.cos(2 * np.pi * (hour - 19) / 12)
+    site = rng.lognormal(0, 0.25)
+    values = level * site * (1 + amplitude * season) * (1 + 0.3 * daily)
+    values *= rng.lognormal(0, 0.35, size=len(hours))
+    values = np.round(np.maximum(values, 0), 1)
+
+    values[rng.random(len(hours)) < invalid_rate] = -9999
+    keep = rng.random(len(hours)) >= missing_rate
+    return keep, values
+
+
+def write_measurements(path, stations, hours, rng, missing_rate, invalid_rate):
+    """Write every sensor's readings to `path`; returns the row count."""
+    # Each distinct timestamp is formatted once and reused for every sensor
+    stamps = hours.strftime(TIMESTAMP_FORMAT).to_numpy()
+    rows = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(",".join(MEASUREMENT_COLUMNS) + "\n")
+        for sensor_id, pollutant in zip(stations["IdSensore"], stations["NomeTipoSensore"]):
+            keep, values = sensor_series(pollutant, hours, rng, missing_rate, invalid_rate)
+            frame = pd.DataFrame({
+                "idSensore": sensor_id,
+                "Data": stamps[keep],
+                "Valore": values[keep],
+                "idOperatore": 1,
+                "Stato": np.where(values[keep] == -9999, "NA", "VA"),
+            })
+            frame.to_csv(f, header=False, index=False)
+            rows += len(frame)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Dati Lombardia-format CSVs for benchmarks.")
+    parser.add_argument("--out", default=os.path.join("benchmarks", "data"), help="output directory")
+    parser.add_argument("--sensors", type=int, default=200, help="number of sensors")
+    parser.add_argument("--years", type=int, default=2, help="years of hourly data")
+    parser.add_argument("--start-year", type=int, default=2018)
+    parser.add_argument("--missing-rate", type=float, default=0.03,
+                        help="share of hours with no row at all")
+    parser.add_argument("--invalid-rate", type=float, default=0.02,
+                        help="share of rows reported as -9999")
+    parser.add_argument("--first-sensor-id", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.start_year + args.years > 2024:
+        print("⚠️ manage_data.py only keeps readings before 2024; later years will be dropped on load.")
+
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    hours = pd.date_range(f"{args.start_year}-01-01", f"{args.start_year + args.years}-01-01",
+                          freq="h", inclusive="left")
+
+    t0 = time.perf_counter()
+    stations = build_stations(args.sensors, args.first_sensor_id, rng)
+    stations_path = os.path.join(args.out, "stations.csv")
+    stations.to_csv(stations_path, index=False)
+    print(f"🏭 {len(stations):,} sensors at {stations['Idstazione'].nunique():,} stations -> {stations_path}")
+
+    measurements_path = os.path.join(args.out, "measurements.csv")
+    rows = write_measurements(measurements_path, stations, hours, rng, args.missing_rate, args.invalid_rate)
+    size_mb = os.path.getsize(measurements_path) / 1024 / 1024
+    print(f"📈 {rows:,} hourly rows ({size_mb:,.0f} MB) -> {measurements_path}")
+    print(f"✅ Done in {time.perf_counter() - t0:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# benchmarks/ingest.py
+#
+# Ingestion throughput and peak memory of manage_data.py, per loader mode,
+# against a local PostgreSQL. Before each mode the schema is dropped and
+# rebuilt with create_table.py --reset, so point DB_NAME at a database you
+# can throw away. Peak memory is the summed RSS of the loader and its worker
+# processes, sampled every 100 ms.
+#
+#   python -m benchmarks.generate_dataset --sensors 200 --years 2
+#   DB_NAME=se_bench python -m benchmarks.ingest --allow-reset --out ingest.json
+#   python -m benchmarks.ingest --compare before.json after.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+import psycopg2
+
+from db import DB_CONFIG
+
+DATA_DIR = os.path.join("benchmarks", "data")
+
+# Mode name -> extra manage_data.py arguments
+MODES = {
+    "full": [],
+    "stream": ["--stream"],
+    "parallel": ["--parallel"],
+    "incremental": ["--incremental"],
+}
+SAMPLE_INTERVAL = 0.1
+
+
+def run_tracked(cmd):
+    """Run `cmd`; return (seconds, peak RSS in MB of it and its children)."""
+    # stderr goes to a file so a chatty loader cannot fill a pipe and stall
+    with tempfile.TemporaryFile(mode="w+") as log:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log)
+        tree = psutil.Process(proc.pid)
+        peak = 0
+        while proc.poll() is None:
+            try:
+                rss = tree.memory_info().rss + sum(c.memory_info().rss for c in tree.children(recursive=True))
+                peak = max(peak, rss)
+            except psutil.Error:
+                pass
+            time.sleep(SAMPLE_INTERVAL)
+        elapsed = time.perf_counter() - t0
+        if proc.returncode != 0:
+            log.seek(0)
+            raise RuntimeError(f"{' '.join(cmd)} failed:\n{log.read()[-2000:]}")
+    return elapsed, peak / 1024 / 1024
+
+
+def count_rows():
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM raw_measurements;")
+    rows = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return rows
+
+
+def reset_schema():
+    subprocess.run([sys.executable, "create_table.py", "--reset"], check=True, stdout=subprocess.DEVNULL)
+
+
+def run(modes, sensors_csv, measurements_csv):
+    csv_mb = os.path.getsize(measurements_csv) / 1024 / 1024
+    load = [sys.executable, "manage_data.py", "--sensors-csv", sensors_csv, "--measurements-csv", measurements_csv]
+    report = {}
+
+    def record(name, seconds, peak_mb, rows):
+        report[name] = {
+            "seconds": round(seconds, 2),
+            "rows": rows,
+            "rows_per_s": round(rows / seconds),
+            "csv_mb_per_s": round(csv_mb / seconds, 1),
+            "peak_rss_mb": round(peak_mb, 1),
+        }
+        print(f"{name:18s} {seconds:8.1f} s  {rows / seconds:12,.0f} rows/s  peak {peak_mb:8.1f} MB")
+
+    for mode in modes:
+        reset_schema()
+        seconds, peak_mb = run_tracked(load + MODES[mode])
+        rows = count_rows()
+        record(mode, seconds, peak_mb, rows)
+        if mode == "incremental":
+            # Same input again: everything is below the watermarks
+            seconds, peak_mb = run_tracked(load + MODES[mode])
+            record("incremental_rerun", seconds, peak_mb, rows)
+    return report
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'mode':18s} {'rows/s before':>14s} {'rows/s after':>13s} {'peak MB before':>15s} {'peak MB after':>14s}")
+    for mode, b in before.items():
+        a = after.get(mode)
+        if a is None:
+            continue
+        print(f"{mode:18s} {b['rows_per_s']:14,} {a['rows_per_s']:13,} "
+              f"{b['peak_rss_mb']:15.1f} {a['peak_rss_mb']:14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure manage_data.py throughput and peak memory per mode.")
+    parser.add_argument("--sensors-csv", default=os.path.join(DATA_DIR, "stations.csv"))
+    parser.add_argument("--measurements-csv", default=os.path.join(DATA_DIR, "measurements.csv"))
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help=f"comma-separated subset of {', '.join(MODES)}")
+    parser.add_argument("--allow-reset", action="store_true",
+                        help="confirm that every table in DB_NAME may be dropped")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="print a comparison of two saved reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.allow_reset:
+        parser.error(f"this drops every table in database {DB_CONFIG['database']!r}; "
+                     "point DB_NAME at a scratch database and pass --allow-reset")
+
+    modes = args.modes.split(",")
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    report = run(modes, args.sensors_csv, args.measurements_csv)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# benchmarks/parse_memory.py
+#
+# Peak RSS of parsing and cleaning the measurements CSV, comparing the
+# original untyped read (all columns, object strings, merge for pollutants)
+# with manage_data.load_measurements(). With --load it also reports the peak
+# RSS of a complete manage_data.py run (parsing, COPY, aggregation, derived
+# tables), which needs the database configured as for the loader. Each
+# variant runs in a fresh interpreter so none inherits another's heap.
+#
+#   python -m benchmarks.parse_memory
+#   python -m benchmarks.parse_memory --measurements path/to/Dati_sensori.csv --out memory.json
+#   python -m benchmarks.parse_memory --load               # default full load
+#   python -m benchmarks.parse_memory --load "--stream"    # any manage_data.py mode
+
+import argparse
+import json
+import shlex
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+import manage_data
+from manage_data import MEASUREMENTS_CSV, SENSORS_CSV, load_measurements, load_sensors
+
+VARIANTS = ("untyped", "typed")
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def load_untyped(path, sensor_pollutants):
+    """The loader's original parsing path, kept here as the baseline."""
+    measurements_df = pd.read_csv(path, sep=",")
+
+    measurements_df.columns = measurements_df.columns.str.strip()
+    measurements_df['timestamp'] = pd.to_datetime(measurements_df['Data'], format='%d/%m/%Y %H:%M:%S')
+    measurements_df.dropna(subset=['idSensore', 'Valore'], inplace=True)
+    measurements_df = measurements_df[measurements_df['timestamp'].dt.year < 2024]
+    measurements_df.rename(columns={'idSensore': 'sensor_id', 'Valore': 'value'}, inplace=True)
+
+    sensor_pollutants = sensor_pollutants.astype({'pollutant': 'object'})
+    measurements_merged = measurements_df.merge(sensor_pollutants, on='sensor_id', how='left')
+    measurements_merged.dropna(subset=['pollutant'], inplace=True)
+    measurements_merged = measurements_merged[
+        (measurements_merged["value"] >= 0) & (measurements_merged["value"] != -9999)
+    ]
+    measurements_merged['date'] = measurements_merged['timestamp'].dt.date
+    return measurements_merged
+
+
+def measure_load(sensors_path, measurements_path, load_args):
+    """Run manage_data.py's main() in this process and return its report."""
+    baseline = peak_rss_mb()
+    sys.argv = ["manage_data.py", "--sensors-csv", sensors_path,
+                "--measurements-csv", measurements_path] + shlex.split(load_args)
+    t0 = time.perf_counter()
+    manage_data.main()
+    return {
+        "variant": "load",
+        "args": load_args,
+        "seconds": round(time.perf_counter() - t0, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "startup_rss_mb": round(baseline, 1),
+    }
+
+
+def measure(variant, sensors_path, measurements_path, load_args=""):
+    """Run one variant in this process and return its report."""
+    if variant == "load":
+        return measure_load(sensors_path, measurements_path, load_args)
+    _, sensor_pollutants = load_sensors(sensors_path)
+    baseline = peak_rss_mb()
+    t0 = time.perf_counter()
+    if variant == "untyped":
+        frame = load_untyped(measurements_path, sensor_pollutants)
+    else:
+        frame = load_measurements(measurements_path, sensor_pollutants)
+    elapsed = time.perf_counter() - t0
+    return {
+        "variant": variant,
+        "rows": len(frame),
+        "seconds": round(elapsed, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "startup_rss_mb": round(baseline, 1),
+        "frame_mb": round(frame.memory_usage(deep=True).sum() / 1024 / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare peak memory of untyped and typed CSV parsing.")
+    parser.add_argument("--sensors", default=SENSORS_CSV)
+    parser.add_argument("--measurements", default=MEASUREMENTS_CSV)
+    parser.add_argument("--variant", choices=VARIANTS + ("load",), help=argparse.SUPPRESS)
+    parser.add_argument("--load", nargs="?", const="", metavar="ARGS",
+                        help="also measure a complete manage_data.py run, with these extra arguments")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.variant:
+        # Child process: measure a single variant and hand the result back
+        print(json.dumps(measure(args.variant, args.sensors, args.measurements, args.load or "")))
+        return
+
+    report = {}
+    variants = VARIANTS + (("load",) if args.load is not None else ())
+    for variant in variants:
+        command = [sys.executable, "-m", "benchmarks.parse_memory", "--variant", variant,
+                   "--sensors", args.sensors, "--measurements", args.measurements]
+        if variant == "load":
+            command.append(f"--load={args.load}")
+        out = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        report[variant] = json.loads(out.strip().splitlines()[-1])
+        r = report[variant]
+        if variant == "load":
+            print(f"{'load':8s} {'manage_data.py ' + r['args']:>17s}  {r['seconds']:8.1f} s  "
+                  f"peak {r['peak_rss_mb']:9.1f} MB")
+        else:
+            print(f"{variant:8s} {r['rows']:>12,} rows  {r['seconds']:8.1f} s  "
+                  f"peak {r['peak_rss_mb']:9.1f} MB  frame {r['frame_mb']:9.1f} MB")
+
+    reduction = report["untyped"]["peak_rss_mb"] / report["typed"]["peak_rss_mb"]
+    print(f"Peak RSS reduced {reduction:.1f}x")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
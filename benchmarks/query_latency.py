@@ -0,0 +1,113 @@
+# benchmarks/query_latency.py
+#
+# Before/after latency report for the app.py endpoints. Requests go through
+# Flask's test client, so the numbers cover the real handlers and their SQL
+# without HTTP overhead.
+#
+#   python -m benchmarks.query_latency --out before.json
+#   python create_table.py
+#   python -m benchmarks.query_latency --out after.json
+#   python -m benchmarks.query_latency --compare before.json after.json
+
+import argparse
+import json
+import statistics
+import time
+from datetime import timedelta
+
+import psycopg2
+
+from db import DB_CONFIG
+
+
+def sample_params():
+    """Pick a real sensor/pollutant and the latest day with data to query against."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT sensor_id, pollutant
+        FROM sensor_pollutants
+        ORDER BY sensor_id
+        LIMIT 1;
+    """)
+    sensor_id, pollutant = cur.fetchone()
+    cur.execute("SELECT MAX(timestamp)::date FROM measurements WHERE sensor_id = %s;", (sensor_id,))
+    last_day = cur.fetchone()[0]
+    cur.close()
+    conn.close()
+    return sensor_id, pollutant, last_day
+
+
+def endpoints(sensor_id, pollutant, last_day):
+    month_ago = last_day - timedelta(days=30)
+    year_ago = last_day - timedelta(days=365)
+    return {
+        "sensors": "/api/sensors",
+        "sensor": f"/api/sensors/{sensor_id}",
+        "date_range": "/api/date_range",
+        "raw_sensor_month": f"/api/raw_measurements?sensor_id={sensor_id}&start={month_ago}&end={last_day}",
+        "raw_pollutant_day": f"/api/raw_measurements?pollutant={pollutant}&start={last_day}&end={last_day}",
+        "daily_pollutant_day": f"/api/measurements?pollutant={pollutant}&start={last_day}&end={last_day}",
+        "sensor_daily_year": f"/api/sensors/{sensor_id}/measurements?start={year_ago}&end={last_day}",
+    }
+
+
+def run(repeat):
+    from app import app
+
+    client = app.test_client()
+    report = {}
+    for name, url in endpoints(*sample_params()).items():
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            resp = client.get(url)
+            resp.get_data()
+            timings.append((time.perf_counter() - t0) * 1000)
+        timings.sort()
+        report[name] = {
+            "url": url,
+            "status": resp.status_code,
+            "min_ms": round(timings[0], 2),
+            "median_ms": round(statistics.median(timings), 2),
+            "p95_ms": round(timings[int(0.95 * (len(timings) - 1))], 2),
+        }
+        print(f"{name:22s} median {report[name]['median_ms']:9.2f} ms   p95 {report[name]['p95_ms']:9.2f} ms")
+    return report
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'endpoint':22s} {'before ms':>11s} {'after ms':>11s} {'speedup':>9s}")
+    for name, b in before.items():
+        a = after.get(name)
+        if a is None:
+            continue
+        speedup = b["median_ms"] / a["median_ms"] if a["median_ms"] else float("inf")
+        print(f"{name:22s} {b['median_ms']:11.2f} {a['median_ms']:11.2f} {speedup:8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app.py endpoint latency.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--out", help="write the report to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="print a comparison of two saved reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.repeat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Report written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# change_feed.py
+#
+# Push notifications of new data. Every load that bumps the dataset version
+# (manage_data.py, ingest_service.py) also sends a NOTIFY on CHANNEL, which
+# PostgreSQL delivers when the load commits:
+#
+#     {"version": 42, "rows": 1830, "pollutants": ["PM10", ...],
+#      "sensors": ["5504", ...], "first": "2025-05-07T13:00:00", "last": "..."}
+#
+# `sensors` is null when the batch touched too many to list; after a full
+# reload everything but `version` is null. app.py LISTENs on the channel and
+# relays each notification to browsers as a server-sent event on /api/events.
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+CHANNEL = "dataset_changed"
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD_BYTES = 7900
+# Seconds between keep-alive comments on an idle event stream, which is also
+# how soon a stream notices its client has gone
+HEARTBEAT_SECONDS = 15
+# Milliseconds a browser waits before reconnecting a dropped stream
+RETRY_MS = 5000
+# Events buffered per stream; a client that falls further behind is cut off
+# and catches up when it reconnects
+SUBSCRIBER_QUEUE = 32
+
+
+def iso(ts):
+    return ts.isoformat() if ts is not None else None
+
+
+def notify_change(cur, version, rows=None, pollutants=None, sensors=None, first=None, last=None):
+    """Announce `version` on CHANNEL; it is sent when the current transaction commits."""
+    event = {"version": version, "rows": rows, "pollutants": pollutants, "sensors": sensors,
+             "first": iso(first), "last": iso(last)}
+    payload = json.dumps(event)
+    if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+        event["sensors"] = None
+        payload = json.dumps(event)
+    cur.execute("SELECT pg_notify(%s, %s);", (CHANNEL, payload))
+
+
+def format_event(event):
+    """One server-sent event; its id is the dataset version, so a reconnecting browser says what it has."""
+    return f"id: {event['version']}\nevent: dataset\ndata: {json.dumps(event)}\n\n"
+
+
+class ChangeFeed:
+    """
+    LISTENs on CHANNEL from a background thread, on a connection of its own,
+    and fans every notification out to the subscribed event streams.
+    `on_change(version)` runs first, so e.g. the response cache switches to
+    the new version at once instead of after its TTL.
+    """
+
+    def __init__(self, connect_kwargs, on_change=None):
+        self._connect_kwargs = connect_kwargs
+        self._on_change = on_change
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.latest = None
+        self._connected = False
+        self._counters = {"events": 0, "dropped_streams": 0, "reconnects": 0}
+        threading.Thread(target=self._listen, name="change-feed", daemon=True).start()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscribed(self, q):
+        with self._lock:
+            return q in self._subscribers
+
+    def stats(self):
+        with self._lock:
+            return {"connected": int(self._connected), "streams": len(self._subscribers), **self._counters}
+
+    def _publish(self, event):
+        if self._on_change is not None:
+            self._on_change(event["version"])
+        with self._lock:
+            if self.latest is not None and event["version"] <= self.latest["version"]:
+                return
+            self.latest = event
+            self._counters["events"] += 1
+            for q in list(self._subscribers):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    self._subscribers.discard(q)
+                    self._counters["dropped_streams"] += 1
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._connect_kwargs)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {CHANNEL};")
+                # Anything committed while we were not listening comes as one catch-up event
+                cur.execute("SELECT version FROM dataset_version;")
+                row = cur.fetchone()
+                if row is not None and self.latest is not None:
+                    self._publish({"version": row[0], "rows": None, "pollutants": None,
+                                   "sensors": None, "first": None, "last": None})
+                with self._lock:
+                    self._connected = True
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], HEARTBEAT_SECONDS) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            logging.warning("Ignoring malformed %s payload: %r", CHANNEL, notify.payload)
+                            continue
+                        self._publish(event)
+            except Exception:
+                logging.exception("Change feed connection lost; reconnecting")
+            finally:
+                with self._lock:
+                    self._connected = False
+                if conn is not None:
+                    conn.close()
+            with self._lock:
+                self._counters["reconnects"] += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+def event_stream(feed, last_event_id=None, current_version=None):
+    """
+    Body of a text/event-stream response. A browser reconnecting with an
+    older Last-Event-ID than `current_version` first gets one event for the
+    newest change, then live ones.
+    """
+    q = feed.subscribe()
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        if last_event_id is not None and current_version is not None and current_version > last_event_id:
+            latest = feed.latest
+            if latest is None or latest["version"] != current_version:
+                latest = {"version": current_version, "rows": None, "pollutants": None,
+                          "sensors": None, "first": None, "last": None}
+            yield format_event(latest)
+        while feed.subscribed(q):
+            try:
+                event = q.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        feed.unsubscribe(q)
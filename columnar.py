@@ -0,0 +1,209 @@
+# columnar.py
+#
+# Columnar response formats for the measurement endpoints. Query results are
+# converted batch by batch (one Arrow record batch per cursor fetch) and
+# written out incrementally, so large ranges never exist as row dicts.
+
+import csv
+import io
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # Arrow and Parquet output are optional
+    pa = pq = None
+
+MIMETYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "csv": "text/csv",
+}
+COLUMNAR_FORMATS = ("arrow", "parquet", "csv")
+
+# Parquet row groups are buffered up to this many rows; tiny groups compress
+# poorly and slow down readers
+PARQUET_ROW_GROUP = 100_000
+
+# Fixed Arrow types for the columns the API returns, so every batch of a
+# response shares one schema even when a batch is all NULLs
+ARROW_TYPES = {
+    "measurement_id": "int64",
+    "sensor_id": "string",
+    "timestamp": "timestamp[us]",
+    "date": "date32",
+    "pollutant": "string",
+    "value": "float64",
+    "daily_avg": "float64",
+    "daily_min": "float64",
+    "daily_max": "float64",
+    "avg": "float64",
+    "min": "float64",
+    "max": "float64",
+    "count": "int64",
+}
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def negotiate_format(req, allowed):
+    """
+    Pick the response format from `?format=` or, failing that, the Accept
+    header. `allowed` lists format names in order of preference.
+    """
+    fmt = req.args.get("format")
+    if not fmt:
+        best = req.accept_mimetypes.best_match([MIMETYPES[f] for f in allowed])
+        fmt = next((f for f in allowed if MIMETYPES[f] == best), allowed[0])
+    if fmt not in allowed:
+        raise UnsupportedFormat(f"unsupported format {fmt}; use one of {', '.join(allowed)}")
+    if fmt in ("arrow", "parquet") and pa is None:
+        raise UnsupportedFormat(f"{fmt} output needs pyarrow installed on the server")
+    return fmt
+
+
+def record_batch(cols, rows, schema=None):
+    """
+    Build one Arrow record batch from row tuples. Columns listed in
+    ARROW_TYPES get their fixed type; others are inferred from the first
+    batch and `schema` keeps later batches consistent with it.
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(cols)
+    arrays = []
+    for i, (col, values) in enumerate(zip(cols, columns)):
+        if schema is not None:
+            typ = schema.field(i).type
+        elif col in ARROW_TYPES:
+            typ = pa.type_for_alias(ARROW_TYPES[col])
+        else:
+            typ = None
+        arrays.append(pa.array(values, type=typ))
+    return pa.RecordBatch.from_arrays(arrays, names=cols)
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only sink that hands back whatever was written since the last
+    drain(). tell() keeps counting absolute bytes, which the Parquet writer
+    relies on for the offsets in its footer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        # Arrow writers close their sink; keep it usable for the final drain()
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class ColumnarEncoder:
+    """
+    Incremental encoder for one columnar response: write() takes a batch of
+    row tuples and returns the bytes ready to send, close() the remainder.
+    """
+
+    def __init__(self, fmt, cols):
+        self.fmt = fmt
+        self.cols = cols
+        if fmt == "csv":
+            self._text = io.StringIO()
+            self._csv = csv.writer(self._text)
+            self._csv.writerow(cols)
+            return
+        self._sink = ChunkSink()
+        self._writer = self._schema = None
+        self._pending, self._pending_rows = [], 0
+
+    def write(self, rows):
+        if self.fmt == "csv":
+            self._csv.writerows(rows)
+            return self._drain_text()
+
+        batch = record_batch(self.cols, rows, self._schema)
+        if self._writer is None:
+            self._schema = batch.schema
+            self._writer = open_writer(self.fmt, self._sink, self._schema)
+        if self.fmt == "arrow":
+            self._writer.write_batch(batch)
+            return self._sink.drain()
+        self._pending.append(batch)
+        self._pending_rows += batch.num_rows
+        if self._pending_rows >= PARQUET_ROW_GROUP:
+            self._writer.write_table(pa.Table.from_batches(self._pending))
+            self._pending, self._pending_rows = [], 0
+        return self._sink.drain()
+
+    def close(self):
+        if self.fmt == "csv":
+            return self._drain_text()
+        if self._writer is None:
+            self._schema = record_batch(self.cols, []).schema
+            self._writer = open_writer(self.fmt, self._sink, self._schema)
+        if self._pending:
+            self._writer.write_table(pa.Table.from_batches(self._pending))
+        self._writer.close()
+        return self._sink.drain()
+
+    def _drain_text(self):
+        data = self._text.getvalue().encode()
+        self._text.seek(0)
+        self._text.truncate()
+        return data
+
+
+def stream_columnar(fmt, cols, batches):
+    """Yield the encoded response body for `batches` (lists of row tuples) in `fmt`."""
+    encoder = ColumnarEncoder(fmt, cols)
+    for rows in batches:
+        data = encoder.write(rows)
+        if data:
+            yield data
+    yield encoder.close()
+
+
+def stream_table(fmt, table, batch_rows=PARQUET_ROW_GROUP):
+    """Yield a pyarrow Table encoded as `fmt`, without going through Python rows for Arrow/Parquet."""
+    if fmt == "csv":
+        batches = (list(zip(*(col.to_pylist() for col in batch.columns)))
+                   for batch in table.to_batches(max_chunksize=batch_rows))
+        yield from stream_columnar(fmt, table.column_names, batches)
+        return
+
+    sink = ChunkSink()
+    writer = open_writer(fmt, sink, table.schema)
+    for batch in table.to_batches(max_chunksize=batch_rows):
+        if fmt == "arrow":
+            writer.write_batch(batch)
+        else:
+            writer.write_table(pa.Table.from_batches([batch]))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def open_writer(fmt, sink, schema):
+    if fmt == "arrow":
+        return pa.ipc.new_stream(sink, schema)
+    return pq.ParquetWriter(sink, schema, compression="zstd")
@@ -1,76 +1,31 @@
+import argparse
+
 import psycopg2
 
+from db import DB_CONFIG
+from migrations import MIGRATIONS, migrate, reset
+
+parser = argparse.ArgumentParser(description="Create or upgrade the air quality database schema.")
+parser.add_argument("--reset", action="store_true",
+                    help="drop every table first and rebuild the schema from scratch")
+parser.add_argument("--target", type=int, default=None,
+                    help="stop after this migration version (default: latest)")
+args = parser.parse_args()
+
 try:
-    mydb = psycopg2.connect(
-        host='localhost',
-        database='SE',
-        user='SE',
-        password='191919'
-    )
+    mydb = psycopg2.connect(**DB_CONFIG)
     print("📡 Connected to database.")
 except Exception as e:
     print("❌ Connection failed:", e)
     exit()
 
-cur = mydb.cursor()
-
-# Enable PostGIS extension
-cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
-
-# Drop existing tables
-cur.execute("DROP TABLE IF EXISTS measurements;")
-cur.execute("DROP TABLE IF EXISTS sensors;")
-
-# Create sensors table
-cur.execute('''
-    CREATE TABLE sensors (
-        sensor_id VARCHAR(50) PRIMARY KEY,
-        station_name VARCHAR(100) NOT NULL,
-        province VARCHAR(50),
-        latitude DOUBLE PRECISION NOT NULL,
-        longitude DOUBLE PRECISION NOT NULL,
-        geom GEOMETRY(Point, 4326)
-    );
-''')
-
-# Drop raw_measurements table if it exists
-cur.execute("DROP TABLE IF EXISTS raw_measurements;")
-
-# Create raw measurements table (hourly or raw records)
-cur.execute('''
-    CREATE TABLE raw_measurements (
-        measurement_id SERIAL PRIMARY KEY,
-        sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
-        timestamp TIMESTAMP NOT NULL,
-        pollutant VARCHAR(50) NOT NULL,
-        value DOUBLE PRECISION
-    );
-''')
-
-# Create updated measurements table
-cur.execute('''
-    CREATE TABLE measurements (
-        measurement_id SERIAL PRIMARY KEY,
-        sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
-        timestamp DATE NOT NULL,
-        pollutant VARCHAR(50) NOT NULL,
-        daily_avg DOUBLE PRECISION,
-        daily_min DOUBLE PRECISION,
-        daily_max DOUBLE PRECISION
-    );
-''')
+if args.reset:
+    # Drop existing tables
+    reset(mydb)
+    print("🗑️ Existing tables dropped.")
 
-# Drop and create sensor-pollutant map table
-cur.execute("DROP TABLE IF EXISTS sensor_pollutants;")
-cur.execute('''
-    CREATE TABLE sensor_pollutants (
-        sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
-        pollutant VARCHAR(50),
-        PRIMARY KEY (sensor_id, pollutant)
-    );
-''')
+# Upgrade in place; already-applied migrations are skipped
+version = migrate(mydb, args.target)
 
-mydb.commit()
-cur.close()
 mydb.close()
-print("✅ Tables created successfully.")
+print(f"✅ Schema is at version {version} (latest {MIGRATIONS[-1][0]}).")
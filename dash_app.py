@@ -1,44 +1,45 @@
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import callback_context, dcc, html
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import pandas as pd
 import requests
 import plotly.express as px
-import psycopg2
-
-# Database connection to get date range from raw measurements (hourly data)
-conn = psycopg2.connect(
-    host="localhost",
-    database="SE",
-    user="SE",
-    password="191919"
-)
-cur = conn.cursor()
-# Use the raw_measurements table for date bounds
-cur.execute("SELECT MIN(timestamp)::date, MAX(timestamp)::date FROM raw_measurements;")
-MIN_DATE, MAX_DATE = cur.fetchone()
-cur.close()
-conn.close()
+import time
+
+import metrics
+from api_client import fetch_frame
 
 # API base URL
 API_BASE = "http://localhost:5000/api"
 
-# Initial load for pollutants and sensors
-def fetch_initial_data():
-    # Get list of pollutants from the aggregated endpoint
-    resp_meas = requests.get(f"{API_BASE}/measurements")
-    resp_meas.raise_for_status()
-    meas_df = pd.DataFrame(resp_meas.json())
-    pollutants = sorted(meas_df['pollutant'].unique())
+# Share of the window the time-series graph occupies; used to size requests
+TS_GRAPH_WIDTH_SHARE = 0.7
+
+# Resolutions offered by the comparison panel
+CMP_RESOLUTIONS = {'day': 'Daily', 'week': 'Weekly', 'month': 'Monthly'}
+
+# Seconds before the metadata below is fetched again
+METADATA_TTL = 300
+_metadata = {'data': None, 'fetched': 0.0}
 
-    # Get sensor metadata
-    resp_sensors = requests.get(f"{API_BASE}/sensors")
-    resp_sensors.raise_for_status()
-    sensors_df = pd.DataFrame(resp_sensors.json())
-    sensors = sensors_df.to_dict('records')
-    return pollutants, sensors
+# Pollutants, sensors and date bounds come from /api/metadata, fetched on
+# first use rather than at import, so startup does not touch the API or the DB
+def get_metadata():
+    if _metadata['data'] is None or time.monotonic() - _metadata['fetched'] > METADATA_TTL:
+        resp = requests.get(f"{API_BASE}/metadata")
+        resp.raise_for_status()
+        _metadata['data'] = resp.json()
+        _metadata['fetched'] = time.monotonic()
+    return _metadata['data']
 
-POLLUTANTS, SENSORS = fetch_initial_data()
+# New loads are pushed by the API (/api/events) into the 'live-event' store by
+# assets/live_updates.js; callbacks it triggers redraw only what it touched
+def live_update():
+    return 'live-event.data' in [t['prop_id'] for t in callback_context.triggered]
+
+def affected(event, key, value):
+    """Whether a pushed change may concern `value`; a missing list means anything may have changed."""
+    return not event or event.get(key) is None or str(value) in event[key]
 
 # Create Dash app with a simple stylesheet for spacing
 external_stylesheets = [{
@@ -47,104 +48,253 @@ external_stylesheets = [{
 }]
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
+# Callback timings and request latency on http://localhost:8050/metrics
+metrics.instrument_flask(server)
 
-app.layout = html.Div([
-    html.Header(html.H1("Air Quality Dashboard"), style={
-        'textAlign': 'center', 'padding': '20px 0', 'backgroundColor': '#f8f9fa'
-    }),
+# The layout is built per page load, from the (cached) metadata
+def serve_layout():
+    meta = get_metadata()
+    pollutants, sensors = meta['pollutants'], meta['sensors']
+    min_date, max_date = meta['date_range']['first_date'], meta['date_range']['last_date']
+    provinces = sorted({s['province'] for s in sensors if s['province']})
+    return html.Div([
+        html.Header(html.H1("Air Quality Dashboard"), style={
+            'textAlign': 'center', 'padding': '20px 0', 'backgroundColor': '#f8f9fa'
+        }),
+        # Server-sent event stream of new loads, and the last change it announced
+        dcc.Store(id='live-config', data={'url': f"{API_BASE}/events"}),
+        dcc.Store(id='live-status'),
+        dcc.Store(id='live-event'),
 
-    # Map panel
-    html.Div([
+        # Map panel
         html.Div([
-            html.Label("Select Pollutant"),
-            dcc.Dropdown(
-                id='map-pollutant',
-                options=[{'label': p, 'value': p} for p in POLLUTANTS],
-                value=POLLUTANTS[0],
-                clearable=False
-            ),
-            html.Br(),
-            html.Label("Select Date"),
-            dcc.DatePickerSingle(
-                id='map-date',
-                date=MAX_DATE
-            ),
-        ], style={'width': '30%', 'padding': '10px'}),
+            html.Div([
+                html.Label("Select Pollutant"),
+                dcc.Dropdown(
+                    id='map-pollutant',
+                    options=[{'label': p, 'value': p} for p in pollutants],
+                    value=pollutants[0],
+                    clearable=False
+                ),
+                html.Br(),
+                html.Label("Select Date"),
+                dcc.DatePickerSingle(
+                    id='map-date',
+                    date=max_date
+                ),
+                html.Br(),
+                dcc.Checklist(
+                    id='map-surface-toggle',
+                    options=[{'label': ' Show interpolated surface', 'value': 'surface'}],
+                    value=[]
+                ),
+            ], style={'width': '30%', 'padding': '10px'}),
 
-        html.Div(
-            dcc.Graph(id='map-graph', config={'displayModeBar': False}),
-            style={'width': '70%', 'padding': '10px'}
-        ),
-    ], style={'display': 'flex', 'backgroundColor': '#ffffff', 'padding': '10px'}),
+            html.Div(
+                dcc.Graph(id='map-graph', config={'displayModeBar': False}),
+                style={'width': '70%', 'padding': '10px'}
+            ),
+            # Daily snapshot of the selected pollutant, kept in the browser
+            dcc.Store(id='map-snapshot'),
+            # Grid and scale of the pollutant's interpolated surfaces; the
+            # daily images are loaded by the map itself
+            dcc.Store(id='map-surface'),
+        ], style={'display': 'flex', 'backgroundColor': '#ffffff', 'padding': '10px'}),
 
-    # Time-series panel
-    html.Div([
+        # Time-series panel
         html.Div([
-            html.Label("Select Sensor"),
-            dcc.Dropdown(
-                id='ts-sensor',
-                options=[{'label': s['station_name'], 'value': s['sensor_id']} for s in SENSORS],
-                value=SENSORS[0]['sensor_id'],
-                clearable=False
+            html.Div([
+                html.Label("Select Sensor"),
+                dcc.Dropdown(
+                    id='ts-sensor',
+                    options=[{'label': s['station_name'], 'value': s['sensor_id']} for s in sensors],
+                    value=sensors[0]['sensor_id'],
+                    clearable=False
+                ),
+                html.Br(),
+                html.Label("Select Date Range"),
+                dcc.DatePickerRange(
+                    id='ts-range',
+                    min_date_allowed=min_date,
+                    max_date_allowed=max_date,
+                    start_date=min_date,
+                    end_date=max_date
+                ),
+            ], style={'width': '30%', 'padding': '10px'}),
+
+            html.Div(
+                dcc.Graph(id='ts-graph', config={'displayModeBar': False}),
+                style={'width': '70%', 'padding': '10px'}
             ),
-            html.Br(),
-            html.Label("Select Date Range"),
-            dcc.DatePickerRange(
-                id='ts-range',
-                min_date_allowed=MIN_DATE,
-                max_date_allowed=MAX_DATE,
-                start_date=MIN_DATE,
-                end_date=MAX_DATE
+            # Graph width in pixels, measured in the browser
+            dcc.Store(id='ts-width'),
+        ], style={'display': 'flex', 'backgroundColor': '#ffffff', 'padding': '10px'}),
+
+        # Comparison panel: many sensors from one batch request
+        html.Div([
+            html.Div([
+                html.Label("Select Pollutant"),
+                dcc.Dropdown(
+                    id='cmp-pollutant',
+                    options=[{'label': p, 'value': p} for p in pollutants],
+                    value=pollutants[0],
+                    clearable=False
+                ),
+                html.Br(),
+                html.Label("Select Province"),
+                dcc.Dropdown(
+                    id='cmp-province',
+                    options=[{'label': p, 'value': p} for p in provinces],
+                    placeholder="Any province"
+                ),
+                html.Br(),
+                html.Label("Select Sensors"),
+                dcc.Dropdown(
+                    id='cmp-sensors',
+                    options=[{'label': s['station_name'], 'value': s['sensor_id']} for s in sensors],
+                    multi=True,
+                    placeholder="Every sensor of the province"
+                ),
+                html.Br(),
+                html.Label("Resolution"),
+                dcc.RadioItems(
+                    id='cmp-resolution',
+                    options=[{'label': label, 'value': r} for r, label in CMP_RESOLUTIONS.items()],
+                    value='week',
+                    inline=True
+                ),
+                html.Br(),
+                html.Label("Select Date Range"),
+                dcc.DatePickerRange(
+                    id='cmp-range',
+                    min_date_allowed=min_date,
+                    max_date_allowed=max_date,
+                    start_date=min_date,
+                    end_date=max_date
+                ),
+            ], style={'width': '30%', 'padding': '10px'}),
+
+            html.Div(
+                dcc.Graph(id='cmp-graph', config={'displayModeBar': False}),
+                style={'width': '70%', 'padding': '10px'}
             ),
-        ], style={'width': '30%', 'padding': '10px'}),
+        ], style={'display': 'flex', 'backgroundColor': '#ffffff', 'padding': '10px'})
+    ])
 
-        html.Div(
-            dcc.Graph(id='ts-graph', config={'displayModeBar': False}),
-            style={'width': '70%', 'padding': '10px'}
-        ),
-    ], style={'display': 'flex', 'backgroundColor': '#ffffff', 'padding': '10px'})
-])
+app.layout = serve_layout
 
-# Callback for updating the map
+app.clientside_callback(
+    ClientsideFunction(namespace='live', function_name='connect'),
+    Output('live-status', 'data'),
+    Input('live-config', 'data')
+)
+
+app.clientside_callback(
+    f"function(_) {{ return Math.round(window.innerWidth * {TS_GRAPH_WIDTH_SHARE}); }}",
+    Output('ts-width', 'data'),
+    Input('ts-graph', 'id')
+)
+
+# The snapshot is fetched once per pollutant; dates are switched in the
+# browser by assets/map_snapshot.js without calling back to the server
 @app.callback(
-    Output('map-graph', 'figure'),
+    Output('map-snapshot', 'data'),
     Input('map-pollutant', 'value'),
-    Input('map-date', 'date')
+    Input('live-event', 'data')
+)
+@metrics.timed_callback
+def load_map_snapshot(pollutant, event):
+    if live_update() and not affected(event, 'pollutants', pollutant):
+        return dash.no_update
+    resp = requests.get(f"{API_BASE}/map_snapshots/{pollutant}")
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+@app.callback(
+    Output('map-surface', 'data'),
+    Input('map-pollutant', 'value'),
+    Input('live-event', 'data')
+)
+@metrics.timed_callback
+def load_map_surface(pollutant, event):
+    if live_update() and not affected(event, 'pollutants', pollutant):
+        return dash.no_update
+    resp = requests.get(f"{API_BASE}/surfaces/{pollutant}")
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return {**resp.json(), 'url': f"{API_BASE}/surfaces/{pollutant}"}
+
+app.clientside_callback(
+    ClientsideFunction(namespace='map', function_name='showDay'),
+    Output('map-graph', 'figure'),
+    Input('map-snapshot', 'data'),
+    Input('map-date', 'date'),
+    Input('map-surface', 'data'),
+    Input('map-surface-toggle', 'value')
 )
-def update_map(pollutant, map_date):
-    params = {'pollutant': pollutant, 'start': map_date, 'end': map_date}
-    df = pd.DataFrame(requests.get(f"{API_BASE}/measurements", params=params).json())
-    if df.empty:
-        return px.scatter_mapbox(
-            pd.DataFrame(columns=['latitude', 'longitude', 'daily_avg']),
-            lat='latitude', lon='longitude', zoom=6,
-            mapbox_style='open-street-map',
-            title=f'No data for {pollutant} on {map_date}'
-        )
-    df = df.merge(pd.DataFrame(SENSORS), on='sensor_id', how='left')
-    fig = px.scatter_mapbox(
-        df, lat='latitude', lon='longitude',
-        color='daily_avg', size='daily_avg',
-        hover_name='station_name', hover_data={'daily_avg':':.2f'},
-        zoom=6, height=500,
-        mapbox_style='open-street-map',
-        title=f'{pollutant} on {map_date}'
-    )
-    return fig
+
+# Default the date pickers to the selected sensor's real coverage
+@app.callback(
+    Output('ts-range', 'min_date_allowed'),
+    Output('ts-range', 'max_date_allowed'),
+    Output('ts-range', 'start_date'),
+    Output('ts-range', 'end_date'),
+    Input('ts-sensor', 'value'),
+    Input('live-event', 'data'),
+    State('ts-range', 'end_date'),
+    State('ts-range', 'max_date_allowed')
+)
+@metrics.timed_callback
+def update_ts_range(sensor_id, event, end, max_allowed):
+    live = live_update()
+    if live and not affected(event, 'sensors', sensor_id):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    resp = requests.get(f"{API_BASE}/sensors/{sensor_id}/coverage")
+    if resp.status_code == 404:
+        bounds = get_metadata()['date_range']
+        first, last = bounds['first_date'], bounds['last_date']
+    else:
+        resp.raise_for_status()
+        coverage = resp.json()
+        first = min(c['first_date'] for c in coverage)
+        last = max(c['last_date'] for c in coverage)
+    if live:
+        # Keep the picked range, but follow new data if it ended at the latest day
+        return first, last, dash.no_update, last if end == max_allowed else dash.no_update
+    return first, last, first, last
 
 # Callback for updating the time series using hourly data
 @app.callback(
     Output('ts-graph', 'figure'),
     Input('ts-sensor', 'value'),
     Input('ts-range', 'start_date'),
-    Input('ts-range', 'end_date')
+    Input('ts-range', 'end_date'),
+    Input('ts-width', 'data'),
+    Input('ts-graph', 'relayoutData'),
+    Input('live-event', 'data'),
 )
-def update_timeseries(sensor_id, start, end):
-    # Fetch raw hourly measurements instead of daily aggregates
-    params = {'sensor_id': sensor_id, 'start': start, 'end': end}
-    resp = requests.get(f"{API_BASE}/raw_measurements", params=params)
-    resp.raise_for_status()
-    df = pd.DataFrame(resp.json())
+@metrics.timed_callback
+def update_timeseries(sensor_id, start, end, width, relayout, event):
+    if live_update() and not affected(event, 'sensors', sensor_id):
+        return dash.no_update
+
+    # Zoom is kept until the sensor or the picked range changes
+    revision = f"{sensor_id}|{start}|{end}"
+
+    # When the user zooms, re-fetch just the visible window at full resolution
+    triggered = [t['prop_id'] for t in callback_context.triggered]
+    if 'ts-graph.relayoutData' in triggered and relayout:
+        if 'xaxis.range[0]' in relayout:
+            start, end = relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+        elif not relayout.get('xaxis.autorange'):
+            return dash.no_update
+
+    # The API downsamples hourly data to about one point per pixel column
+    params = {'sensor_id': sensor_id, 'start': start, 'end': end, 'points': (width or 1000) * 4}
+    df = fetch_frame(f"{API_BASE}/raw_measurements", params=params)
     if df.empty:
         return px.line(title='No hourly data available for this range')
 
@@ -157,10 +307,62 @@ def update_timeseries(sensor_id, start, end):
         x='timestamp',
         y='value',
         color='pollutant',
-        markers=True,
+        markers=len(df) < 2000,
         title=f"Hourly Measurements for Sensor {sensor_id}"
     )
-    fig.update_layout(xaxis_title='Timestamp', yaxis_title='Value')
+    # Keep the user's zoom while the finer-grained data replaces the trace
+    fig.update_layout(xaxis_title='Timestamp', yaxis_title='Value', uirevision=revision)
+    return fig
+
+# Narrow the sensor list to the chosen province
+@app.callback(
+    Output('cmp-sensors', 'options'),
+    Input('cmp-province', 'value')
+)
+@metrics.timed_callback
+def update_cmp_sensors(province):
+    sensors = get_metadata()['sensors']
+    return [{'label': s['station_name'], 'value': s['sensor_id']}
+            for s in sensors if not province or s['province'] == province]
+
+# One /measurements/batch request draws every compared sensor
+@app.callback(
+    Output('cmp-graph', 'figure'),
+    Input('cmp-pollutant', 'value'),
+    Input('cmp-province', 'value'),
+    Input('cmp-sensors', 'value'),
+    Input('cmp-resolution', 'value'),
+    Input('cmp-range', 'start_date'),
+    Input('cmp-range', 'end_date'),
+)
+@metrics.timed_callback
+def update_comparison(pollutant, province, sensor_ids, resolution, start, end):
+    if not province and not sensor_ids:
+        return px.line(title='Select a province or some sensors to compare')
+
+    params = {'pollutant': pollutant, 'resolution': resolution, 'start': start, 'end': end}
+    if province:
+        params['province'] = province
+    if sensor_ids:
+        params['sensor_ids'] = ",".join(str(s) for s in sensor_ids)
+    resp = requests.get(f"{API_BASE}/measurements/batch", params=params)
+    resp.raise_for_status()
+    series = resp.json()['series']
+    if not series:
+        return px.line(title='No data available for this selection')
+
+    df = pd.concat([
+        pd.DataFrame({'date': pd.to_datetime(s['date']), 'avg': s['avg'], 'station': s['station_name']})
+        for s in series
+    ], ignore_index=True)
+    fig = px.line(
+        df,
+        x='date',
+        y='avg',
+        color='station',
+        title=f"{CMP_RESOLUTIONS[resolution]} {pollutant} averages by station"
+    )
+    fig.update_layout(xaxis_title='Date', yaxis_title='Average')
     return fig
 
 if __name__ == '__main__':
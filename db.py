@@ -0,0 +1,269 @@
+# db.py
+#
+# Thread-safe PostgreSQL connection pool shared by the API handlers, plus
+# per-connection prepared statements for the queries they run.
+
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from metrics import record_fetch, record_sql
+
+DB_CONFIG = {
+    "host": os.environ.get("DB_HOST", "localhost"),
+    "database": os.environ.get("DB_NAME", "SE"),
+    "user": os.environ.get("DB_USER", "SE"),
+    "password": os.environ.get("DB_PASSWORD", "191919"),
+}
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the checkout timeout."""
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that remembers which statements it has already prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """
+    Bounded pool of psycopg2 connections.
+
+    Connections are opened lazily up to `maxconn`; callers block for at most
+    `timeout` seconds waiting for one to be returned. Broken connections, and
+    ones older than `max_lifetime`, are closed and replaced instead of being
+    handed out again; connections idle for longer than `ping_after` seconds
+    are checked with a cheap query first.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=5.0,
+                 max_lifetime=3600.0, ping_after=60.0, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "opened": 0,
+            "recycled": 0,
+        }
+        for _ in range(minconn):
+            self._idle.append(self._open())
+            self._size += 1
+
+    def _open(self):
+        conn = psycopg2.connect(connection_factory=PreparingConnection, **self._connect_kwargs)
+        self._counters["opened"] += 1
+        return conn
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            return False
+        if now - conn.last_used > self.ping_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _reserve(self, deadline):
+        """
+        Take an idle connection, or reserve a slot for a new one (None), and
+        count it as in use; waits until `deadline` when the pool is exhausted.
+        """
+        with self._cond:
+            while True:
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+                if self._size < self.maxconn:
+                    self._size += 1
+                    self._in_use += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"no database connection available within {self.timeout:.1f}s "
+                        f"({self.maxconn} in use)"
+                    )
+                self._counters["waits"] += 1
+                self._cond.wait(remaining)
+
+    def _drop_slot(self, recycled=False):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            if recycled:
+                self._counters["recycled"] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = self._reserve(deadline)
+            if conn is None:
+                # Connect outside the lock, in the slot just reserved
+                try:
+                    conn = self._open()
+                except Exception:
+                    self._drop_slot()
+                    raise
+            # The health check may ping the server, so it also runs outside the
+            # lock; other threads keep checking connections out and in meanwhile
+            elif not self._healthy(conn):
+                self._close(conn)
+                self._drop_slot(recycled=True)
+                continue
+            with self._cond:
+                self._counters["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                # End whatever transaction the handler left open
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._close(conn)
+                self._size -= 1
+                self._counters["recycled"] += 1
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "utilization": round(self._in_use / self.maxconn, 3),
+                **self._counters,
+            }
+
+    def closeall(self):
+        with self._cond:
+            for conn in self._idle:
+                self._close(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Server-side cursor whose fetches are accounted to the current request's SQL time."""
+
+    def fetchmany(self, size=None):
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        record_fetch(time.perf_counter() - t0, len(rows))
+        return rows
+
+
+def prepare(cur, sql):
+    """Name of the prepared statement for `sql`, preparing it on first use per connection."""
+    name = "stmt_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {sql.strip().rstrip(';')}")
+        conn.prepared.add(name)
+    return name
+
+
+def execute_args(name, params):
+    return f"{name} ({', '.join(['%s'] * len(params))})" if params else name
+
+
+def execute_prepared(cur, sql, params=()):
+    """
+    Run `sql` (written with $1, $2, ... placeholders) through a prepared
+    statement, preparing it the first time this connection sees it.
+    """
+    t0 = time.perf_counter()
+    name = prepare(cur, sql)
+    cur.execute(f"EXECUTE {execute_args(name, params)}", params or None)
+    record_sql(sql, params, time.perf_counter() - t0, cur.rowcount)
+
+
+def explain_prepared(cur, sql, params=()):
+    """EXPLAIN ANALYZE output lines of `sql` run with `params`, as the API runs it."""
+    name = prepare(cur, sql)
+    cur.execute(f"EXPLAIN (ANALYZE, BUFFERS) EXECUTE {execute_args(name, params)}", params or None)
+    return [row[0] for row in cur.fetchall()]
+
+
+def open_stream(conn, sql, params=(), itersize=5000):
+    """
+    Execute `sql` on a server-side (named) cursor so rows arrive in batches of
+    `itersize` instead of all at once. Named cursors cannot run prepared
+    statements, so the $n placeholders are rewritten for psycopg2; each one
+    must appear once and in order.
+    """
+    cur = conn.cursor(name=f"stream_{uuid.uuid4().hex[:12]}", cursor_factory=TimedCursor)
+    cur.itersize = itersize
+    t0 = time.perf_counter()
+    cur.execute(re.sub(r"\$\d+", "%s", sql), params)
+    record_sql(sql, params, time.perf_counter() - t0)
+    return cur
+
+
+def create_pool():
+    return ConnectionPool(
+        minconn=int(os.environ.get("DB_POOL_MIN", 1)),
+        maxconn=int(os.environ.get("DB_POOL_MAX", 10)),
+        timeout=float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+        max_lifetime=float(os.environ.get("DB_POOL_MAX_LIFETIME", 3600)),
+        **DB_CONFIG
+    )
@@ -0,0 +1,466 @@
+# export_jobs.py
+#
+# Background bulk exports for extracts too large for a request: a filter set
+# (sensors, pollutants, date range, resolution, format) becomes a job that a
+# bounded worker pool streams month by month into a file under EXPORT_DIR,
+# gzip-compressed CSV or zstd Parquet:
+#
+#     <root>/<job id>.csv.gz | <job id>.parquet    the finished export
+#     <root>/<job id>.json                          its filters and row count
+#     <root>/<job id>.lock                          claim and progress of a job
+#                                                   queued or running
+#
+# The job id is a hash of the filters and the dataset version, so asking for
+# the same extract again returns the existing job or file until the next load.
+# Several server processes may share the directory: the one that creates a
+# job's .lock runs it, and the others report its status from that file.
+# Files past EXPORT_MAX_AGE_HOURS, then the least recently downloaded ones
+# beyond EXPORT_MAX_MB, are deleted after every job; a file being downloaded
+# is kept until its download ends. Every statement of an export is cancelled
+# after EXPORT_STATEMENT_TIMEOUT seconds, which fails the job.
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+
+from columnar import ColumnarEncoder, pa
+from db import DB_CONFIG, open_stream
+from migrations import month_start, next_month
+from rollups import RESOLUTION_TABLES
+
+EXPORT_FORMATS = {
+    "csv": (".csv.gz", "application/gzip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+EXPORT_RESOLUTIONS = ("hour", "day") + tuple(RESOLUTION_TABLES)
+# Rows fetched from the server-side cursor per write
+EXPORT_BATCH_ROWS = 20_000
+CSV_GZIP_LEVEL = 6
+# An unfinished file or claim left alone this long belongs to a dead process
+STALE_PART_SECONDS = 3600
+# Seconds between progress updates of a running job's claim file
+CLAIM_HEARTBEAT = 10
+JOB_ID = re.compile(r"[0-9a-f]{24}")
+
+
+class ExportQueueFull(Exception):
+    """Every export slot is taken; the client should retry later."""
+
+
+def split_list(value):
+    """A JSON list or a comma-separated string, as a sorted list without duplicates."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return sorted({str(v).strip() for v in value if str(v).strip()})
+
+
+def parse_export(body):
+    """Validate a job request (JSON object or query args) into its normalized filters."""
+    try:
+        start = date.fromisoformat(body["start"])
+        end = date.fromisoformat(body["end"])
+    except KeyError:
+        raise ValueError("start and end (YYYY-MM-DD) are required")
+    except (TypeError, ValueError):
+        raise ValueError("start and end must be dates (YYYY-MM-DD)")
+    if end < start:
+        raise ValueError("end must not be before start")
+
+    resolution = body.get("resolution", "hour")
+    if resolution not in EXPORT_RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(EXPORT_RESOLUTIONS)}")
+    fmt = body.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet" and pa is None:
+        raise ValueError("parquet exports need pyarrow installed on the server")
+
+    return {
+        "sensor_ids": split_list(body.get("sensor_ids")),
+        "pollutants": split_list(body.get("pollutants")),
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "resolution": resolution,
+        "format": fmt,
+    }
+
+
+def export_chunks(filters):
+    """
+    (sql, params) per chunk of the export, in output order. Hourly and daily
+    data is read one month at a time, so each statement stays within one
+    partition and the job can report progress; rollups come in one statement.
+    """
+    start = date.fromisoformat(filters["start"])
+    end = date.fromisoformat(filters["end"]) + timedelta(days=1)
+    resolution = filters["resolution"]
+
+    if resolution == "hour":
+        table, time_col = "raw_measurements", "timestamp"
+        select = "sensor_id, pollutant, timestamp, value"
+    elif resolution == "day":
+        table, time_col = "measurements", "timestamp"
+        select = "sensor_id, pollutant, timestamp::date AS date, daily_avg AS avg, daily_min AS min, daily_max AS max"
+    else:
+        table, unit = RESOLUTION_TABLES[resolution]
+        time_col = "bucket"
+        select = ("sensor_id, pollutant, bucket AS date, "
+                  "ROUND((total / NULLIF(n, 0))::numeric, 3)::double precision AS avg, min, max")
+        # Every bucket overlapping the range, as the API's rollup queries select them
+        start = {"week": start - timedelta(days=start.weekday()),
+                 "month": month_start(start),
+                 "year": date(start.year, 1, 1)}[unit]
+
+    def chunk(lower, upper):
+        params = [lower, upper]
+        filters_sql = [f"{time_col} >= $1", f"{time_col} < $2"]
+        if filters["sensor_ids"]:
+            params.append(filters["sensor_ids"])
+            filters_sql.append(f"sensor_id = ANY(${len(params)}::varchar[])")
+        if filters["pollutants"]:
+            params.append(filters["pollutants"])
+            filters_sql.append(f"pollutant = ANY(${len(params)}::varchar[])")
+        sql = f"""
+            SELECT {select}
+            FROM {table}
+            WHERE {" AND ".join(filters_sql)}
+            ORDER BY {time_col}, sensor_id, pollutant;
+        """
+        return sql, params
+
+    if resolution not in ("hour", "day"):
+        return [chunk(start, end)]
+    chunks = []
+    lower = start
+    while lower < end:
+        upper = min(next_month(lower), end)
+        chunks.append(chunk(lower, upper))
+        lower = upper
+    return chunks
+
+
+def iso_time(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds") if ts else None
+
+
+class ExportJob:
+    def __init__(self, job_id, filters, dataset_version, path):
+        self.id = job_id
+        self.filters = filters
+        self.dataset_version = dataset_version
+        self.path = path
+        self.status = "queued"
+        self.progress = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self.heartbeat = 0
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "filters": self.filters,
+            "dataset_version": self.dataset_version,
+            "progress": round(self.progress, 3),
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "error": self.error,
+            "created": iso_time(self.created),
+            "started": iso_time(self.started),
+            "finished": iso_time(self.finished),
+        }
+
+
+class ExportJobs:
+    """
+    Export jobs of one server process, plus what the claim files of other
+    processes sharing `root` say about theirs. At most `workers` exports run
+    at a time, each on a database connection of its own so they never take
+    connections from the API pool; at most `max_queued` may be waiting or
+    running before new submissions are refused. `statement_timeout` (seconds,
+    0 for none) bounds each statement of an export.
+    """
+
+    def __init__(self, root, workers=2, max_queued=16, max_bytes=10 * 1024 ** 3, max_age=72 * 3600,
+                 statement_timeout=600):
+        self.root = root
+        self.max_queued = max_queued
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.statement_timeout = statement_timeout
+        self._jobs = {}
+        # Open downloads per job id; their files are not evicted
+        self._downloads = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+        os.makedirs(root, exist_ok=True)
+        # Leftovers of a process that died mid-export; a running export keeps
+        # writing to its files, so other workers' exports are not touched
+        for name in os.listdir(root):
+            if name.endswith((".part", ".tmp", ".lock")):
+                self._remove_stale(os.path.join(root, name))
+        self.evict()
+
+    def _remove_stale(self, path):
+        """Delete `path` if nothing has written to it for STALE_PART_SECONDS; whether it is gone."""
+        try:
+            if time.time() - os.path.getmtime(path) <= STALE_PART_SECONDS:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _path(self, job_id, fmt):
+        return os.path.join(self.root, job_id + EXPORT_FORMATS[fmt][0])
+
+    def _meta_path(self, job_id):
+        return os.path.join(self.root, job_id + ".json")
+
+    def _claim_path(self, job_id):
+        return os.path.join(self.root, job_id + ".lock")
+
+    def _write_json(self, path, data, exclusive=False):
+        """
+        Write `data` to `path` atomically, so readers never see a partial file.
+        With `exclusive` an existing file is left alone and False is returned.
+        """
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        try:
+            if not exclusive:
+                os.replace(tmp, path)
+                return True
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                return False
+            return True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _claim_data(self, job):
+        return {"filters": job.filters, "dataset_version": job.dataset_version, "status": job.status,
+                "progress": job.progress, "rows": job.rows, "bytes": job.bytes,
+                "created": job.created, "started": job.started, "pid": os.getpid()}
+
+    def _claim(self, job):
+        """Create the job's claim file; False if another process holds a live claim."""
+        path = self._claim_path(job.id)
+        if self._write_json(path, self._claim_data(job), exclusive=True):
+            return True
+        # A claim nobody has updated for a long time was left by a dead process
+        return self._remove_stale(path) and self._write_json(path, self._claim_data(job), exclusive=True)
+
+    def submit(self, filters, dataset_version):
+        """The job for `filters`, and whether it was newly created."""
+        if dataset_version is None:
+            # Without a version a finished file cannot be trusted to be current
+            job_id = uuid.uuid4().hex[:24]
+        else:
+            key = json.dumps({"filters": filters, "version": dataset_version}, sort_keys=True)
+            job_id = hashlib.sha256(key.encode()).hexdigest()[:24]
+
+        with self._lock:
+            job = self._jobs.get(job_id) or self._load(job_id)
+            if job is not None and job.status != "failed":
+                return job, False
+            active = sum(1 for j in self._jobs.values() if j.status in ("queued", "running"))
+            if active >= self.max_queued:
+                raise ExportQueueFull(f"{active} exports are already queued or running; retry later")
+            job = ExportJob(job_id, filters, dataset_version, self._path(job_id, filters["format"]))
+            if not self._claim(job):
+                # Another process claimed the same job since _load() looked
+                other = self._load(job_id)
+                if other is None:
+                    raise ExportQueueFull(f"export {job_id} is being started by another worker; retry later")
+                return other, False
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job)
+        return job, True
+
+    def get(self, job_id):
+        if not JOB_ID.fullmatch(job_id):
+            return None
+        with self._lock:
+            return self._jobs.get(job_id) or self._load(job_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {status: statuses.count(status) for status in ("queued", "running", "done", "failed")}
+
+    def touch(self, job):
+        """Mark a download, so size eviction removes the least recently used files first."""
+        try:
+            os.utime(job.path)
+        except OSError:
+            pass
+
+    def begin_download(self, job):
+        """Keep the job's file until end_download(); call that once the response is closed."""
+        with self._lock:
+            self._downloads[job.id] = self._downloads.get(job.id, 0) + 1
+        self.touch(job)
+
+    def end_download(self, job):
+        with self._lock:
+            left = self._downloads.pop(job.id, 1) - 1
+            if left > 0:
+                self._downloads[job.id] = left
+        # A long transfer counts as used when it ends, not only when it started
+        self.touch(job)
+
+    def _load(self, job_id):
+        """
+        A finished job from its metadata file, e.g. written before a restart or
+        by another process, or else one another process is running, from its claim.
+        """
+        try:
+            with open(self._meta_path(job_id)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return self._load_claim(job_id)
+        job = ExportJob(job_id, meta["filters"], meta["dataset_version"],
+                        self._path(job_id, meta["filters"]["format"]))
+        if not os.path.exists(job.path):
+            return None
+        job.status, job.progress = "done", 1.0
+        job.rows, job.bytes = meta["rows"], os.path.getsize(job.path)
+        job.created, job.started, job.finished = meta["created"], meta["started"], meta["finished"]
+        self._jobs[job_id] = job
+        return job
+
+    def _load_claim(self, job_id):
+        """The state of a job another process has claimed; not kept, as it keeps changing."""
+        try:
+            with open(self._claim_path(job_id)) as f:
+                claim = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = ExportJob(job_id, claim["filters"], claim["dataset_version"],
+                        self._path(job_id, claim["filters"]["format"]))
+        job.status, job.progress = claim["status"], claim["progress"]
+        job.rows, job.bytes = claim["rows"], claim["bytes"]
+        job.created, job.started = claim["created"], claim["started"]
+        return job
+
+    def _heartbeat(self, job, force=False):
+        """Publish the job's progress to other processes; also keeps the claim from going stale."""
+        now = time.time()
+        if force or now - job.heartbeat >= CLAIM_HEARTBEAT:
+            self._write_json(self._claim_path(job.id), self._claim_data(job))
+            job.heartbeat = now
+
+    def _run(self, job):
+        job.status, job.started = "running", time.time()
+        # Unique per run, so no other writer can ever share it
+        part = f"{job.path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.part"
+        conn = None
+        try:
+            self._heartbeat(job, force=True)
+            conn = psycopg2.connect(**DB_CONFIG,
+                                    options=f"-c statement_timeout={int(self.statement_timeout * 1000)}")
+            chunks = export_chunks(job.filters)
+            with open(part, "wb") as raw:
+                out = (gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=CSV_GZIP_LEVEL)
+                       if job.filters["format"] == "csv" else raw)
+                encoder = None
+                for i, (sql, params) in enumerate(chunks):
+                    cur = open_stream(conn, sql, params, itersize=EXPORT_BATCH_ROWS)
+                    while True:
+                        rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+                        if encoder is None:
+                            encoder = ColumnarEncoder(job.filters["format"], [c[0] for c in cur.description])
+                        if not rows:
+                            break
+                        out.write(encoder.write(rows))
+                        job.rows += len(rows)
+                        job.bytes = raw.tell()
+                        self._heartbeat(job)
+                    cur.close()
+                    job.progress = (i + 1) / len(chunks)
+                out.write(encoder.close())
+                if out is not raw:
+                    out.close()
+            conn.rollback()
+            os.replace(part, job.path)
+            job.bytes = os.path.getsize(job.path)
+            job.finished = time.time()
+            self._write_json(self._meta_path(job.id), {
+                "filters": job.filters, "dataset_version": job.dataset_version, "rows": job.rows,
+                "created": job.created, "started": job.started, "finished": job.finished,
+            })
+            job.status = "done"
+            logging.info("Export %s finished: %d rows, %d bytes", job.id, job.rows, job.bytes)
+        except Exception as e:
+            logging.exception(f"Export {job.id} failed")
+            job.status, job.error, job.finished = "failed", str(e), time.time()
+            if os.path.exists(part):
+                os.remove(part)
+        finally:
+            if conn is not None:
+                conn.close()
+            # Other processes now find the metadata file, or nothing for a failed job
+            try:
+                os.remove(self._claim_path(job.id))
+            except FileNotFoundError:
+                pass
+        try:
+            self.evict()
+        except Exception:
+            # Nothing would see the error on the worker thread otherwise
+            logging.exception("Export eviction failed")
+
+    def evict(self):
+        """Delete exports older than max_age, then the least recently used ones beyond max_bytes."""
+        now = time.time()
+        with self._lock:
+            files = []
+            for name in os.listdir(self.root):
+                if name.endswith((".part", ".json", ".lock", ".tmp")):
+                    continue
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process sharing the directory
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name.split(".", 1)[0], path))
+
+            files.sort()
+            total = sum(size for _, size, _, _ in files)
+            for mtime, size, job_id, path in files:
+                if now - mtime <= self.max_age and total <= self.max_bytes:
+                    continue
+                if job_id in self._downloads:
+                    continue
+                for p in (path, self._meta_path(job_id)):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self._jobs.pop(job_id, None)
+                total -= size
+
+            # Failed jobs are kept only to report their error
+            for job_id, job in list(self._jobs.items()):
+                if job.status == "failed" and now - job.finished > self.max_age:
+                    del self._jobs[job_id]
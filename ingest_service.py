@@ -0,0 +1,204 @@
+# ingest_service.py
+#
+# Long-running ingestion: polls a source for new hourly records in the Dati
+# Lombardia feed format (the columns of the measurements CSV) and appends
+# each as a micro-batch with manage_data.incremental_load. That updates the
+# daily aggregates, rollups, analytics, map snapshots and surfaces of the
+# touched groups, bumps the dataset version the API caches are keyed on and
+# notifies app.py, which pushes the change to open dashboards (change_feed.py).
+#
+# Sources:
+#   --watch-dir DIR   CSV files dropped into DIR, oldest first; each is moved to
+#                     DIR/processed or DIR/failed once handled
+#   --url URL         a CSV feed fetched on every poll; "{since}" in the URL is
+#                     replaced with the oldest watermark of the sensors that
+#                     reported within --since-horizon hours of the newest one,
+#                     so a feed that supports it sends only rows some live
+#                     sensor may lack; a decommissioned station does not hold
+#                     it back
+#
+#   python ingest_service.py --watch-dir incoming --interval 60
+#   python ingest_service.py --url "http://localhost:8000/feed.csv?since={since}"
+#
+# Rows already loaded are skipped by the watermarks, so re-reading a feed is
+# harmless. Unlike the batch loader, records from 2024 on are kept.
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+import psycopg2
+
+from db import DB_CONFIG
+from manage_data import (
+    CHUNK_SIZE, SENSORS_CSV, incremental_load, insert_sensors, iter_clean_chunks, load_sensors,
+    pollutant_lookup,
+)
+
+# A dropped file still being written to is left for the next poll
+SETTLE_SECONDS = 5
+FETCH_TIMEOUT = 120
+# Sensors silent for longer than this before the newest reading do not hold
+# back {since}; readings they send later than that are not re-fetched
+SINCE_HORIZON_HOURS = float(os.environ.get("INGEST_SINCE_HORIZON_HOURS", 168))
+
+
+class DirectorySource:
+    def __init__(self, path):
+        self.path = path
+        for sub in ("processed", "failed"):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def pending(self, cur):
+        """CSV files in the drop directory that are complete, oldest first."""
+        now = time.time()
+        files = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.lower().endswith(".csv") and os.path.isfile(path):
+                mtime = os.path.getmtime(path)
+                if now - mtime >= SETTLE_SECONDS:
+                    files.append((mtime, path))
+        return [path for _, path in sorted(files)]
+
+    def done(self, path, ok):
+        target = os.path.join(self.path, "processed" if ok else "failed", os.path.basename(path))
+        os.replace(path, target)
+
+
+class HttpSource:
+    def __init__(self, url, since_horizon=SINCE_HORIZON_HOURS):
+        self.url = url
+        self.since_horizon = since_horizon
+
+    def pending(self, cur):
+        """The feed's current content, downloaded to a temporary file."""
+        url = self.url
+        if "{since}" in url:
+            # The oldest watermark, so a sensor whose readings arrive late is not
+            # skipped; rows other sensors already have are dropped by drop_loaded().
+            # Sensors that stopped reporting long ago are left out of it
+            cur.execute("""
+                SELECT MIN(last_timestamp)
+                FROM ingest_watermarks
+                WHERE last_timestamp >= (SELECT MAX(last_timestamp) FROM ingest_watermarks)
+                                        - %s * INTERVAL '1 hour';
+            """, (self.since_horizon,))
+            since = cur.fetchone()[0]
+            url = url.replace("{since}", urllib.parse.quote(since.isoformat() if since else ""))
+        fd, path = tempfile.mkstemp(prefix="feed-", suffix=".csv")
+        try:
+            with os.fdopen(fd, "wb") as out, urllib.request.urlopen(url, timeout=FETCH_TIMEOUT) as resp:
+                shutil.copyfileobj(resp, out)
+        except OSError:
+            os.remove(path)
+            raise
+        return [path]
+
+    def done(self, path, ok):
+        os.remove(path)
+
+
+class SensorCatalog:
+    """The stations CSV, re-read and upserted whenever the file changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self.pollutant_map = {}
+
+    def refresh(self, mydb):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return
+        sensors_clean, sensor_pollutants = load_sensors(self.path)
+        cur = mydb.cursor()
+        insert_sensors(cur, sensors_clean)
+        mydb.commit()
+        cur.close()
+        self.pollutant_map = pollutant_lookup(sensor_pollutants)
+        self._mtime = mtime
+        print(f"🛰 {len(self.pollutant_map):,} sensors loaded from {self.path}")
+
+
+def poll(mydb, source, sensors, chunksize, store):
+    """Load everything the source has; returns the number of new rows."""
+    sensors.refresh(mydb)
+    cur = mydb.cursor()
+    paths = source.pending(cur)
+    mydb.rollback()
+    cur.close()
+
+    total = 0
+    for path in paths:
+        print(f"📥 {os.path.basename(path)}")
+        try:
+            chunks = iter_clean_chunks(path, sensors.pollutant_map, chunksize, cutoff_year=None)
+            total += incremental_load(mydb, chunks, store)
+        except psycopg2.OperationalError:
+            # The connection is gone; the file is retried after reconnecting
+            raise
+        except Exception as e:
+            mydb.rollback()
+            print(f"❌ {os.path.basename(path)} failed: {e}")
+            source.done(path, False)
+        else:
+            source.done(path, True)
+    return total
+
+
+def run(source, sensors, interval, chunksize, store, once=False):
+    mydb = None
+    backoff = 1
+    while True:
+        try:
+            if mydb is None or mydb.closed:
+                mydb = psycopg2.connect(**DB_CONFIG)
+                print("📡 Connected to database.")
+            poll(mydb, source, sensors, chunksize, store)
+            backoff = 1
+        except psycopg2.OperationalError as e:
+            print(f"❌ Database unavailable ({e}); retrying in {backoff}s")
+            if mydb is not None:
+                mydb.close()
+            mydb = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 300)
+            continue
+        except OSError as e:
+            # An unreachable feed or a missing file; try again on the next poll
+            print(f"❌ Poll failed: {e}")
+        if once:
+            break
+        time.sleep(interval)
+    if mydb is not None:
+        mydb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuously append new air quality records to PostgreSQL.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--watch-dir", metavar="DIR", help="load CSV files dropped into DIR")
+    source.add_argument("--url", help="poll a CSV feed; {since} is replaced with the oldest live sensor watermark")
+    parser.add_argument("--since-horizon", type=float, default=SINCE_HORIZON_HOURS, metavar="HOURS",
+                        help="sensors silent this long before the newest reading do not hold back {since}")
+    parser.add_argument("--interval", type=float, default=float(os.environ.get("INGEST_INTERVAL", 60)),
+                        help="seconds between polls")
+    parser.add_argument("--once", action="store_true", help="poll once and exit")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE, help="rows per chunk of a file")
+    parser.add_argument("--sensors-csv", default=SENSORS_CSV, help="stations CSV (Stazioni qualità dell'aria)")
+    parser.add_argument("--parquet-store", metavar="DIR", default=os.environ.get("PARQUET_STORE_DIR"),
+                        help="also rewrite the touched months of this Parquet store")
+    args = parser.parse_args()
+
+    source = DirectorySource(args.watch_dir) if args.watch_dir else HttpSource(args.url, args.since_horizon)
+    print(f"👀 Polling {args.watch_dir or args.url} every {args.interval:g}s")
+    run(source, SensorCatalog(args.sensors_csv), args.interval, args.chunksize, args.parquet_store, args.once)
+
+
+if __name__ == "__main__":
+    main()
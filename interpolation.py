@@ -0,0 +1,255 @@
+# interpolation.py
+#
+# Interpolated pollution surfaces: for every pollutant and day, an
+# inverse-distance-weighted (IDW) estimate of daily_avg on a regular
+# lon/lat grid over Lombardy, built by the loader from the map snapshots
+# (snapshots.py) and the sensor positions.
+#
+#     surface_grids  one header per pollutant: grid bounds and size, first
+#                    day, and the value that quantization level 254 stands for
+#     surface_days   one uint8 grid per pollutant and day, row-major with the
+#                    northernmost row first; 255 marks cells with no sensor
+#                    within IDW_RADIUS_KM
+#
+# All days of a pollutant are interpolated at once: the cell x sensor weight
+# matrix is computed once and multiplied by the sensor x day value matrix.
+#
+# value_max is set when a pollutant's surfaces are built from scratch (the
+# full load) and kept by incremental batches, which re-interpolate only the
+# days they touched; stored grids therefore never need rescaling. Values of
+# new days above it are clipped until the next full load.
+
+import struct
+import zlib
+from datetime import timedelta
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+# West, south, east, north edges of the grid (degrees) and its cell size
+GRID_BOUNDS = (8.45, 44.65, 11.45, 46.65)
+GRID_STEP = 0.02
+IDW_POWER = 2.0
+# Sensors further away than this do not contribute to a cell
+IDW_RADIUS_KM = 40.0
+# Distances are clamped to this, so a cell on top of a sensor stays finite
+IDW_MIN_DISTANCE_KM = 0.5
+# Days interpolated per matrix product, which bounds memory
+DAY_BLOCK = 366
+
+NODATA = 255
+LEVELS = 254
+# Level 254 stands for this percentile of the pollutant's daily means;
+# higher values are clipped
+SCALE_PERCENTILE = 99.5
+
+# Plotly's Plasma, the colorscale of the map markers
+PLASMA = ["#0d0887", "#46039f", "#7201a8", "#9c179e", "#bd3786",
+          "#d8576b", "#ed7953", "#fb9f3a", "#fdca26", "#f0f921"]
+
+
+def create_surface_tables(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS surface_grids (
+            pollutant VARCHAR(50) PRIMARY KEY,
+            first_date DATE NOT NULL,
+            days INTEGER NOT NULL,
+            west DOUBLE PRECISION NOT NULL,
+            south DOUBLE PRECISION NOT NULL,
+            step DOUBLE PRECISION NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            value_max DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS surface_days (
+            pollutant VARCHAR(50) REFERENCES surface_grids(pollutant) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            grid BYTEA NOT NULL,
+            PRIMARY KEY (pollutant, day)
+        );
+    ''')
+
+
+def grid_shape():
+    west, south, east, north = GRID_BOUNDS
+    return round((east - west) / GRID_STEP), round((north - south) / GRID_STEP)
+
+
+def idw_weights(sensor_lons, sensor_lats):
+    """(cells, sensors) float32 IDW weights, zero beyond IDW_RADIUS_KM."""
+    west, south, east, north = GRID_BOUNDS
+    width, height = grid_shape()
+    lons = west + GRID_STEP * (np.arange(width) + 0.5)
+    lats = north - GRID_STEP * (np.arange(height) + 0.5)
+    cell_lon, cell_lat = (a.ravel() for a in np.meshgrid(lons, lats))
+
+    # Equirectangular distances; the error is negligible at the scale of one region
+    kx = 111.32 * np.cos(np.radians((south + north) / 2))
+    dx = (cell_lon[:, None] - np.asarray(sensor_lons)[None, :]) * kx
+    dy = (cell_lat[:, None] - np.asarray(sensor_lats)[None, :]) * 110.57
+    distance = np.maximum(np.hypot(dx, dy), IDW_MIN_DISTANCE_KM).astype(np.float32)
+    weights = distance ** -IDW_POWER
+    weights[distance > IDW_RADIUS_KM] = 0
+    return weights
+
+
+def interpolate(weights, values):
+    """
+    IDW surfaces for a (sensors, days) matrix with NaN for missing readings:
+    (days, cells) float32, NaN where no sensor with data is in range.
+    """
+    present = np.isfinite(values)
+    filled = np.where(present, values, 0).astype(np.float32)
+    total = weights @ filled
+    weight = weights @ present.astype(np.float32)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        surface = total / weight
+    surface[weight == 0] = np.nan
+    return surface.T
+
+
+def quantize(surface, value_max):
+    levels = np.rint(np.clip(surface / value_max, 0, 1) * LEVELS)
+    return np.where(np.isfinite(surface), levels, NODATA).astype(np.uint8)
+
+
+def surface_scale(values):
+    """value_max for a sensor x day matrix: the SCALE_PERCENTILE of its readings."""
+    finite = values[np.isfinite(values)]
+    value_max = float(np.percentile(finite, SCALE_PERCENTILE)) if finite.size else 1.0
+    return value_max if value_max > 0 else 1.0
+
+
+def build_surfaces(weights, values, value_max):
+    """(column, uint8 grid bytes) per column of a sensor x day matrix with any data in range."""
+    for first in range(0, values.shape[1], DAY_BLOCK):
+        block = quantize(interpolate(weights, values[:, first:first + DAY_BLOCK]), value_max)
+        for offset, grid in enumerate(block):
+            # Days no sensor reported get no surface
+            if (grid != NODATA).any():
+                yield first + offset, grid.tobytes()
+
+
+def snapshot_values(cur, pollutant):
+    """
+    (first_date, days, IDW weights, sensor x day values) of the located sensors
+    in a pollutant's map snapshot, or None without a snapshot or located sensors.
+    """
+    cur.execute("SELECT first_date, days, sensor_ids, grid FROM map_snapshots WHERE pollutant = %s;",
+                (pollutant,))
+    snapshot = cur.fetchone()
+    if snapshot is None:
+        return None
+    first_date, days, sensor_ids, grid = snapshot
+    cur.execute("""
+        SELECT ids.idx - 1, ST_X(s.geom), ST_Y(s.geom)
+        FROM unnest(%s::text[]) WITH ORDINALITY AS ids(sensor_id, idx)
+        JOIN sensors s ON s.sensor_id = ids.sensor_id
+        WHERE s.geom IS NOT NULL
+        ORDER BY ids.idx;
+    """, (sensor_ids,))
+    located = cur.fetchall()
+    if not located:
+        return None
+    # Snapshot rows are in sensor_ids order; keep the rows of sensors with a position
+    matrix = np.frombuffer(bytes(grid), dtype="<f4").reshape(-1, days)
+    weights = idw_weights([row[1] for row in located], [row[2] for row in located])
+    return first_date, days, weights, matrix[[row[0] for row in located]]
+
+
+def insert_surface_days(cur, pollutant, first_date, grids):
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO surface_days (pollutant, day, grid) VALUES %s;",
+        ((pollutant, first_date + timedelta(days=offset), psycopg2.Binary(grid)) for offset, grid in grids),
+        page_size=200
+    )
+
+
+def refresh_surfaces(cur, pollutants=None):
+    """Rebuild the surfaces of `pollutants` (default: all of them) from `map_snapshots`."""
+    if pollutants is None:
+        cur.execute("DELETE FROM surface_grids;")
+        cur.execute("SELECT pollutant FROM map_snapshots;")
+        pollutants = [row[0] for row in cur.fetchall()]
+
+    west, south, _, _ = GRID_BOUNDS
+    width, height = grid_shape()
+    for pollutant in pollutants:
+        cur.execute("DELETE FROM surface_grids WHERE pollutant = %s;", (pollutant,))
+        source = snapshot_values(cur, pollutant)
+        if source is None:
+            continue
+        first_date, days, weights, values = source
+        value_max = surface_scale(values)
+        cur.execute("""
+            INSERT INTO surface_grids (pollutant, first_date, days, west, south, step, width, height, value_max)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+        """, (pollutant, first_date, days, west, south, GRID_STEP, width, height, value_max))
+        insert_surface_days(cur, pollutant, first_date, build_surfaces(weights, values, value_max))
+
+
+def merge_surfaces(cur):
+    """
+    Re-interpolate the days in the `touched_days` temp table (see
+    manage_data.publish_batch) at each pollutant's stored scale; pollutants
+    without surfaces yet are built from scratch. Run after merge_map_snapshots().
+    """
+    cur.execute("SELECT pollutant, array_agg(DISTINCT day) FROM touched_days GROUP BY pollutant;")
+    for pollutant, touched in cur.fetchall():
+        cur.execute("SELECT value_max FROM surface_grids WHERE pollutant = %s FOR UPDATE;", (pollutant,))
+        header = cur.fetchone()
+        if header is None:
+            refresh_surfaces(cur, [pollutant])
+            continue
+        source = snapshot_values(cur, pollutant)
+        if source is None:
+            continue
+        first_date, days, weights, values = source
+        offsets = sorted((day - first_date).days for day in touched)
+
+        cur.execute("DELETE FROM surface_days WHERE pollutant = %s AND day = ANY(%s::date[]);",
+                    (pollutant, touched))
+        grids = build_surfaces(weights, values[:, offsets], header[0])
+        insert_surface_days(cur, pollutant, first_date, ((offsets[i], grid) for i, grid in grids))
+        # The snapshot may have grown by the batch's days
+        cur.execute("""
+            UPDATE surface_grids SET first_date = %s, days = %s, updated_at = now()
+            WHERE pollutant = %s;
+        """, (first_date, days, pollutant))
+
+
+# -----------------------------
+# Rendering (app.py)
+# -----------------------------
+def palette():
+    """PNG PLTE and tRNS chunks: Plasma over levels 0..254, NODATA transparent."""
+    anchors = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in PLASMA], dtype=float)
+    positions = np.linspace(0, LEVELS, len(PLASMA))
+    colors = np.stack([np.interp(np.arange(LEVELS + 1), positions, anchors[:, i]) for i in range(3)], axis=1)
+    rgb = np.vstack([colors, [[0, 0, 0]]]).round().astype(np.uint8)
+    alpha = bytes([255] * (LEVELS + 1) + [0])
+    return rgb.tobytes(), alpha
+
+
+PALETTE, ALPHA = palette()
+
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+
+def surface_png(grid, width, height):
+    """A stored uint8 grid as an indexed-color PNG, north up."""
+    grid = bytes(grid)
+    scanlines = b"".join(b"\x00" + grid[y * width:(y + 1) * width] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+            + png_chunk(b"PLTE", PALETTE)
+            + png_chunk(b"tRNS", ALPHA)
+            + png_chunk(b"IDAT", zlib.compress(scanlines, 9))
+            + png_chunk(b"IEND", b""))
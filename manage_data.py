@@ -1,179 +1,840 @@
 # manage_data.py
 
+import argparse
+import csv
+import io
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
 import pandas as pd
 import psycopg2
 from psycopg2.extras import execute_values
 
+from analytics import merge_analytics, refresh_analytics
+from change_feed import notify_change
+from db import DB_CONFIG
+from interpolation import merge_surfaces, refresh_surfaces
+from migrations import COVERAGE_REFRESH_SQL, ensure_month_partitions
+from rollups import merge_rollups, refresh_rollups
+from parquet_store import export_store
+from snapshots import merge_map_snapshots, refresh_map_snapshots
+
+SENSORS_CSV = r"Database\data\Stazioni_qualit__dell_aria_20250507.csv"
+MEASUREMENTS_CSV = r"Database\data\Dati_sensori_aria_dal_2018_20250507.csv"
+
+# Rows per chunk in --stream mode; peak memory scales with this, not the file
+CHUNK_SIZE = 500_000
+# Bytes of CSV per task in --parallel mode
+RANGE_BYTES = 64 * 1024 * 1024
+
+TIMESTAMP_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+# Batch loads keep rows before this year, as they always have; the ingestion
+# service (ingest_service.py) passes None to keep current records too
+CUTOFF_YEAR = 2024
+
+# Typed read schemas: only these columns are parsed. Timestamps repeat across
+# every sensor, so `Data` is read as a category and each distinct value is
+# parsed once; sensor ids are nullable 32-bit ints until rows are filtered.
+SENSOR_DTYPES = {
+    'IdSensore': 'int64',
+    'NomeTipoSensore': 'category',
+    'NomeStazione': 'object',
+    'Provincia': 'category',
+    'lat': 'float64',
+    'lng': 'float64',
+}
+MEASUREMENT_DTYPES = {
+    'idSensore': 'Int32',
+    'Data': 'category',
+    'Valore': 'float64',
+}
+
+
 # -----------------------------
 # Step 1: Load Sensor Metadata
 # -----------------------------
-sensors_df = pd.read_csv("Database\data\Stazioni_qualit__dell_aria_20250507.csv", sep=",")
+def load_sensors(path):
+    sensors_df = pd.read_csv(path, sep=",", usecols=list(SENSOR_DTYPES), dtype=SENSOR_DTYPES)
+
+    sensors_clean = sensors_df[[
+        'IdSensore', 'NomeStazione', 'Provincia', 'lat', 'lng'
+    ]].copy()
 
-sensors_clean = sensors_df[[
-    'IdSensore', 'NomeStazione', 'Provincia', 'lat', 'lng'
-]].copy()
+    sensors_clean.rename(columns={
+        'IdSensore': 'sensor_id',
+        'NomeStazione': 'station_name',
+        'Provincia': 'province',
+        'lat': 'latitude',
+        'lng': 'longitude'
+    }, inplace=True)
 
-sensors_clean.rename(columns={
-    'IdSensore': 'sensor_id',
-    'NomeStazione': 'station_name',
-    'Provincia': 'province',
-    'lat': 'latitude',
-    'lng': 'longitude'
-}, inplace=True)
+    sensors_clean.dropna(subset=['latitude', 'longitude'], inplace=True)
+
+    sensor_pollutants = sensors_df[['IdSensore', 'NomeTipoSensore']].copy()
+    sensor_pollutants.rename(columns={
+        'IdSensore': 'sensor_id',
+        'NomeTipoSensore': 'pollutant'
+    }, inplace=True)
+
+    return sensors_clean, sensor_pollutants
 
-sensors_clean.dropna(subset=['latitude', 'longitude'], inplace=True)
 
 # -----------------------------
 # Step 2: Connect to Database
 # -----------------------------
-try:
-    mydb = psycopg2.connect(
-        host='localhost',
-        database='SE',
-        user='SE',
-        password='191919'
-    )
-    print("📡 Connected to database.")
-except Exception as e:
-    print("❌ Connection failed:", e)
-    exit()
+def connect():
+    try:
+        # DB_HOST / DB_NAME / DB_USER / DB_PASSWORD, as for the API
+        mydb = psycopg2.connect(**DB_CONFIG)
+        print("📡 Connected to database.")
+    except Exception as e:
+        print("❌ Connection failed:", e)
+        exit()
+    return mydb
 
-cur = mydb.cursor()
 
-# Insert sensor metadata
-for _, row in sensors_clean.iterrows():
-    cur.execute("""
-        INSERT INTO sensors (sensor_id, station_name, province, latitude, longitude, geom)
-        VALUES (%s, %s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
-        ON CONFLICT (sensor_id) DO NOTHING;
-    """, (
-        str(row['sensor_id']),
-        row['station_name'],
-        row['province'],
-        row['latitude'],
-        row['longitude'],
-        row['longitude'],  # X
-        row['latitude']    # Y
-    ))
+def insert_sensors(cur, sensors_clean):
+    for _, row in sensors_clean.iterrows():
+        cur.execute("""
+            INSERT INTO sensors (sensor_id, station_name, province, latitude, longitude, geom)
+            VALUES (%s, %s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+            ON CONFLICT (sensor_id) DO NOTHING;
+        """, (
+            str(row['sensor_id']),
+            row['station_name'],
+            row['province'],
+            row['latitude'],
+            row['longitude'],
+            row['longitude'],  # X
+            row['latitude']    # Y
+        ))
 
-mydb.commit()
 
 # -----------------------------
 # Step 3: Load & Clean Measurements
 # -----------------------------
-measurements_df = pd.read_csv("Database\data\Dati_sensori_aria_dal_2018_20250507.csv", sep=",")
+def read_header(path):
+    with open(path, encoding="utf-8-sig") as f:
+        return f.readline()
+
 
-measurements_df.columns = measurements_df.columns.str.strip()
-measurements_df['timestamp'] = pd.to_datetime(measurements_df['Data'], format='%d/%m/%Y %H:%M:%S')
-measurements_df.dropna(subset=['idSensore', 'Valore'], inplace=True)
+def measurement_read_options(header):
+    """
+    usecols/dtype arguments for pd.read_csv of the measurements CSV, keyed by
+    the header's raw column names (which may carry stray whitespace).
+    """
+    raw = {name.strip(): name for name in next(csv.reader([header.strip()]))}
+    return {
+        'usecols': [raw[name] for name in MEASUREMENT_DTYPES],
+        'dtype': {raw[name]: dtype for name, dtype in MEASUREMENT_DTYPES.items()},
+    }
 
-# Keep only data before 2024
-measurements_df = measurements_df[measurements_df['timestamp'].dt.year < 2024]
 
-measurements_df.rename(columns={
-    'idSensore': 'sensor_id',
-    'Valore': 'value'
-}, inplace=True)
+def load_measurements(path, sensor_pollutants):
+    measurements_df = pd.read_csv(path, sep=",", **measurement_read_options(read_header(path)))
+    return clean_chunk(measurements_df, pollutant_lookup(sensor_pollutants))
 
-sensor_pollutants = sensors_df[['IdSensore', 'NomeTipoSensore']].copy()
-sensor_pollutants.rename(columns={
-    'IdSensore': 'sensor_id',
-    'NomeTipoSensore': 'pollutant'
-}, inplace=True)
 
-measurements_merged = measurements_df.merge(sensor_pollutants, on='sensor_id', how='left')
-measurements_merged.dropna(subset=['pollutant'], inplace=True)
-# Filter out invalid values BEFORE storing in raw_measurements
-measurements_merged = measurements_merged[
-    (measurements_merged["value"] >= 0) & (measurements_merged["value"] != -9999)
-]
+def parse_timestamps(data):
+    """'dd/mm/YYYY HH:MM:SS' -> datetime64, parsing each distinct value only once."""
+    if isinstance(data.dtype, pd.CategoricalDtype):
+        parsed = pd.to_datetime(data.cat.categories, format=TIMESTAMP_FORMAT)
+        codes = data.cat.codes.to_numpy()
+        return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=data.index)
+    return pd.to_datetime(data, format=TIMESTAMP_FORMAT, cache=True)
+
+
+def pollutant_of(sensor_id, pollutant_map):
+    """Categorical pollutant per row of a categorical sensor_id, looked up once per sensor."""
+    per_sensor = pd.Categorical(sensor_id.cat.categories.map(pollutant_map))
+    codes = per_sensor.codes[sensor_id.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, per_sensor.categories), index=sensor_id.index)
+
+
+def clean_chunk(chunk, pollutant_map, cutoff_year=CUTOFF_YEAR):
+    """
+    Clean one frame of the measurements CSV (read with measurement_read_options()).
+    `pollutant_map` maps sensor_id (str) -> pollutant name; rows from
+    `cutoff_year` on are dropped unless it is None.
+    Returns a frame with sensor_id, timestamp, pollutant, value columns;
+    sensor_id and pollutant are categorical.
+    """
+    chunk.columns = chunk.columns.str.strip()
+    # Cheap numeric filters first, so only surviving rows are converted
+    value = chunk['Valore']
+    chunk = chunk[chunk['idSensore'].notna() & (value >= 0) & (value != -9999)]
+
+    sensor_id = chunk['idSensore'].astype('category')
+    sensor_id = sensor_id.cat.rename_categories(sensor_id.cat.categories.astype('int64').astype(str))
+    pollutant = pollutant_of(sensor_id, pollutant_map)
+    timestamp = parse_timestamps(chunk['Data'])
+
+    keep = pollutant.notna()
+    if cutoff_year is not None:
+        keep &= timestamp.dt.year < cutoff_year
+    return pd.DataFrame({
+        'sensor_id': sensor_id[keep],
+        'timestamp': timestamp[keep],
+        'pollutant': pollutant[keep],
+        'value': chunk['Valore'][keep],
+    })
 
 
 # -----------------------------
 # Step 4: Insert Raw Measurements
 # -----------------------------
-print("💾 Inserting raw measurements...")
-cur.execute("DELETE FROM raw_measurements;")
-raw_rows = [
-    (
-        str(row['sensor_id']),
-        row['timestamp'],
-        row['pollutant'],
-        float(row['value'])
+def insert_raw_measurements(cur, measurements_merged):
+    print("💾 Inserting raw measurements...")
+    cur.execute("DELETE FROM raw_measurements;")
+    if not measurements_merged.empty:
+        ensure_month_partitions(
+            cur, measurements_merged['timestamp'].min(), measurements_merged['timestamp'].max()
+        )
+    # COPY slice by slice straight from the typed frame; no per-row Python
+    # objects, and at most one slice of CSV text, exist at any time
+    copy_chunks(cur, "raw_measurements", frame_slices(measurements_merged))
+
+
+def copy_frame(cur, table, frame):
+    """Stream a cleaned frame into `table` with COPY FROM STDIN (CSV)."""
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)",
+        buf
     )
-    for _, row in measurements_merged.iterrows()
-]
 
-execute_values(
-    cur,
+
+def frame_slices(frame, rows=CHUNK_SIZE):
+    """`frame` in consecutive slices of `rows` rows, as views rather than copies."""
+    for start in range(0, len(frame), rows):
+        yield frame.iloc[start:start + rows]
+
+
+def pollutant_lookup(sensor_pollutants):
+    """sensor_id (str) -> pollutant name, as used by clean_chunk()."""
+    return dict(zip(
+        sensor_pollutants['sensor_id'].astype(str),
+        sensor_pollutants['pollutant']
+    ))
+
+
+def iter_clean_chunks(path, pollutant_map, chunksize=CHUNK_SIZE, cutoff_year=CUTOFF_YEAR):
+    reader = pd.read_csv(path, sep=",", chunksize=chunksize, **measurement_read_options(read_header(path)))
+    for chunk in reader:
+        yield clean_chunk(chunk, pollutant_map, cutoff_year)
+
+
+def with_partitions(cur, chunks):
+    """Make sure the monthly partitions for each chunk exist before it is copied."""
+    for cleaned in chunks:
+        if not cleaned.empty:
+            ensure_month_partitions(cur, cleaned['timestamp'].min(), cleaned['timestamp'].max())
+        yield cleaned
+
+
+def copy_chunks(cur, table, chunks):
+    """COPY every frame from `chunks` into `table`, reporting rows/sec per chunk."""
+    total = 0
+    started = t0 = time.perf_counter()
+    for i, cleaned in enumerate(chunks, start=1):
+        copy_frame(cur, table, cleaned)
+        now = time.perf_counter()
+        elapsed, t0 = now - t0, now
+        total += len(cleaned)
+        print(f"   chunk {i}: {len(cleaned):,} rows in {elapsed:.2f}s "
+              f"({len(cleaned) / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    elapsed = time.perf_counter() - started
+    print(f"   {total:,} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)")
+    return total
+
+
+def stream_raw_measurements(cur, path, sensor_pollutants, chunksize=CHUNK_SIZE):
     """
-    INSERT INTO raw_measurements (sensor_id, timestamp, pollutant, value)
-    VALUES %s
-    """,
-    raw_rows,
-    page_size=10000
-)
+    Read the measurements CSV in fixed-size chunks and COPY each cleaned
+    chunk into raw_measurements. Only one chunk is held in memory at a time.
+    """
+    print(f"💾 Streaming raw measurements in chunks of {chunksize:,} rows...")
+    cur.execute("DELETE FROM raw_measurements;")
+    chunks = iter_clean_chunks(path, pollutant_lookup(sensor_pollutants), chunksize)
+    copy_chunks(cur, "raw_measurements", with_partitions(cur, chunks))
+
+
+# -----------------------------
+# Step 4b: Parallel Load (--parallel)
+# -----------------------------
+def byte_ranges(path, range_bytes=RANGE_BYTES):
+    """
+    Split the CSV into (start, end) byte ranges that begin and end on line
+    boundaries, after the header line. Assumes no quoted field spans lines,
+    which holds for the Dati Lombardia export.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        start = f.tell()
+        ranges = []
+        while start < size:
+            f.seek(min(start + range_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+# Per-process state set up once by the pool initializer
+_worker = {}
+
+
+def init_worker(path, header, pollutant_map):
+    _worker.update(path=path, header=header, pollutant_map=pollutant_map)
+
+
+def partial_daily(cleaned):
+    """Per (sensor, pollutant, day) count/sum/min/max, which merge exactly across chunks."""
+    day = cleaned['timestamp'].dt.normalize().rename('day')
+    return cleaned.groupby([cleaned['sensor_id'], cleaned['pollutant'], day], observed=True)['value'].agg(
+        n='count', total='sum', min='min', max='max'
+    ).reset_index()
+
+
+def parse_range(bounds):
+    """Worker: parse and clean one byte range, returning COPY-ready CSV and partial aggregates."""
+    start, end = bounds
+    with open(_worker["path"], "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    header = _worker["header"]
+    chunk = pd.read_csv(io.BytesIO(header + data), sep=",",
+                        **measurement_read_options(header.decode("utf-8-sig")))
+    cleaned = clean_chunk(chunk, _worker["pollutant_map"])
+
+    buf = io.StringIO()
+    cleaned.to_csv(buf, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+    return {
+        "csv": buf.getvalue(),
+        "rows": len(cleaned),
+        "first": cleaned['timestamp'].min() if len(cleaned) else None,
+        "last": cleaned['timestamp'].max() if len(cleaned) else None,
+        "daily": partial_daily(cleaned),
+    }
+
+
+def merge_daily(partials):
+    """Combine partial aggregates into one frame of the same shape."""
+    return pd.concat(partials, ignore_index=True).groupby(['sensor_id', 'pollutant', 'day'], observed=True).agg(
+        n=('n', 'sum'), total=('total', 'sum'), min=('min', 'min'), max=('max', 'max')
+    ).reset_index()
+
+
+def copy_writer(cur, payloads, errors, abort):
+    """Writer thread: COPY each parsed range into raw_measurements as it arrives."""
+    try:
+        while True:
+            result = payloads.get()
+            if result is None or abort.is_set():
+                return
+            if result["rows"]:
+                ensure_month_partitions(cur, result["first"], result["last"])
+                cur.copy_expert(
+                    "COPY raw_measurements (sensor_id, timestamp, pollutant, value) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    io.StringIO(result["csv"])
+                )
+    except Exception as e:
+        errors.append(e)
+
+
+def hand_off(payloads, item, writer, errors):
+    """Queue `item` for the writer, failing as soon as the writer has failed or exited."""
+    while True:
+        if errors:
+            raise errors[0]
+        if not writer.is_alive():
+            raise RuntimeError("COPY writer exited before the load finished")
+        try:
+            payloads.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def parallel_load(cur, path, sensor_pollutants, workers, range_bytes=RANGE_BYTES):
+    """
+    Parse and clean the measurements CSV in a pool of `workers` processes,
+    one byte range per task. A writer thread COPYs finished ranges into
+    raw_measurements while the workers keep parsing, and the daily
+    aggregates are merged from each range's partial count/sum/min/max.
+    """
+    header, ranges = byte_ranges(path, range_bytes)
+    print(f"💾 Loading raw measurements with {workers} workers ({len(ranges)} ranges)...")
+    cur.execute("DELETE FROM raw_measurements;")
+
+    payloads = queue.Queue(maxsize=workers)
+    errors = []
+    abort = threading.Event()
+    writer = threading.Thread(target=copy_writer, args=(cur, payloads, errors, abort))
+    writer.start()
+
+    partials, total = [], 0
+    started = time.perf_counter()
+    todo = iter(ranges)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(path, header, pollutant_lookup(sensor_pollutants))) as executor:
+            # Keep a bounded number of ranges in flight so memory stays flat
+            pending = {executor.submit(parse_range, bounds) for bounds in itertools.islice(todo, 2 * workers)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        result = future.result()
+                        hand_off(payloads, result, writer, errors)
+                    except BaseException:
+                        # Stop parsing ranges nobody will write
+                        for other in pending:
+                            other.cancel()
+                        raise
+                    partials.append(result.pop("daily"))
+                    if len(partials) > 32:
+                        partials = [merge_daily(partials)]
+                    total += result["rows"]
+                    bounds = next(todo, None)
+                    if bounds is not None:
+                        pending.add(executor.submit(parse_range, bounds))
+    except BaseException:
+        # The writer drops whatever is still queued instead of COPYing it
+        abort.set()
+        raise
+    finally:
+        # Never block on a full queue: the writer may die at any moment
+        while writer.is_alive():
+            try:
+                payloads.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - started
+    print(f"   {total:,} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)")
+
+    print("📆 Merging daily aggregates...")
+    cur.execute("DELETE FROM measurements;")
+    if not partials:
+        cur.execute("DELETE FROM sensor_pollutants;")
+        return
+    daily = merge_daily(partials)
+    copy_frame(cur, "measurements", pd.DataFrame({
+        'sensor_id': daily['sensor_id'],
+        'timestamp': daily['day'].dt.date,
+        'pollutant': daily['pollutant'],
+        'daily_avg': (daily['total'] / daily['n']).round(3),
+        'daily_min': daily['min'].round(3),
+        'daily_max': daily['max'].round(3),
+    }))
+    insert_sensor_pollutants(cur, daily)
+
 
 # -----------------------------
 # Step 5: Aggregate Daily Data
 # -----------------------------
-print("📆 Aggregating daily data...")
-measurements_merged['date'] = measurements_merged['timestamp'].dt.date
-
-daily_stats = measurements_merged.groupby(
-    ['sensor_id', 'pollutant', 'date']
-)['value'].agg(
-    daily_avg='mean',
-    daily_min='min',
-    daily_max='max'
-).reset_index()
-
-daily_stats.rename(columns={'date': 'timestamp'}, inplace=True)
-
-cur.execute("DELETE FROM measurements;")
-daily_rows = [
-    (
-        str(row['sensor_id']),
-        row['timestamp'],
-        row['pollutant'],
-        round(row['daily_avg'], 3),
-        round(row['daily_min'], 3),
-        round(row['daily_max'], 3)
+def insert_daily_stats(cur, measurements_merged):
+    print("📆 Aggregating daily data...")
+    day = measurements_merged['timestamp'].dt.normalize().rename('timestamp')
+
+    daily_stats = measurements_merged.groupby(
+        [measurements_merged['sensor_id'], measurements_merged['pollutant'], day], observed=True
+    )['value'].agg(
+        daily_avg='mean',
+        daily_min='min',
+        daily_max='max'
+    ).reset_index()
+    daily_stats['timestamp'] = daily_stats['timestamp'].dt.date
+    daily_stats[['daily_avg', 'daily_min', 'daily_max']] = (
+        daily_stats[['daily_avg', 'daily_min', 'daily_max']].round(3)
     )
-    for _, row in daily_stats.iterrows()
-]
 
-execute_values(
-    cur,
-    """
-    INSERT INTO measurements (sensor_id, timestamp, pollutant, daily_avg, daily_min, daily_max)
-    VALUES %s
-    """,
-    daily_rows,
-    page_size=10000
-)
+    cur.execute("DELETE FROM measurements;")
+    for part in frame_slices(daily_stats):
+        copy_frame(cur, "measurements", part)
+
+
+def aggregate_daily_in_db(cur):
+    """Rebuild `measurements` from raw_measurements without leaving the database."""
+    print("📆 Aggregating daily data...")
+    cur.execute("DELETE FROM measurements;")
+    cur.execute("""
+        INSERT INTO measurements (sensor_id, timestamp, pollutant, daily_avg, daily_min, daily_max)
+        SELECT sensor_id,
+               timestamp::date,
+               pollutant,
+               ROUND(AVG(value)::numeric, 3),
+               ROUND(MIN(value)::numeric, 3),
+               ROUND(MAX(value)::numeric, 3)
+        FROM raw_measurements
+        GROUP BY sensor_id, pollutant, timestamp::date;
+    """)
+
 
 # -----------------------------
 # Step 6: Fill sensor_pollutants table
 # -----------------------------
-print("🧭 Mapping sensors to pollutants...")
-cur.execute("DELETE FROM sensor_pollutants;")
-sensor_pollutant_pairs = measurements_merged[['sensor_id', 'pollutant']].drop_duplicates()
+def insert_sensor_pollutants(cur, measurements_merged):
+    print("🧭 Mapping sensors to pollutants...")
+    cur.execute("DELETE FROM sensor_pollutants;")
+    sensor_pollutant_pairs = measurements_merged[['sensor_id', 'pollutant']].drop_duplicates()
+
+    execute_values(
+        cur,
+        """
+        INSERT INTO sensor_pollutants (sensor_id, pollutant)
+        VALUES %s
+        ON CONFLICT DO NOTHING;
+        """,
+        list(sensor_pollutant_pairs.itertuples(index=False, name=None))
+    )
+
+
+def map_sensor_pollutants_in_db(cur):
+    print("🧭 Mapping sensors to pollutants...")
+    cur.execute("DELETE FROM sensor_pollutants;")
+    cur.execute("""
+        INSERT INTO sensor_pollutants (sensor_id, pollutant)
+        SELECT DISTINCT sensor_id, pollutant FROM raw_measurements
+        ON CONFLICT DO NOTHING;
+    """)
+
 
-execute_values(
-    cur,
+def refresh_watermarks(cur):
+    """Reset the per-(sensor, pollutant) high-water marks after a full reload."""
+    cur.execute("DELETE FROM ingest_watermarks;")
+    cur.execute("""
+        INSERT INTO ingest_watermarks (sensor_id, pollutant, last_timestamp)
+        SELECT sensor_id, pollutant, MAX(timestamp)
+        FROM raw_measurements
+        GROUP BY sensor_id, pollutant;
+    """)
+
+
+# -----------------------------
+# Step 7: Refresh the coverage catalogs
+# -----------------------------
+def refresh_coverage_catalog(cur):
+    """Rebuild first/last timestamp, row and gap counts per (sensor, pollutant)."""
+    print("🗂️ Refreshing coverage catalog...")
+    cur.execute("DELETE FROM coverage_catalog;")
+    cur.execute(COVERAGE_REFRESH_SQL)
+
+
+def merge_coverage_catalog(cur):
+    """
+    Fold the rows of the current incremental batch into coverage_catalog.
+    New rows always come after the stored last_timestamp, so the gaps they
+    add are the breaks along (previous last reading, new readings...).
     """
-    INSERT INTO sensor_pollutants (sensor_id, pollutant)
-    VALUES %s
-    ON CONFLICT DO NOTHING;
-    """,
-    list(sensor_pollutant_pairs.itertuples(index=False, name=None))
-)
+    cur.execute("""
+        WITH seq AS (
+            SELECT sensor_id, pollutant, timestamp FROM inserted_rows
+            UNION ALL
+            SELECT c.sensor_id, c.pollutant, c.last_timestamp
+            FROM coverage_catalog c
+            WHERE EXISTS (
+                SELECT 1 FROM inserted_rows i
+                WHERE i.sensor_id = c.sensor_id AND i.pollutant = c.pollutant
+            )
+        ),
+        gaps AS (
+            SELECT sensor_id,
+                   pollutant,
+                   COUNT(*) FILTER (
+                       WHERE timestamp - prev > INTERVAL '1 hour'
+                   ) AS gap_count
+            FROM (
+                SELECT sensor_id, pollutant, timestamp,
+                       LAG(timestamp) OVER (
+                           PARTITION BY sensor_id, pollutant ORDER BY timestamp
+                       ) AS prev
+                FROM seq
+            ) ordered
+            GROUP BY sensor_id, pollutant
+        )
+        INSERT INTO coverage_catalog
+            (sensor_id, pollutant, first_timestamp, last_timestamp, row_count, gap_count)
+        SELECT i.sensor_id,
+               i.pollutant,
+               MIN(i.timestamp),
+               MAX(i.timestamp),
+               COUNT(*),
+               MAX(g.gap_count)
+        FROM inserted_rows i
+        JOIN gaps g USING (sensor_id, pollutant)
+        GROUP BY i.sensor_id, i.pollutant
+        ON CONFLICT (sensor_id, pollutant) DO UPDATE
+        SET first_timestamp = LEAST(coverage_catalog.first_timestamp, EXCLUDED.first_timestamp),
+            last_timestamp = GREATEST(coverage_catalog.last_timestamp, EXCLUDED.last_timestamp),
+            row_count = coverage_catalog.row_count + EXCLUDED.row_count,
+            gap_count = coverage_catalog.gap_count + EXCLUDED.gap_count,
+            updated_at = now();
+    """)
+
+
+def refresh_pollutant_catalog(cur):
+    """Roll coverage_catalog up into the per-pollutant catalog behind /api/metadata."""
+    cur.execute("DELETE FROM pollutant_catalog;")
+    cur.execute("""
+        INSERT INTO pollutant_catalog
+            (pollutant, sensor_count, first_timestamp, last_timestamp, row_count)
+        SELECT pollutant,
+               COUNT(*),
+               MIN(first_timestamp),
+               MAX(last_timestamp),
+               SUM(row_count)
+        FROM coverage_catalog
+        GROUP BY pollutant;
+    """)
+
+
+def bump_dataset_version(cur):
+    """Tell the API's response caches that the published data changed; returns the new version."""
+    cur.execute("UPDATE dataset_version SET version = version + 1, updated_at = now() RETURNING version;")
+    return cur.fetchone()[0]
+
 
 # -----------------------------
-# Finalize
+# Incremental ingestion
 # -----------------------------
-mydb.commit()
-cur.close()
-mydb.close()
-print("✅ All data inserted successfully.")
+def load_watermarks(cur):
+    cur.execute("SELECT sensor_id, pollutant, last_timestamp FROM ingest_watermarks;")
+    return {(sensor_id, pollutant): ts for sensor_id, pollutant, ts in cur.fetchall()}
+
+
+def drop_loaded(chunks, watermarks):
+    """Drop rows at or below their (sensor_id, pollutant) high-water mark."""
+    marks = pd.Series(watermarks, dtype='datetime64[ns]')
+    for cleaned in chunks:
+        if not marks.empty:
+            key = pd.MultiIndex.from_arrays([cleaned['sensor_id'], cleaned['pollutant']])
+            mark = pd.Series(marks.reindex(key).to_numpy(), index=cleaned.index)
+            cleaned = cleaned[mark.isna() | (cleaned['timestamp'] > mark)]
+        yield cleaned
+
+
+def publish_batch(cur):
+    """
+    Move staged rows into the live tables. Runs inside the loader's single
+    transaction, so readers see either the previous state or the whole batch.
+    """
+    cur.execute("SELECT MIN(timestamp), MAX(timestamp) FROM staging_raw;")
+    ensure_month_partitions(cur, *cur.fetchone())
+    # Rows that were actually new drive every derived-table update below
+    cur.execute("""
+        CREATE TEMP TABLE inserted_rows (
+            sensor_id VARCHAR(50),
+            timestamp TIMESTAMP,
+            pollutant VARCHAR(50)
+        ) ON COMMIT DROP;
+    """)
+    cur.execute("""
+        WITH ins AS (
+            INSERT INTO raw_measurements (sensor_id, timestamp, pollutant, value)
+            SELECT sensor_id, timestamp, pollutant, value FROM staging_raw
+            ON CONFLICT (sensor_id, pollutant, timestamp) DO NOTHING
+            RETURNING sensor_id, timestamp, pollutant
+        )
+        INSERT INTO inserted_rows SELECT * FROM ins;
+    """)
+    inserted = cur.rowcount
+    cur.execute("ANALYZE inserted_rows;")
+
+    # Only the (sensor, pollutant, day) groups touched by this batch are re-aggregated
+    cur.execute("""
+        CREATE TEMP TABLE touched_days ON COMMIT DROP AS
+        SELECT DISTINCT sensor_id, pollutant, timestamp::date AS day
+        FROM inserted_rows;
+    """)
+    cur.execute("ANALYZE touched_days;")
+    cur.execute("""
+        INSERT INTO measurements (sensor_id, timestamp, pollutant, daily_avg, daily_min, daily_max)
+        SELECT r.sensor_id,
+               t.day,
+               r.pollutant,
+               ROUND(AVG(r.value)::numeric, 3),
+               ROUND(MIN(r.value)::numeric, 3),
+               ROUND(MAX(r.value)::numeric, 3)
+        FROM touched_days t
+        JOIN raw_measurements r
+          ON r.sensor_id = t.sensor_id
+         AND r.pollutant = t.pollutant
+         AND r.timestamp >= t.day
+         AND r.timestamp < t.day + 1
+        GROUP BY r.sensor_id, r.pollutant, t.day
+        ON CONFLICT (sensor_id, pollutant, timestamp) DO UPDATE
+        SET daily_avg = EXCLUDED.daily_avg,
+            daily_min = EXCLUDED.daily_min,
+            daily_max = EXCLUDED.daily_max;
+    """)
+    days = cur.rowcount
+    merge_rollups(cur)
+    merge_analytics(cur)
+    merge_map_snapshots(cur)
+    merge_surfaces(cur)
+
+    cur.execute("""
+        INSERT INTO sensor_pollutants (sensor_id, pollutant)
+        SELECT DISTINCT sensor_id, pollutant FROM inserted_rows
+        ON CONFLICT DO NOTHING;
+    """)
+    merge_coverage_catalog(cur)
+    refresh_pollutant_catalog(cur)
+    cur.execute("""
+        INSERT INTO ingest_watermarks (sensor_id, pollutant, last_timestamp)
+        SELECT sensor_id, pollutant, MAX(timestamp)
+        FROM staging_raw
+        GROUP BY sensor_id, pollutant
+        ON CONFLICT (sensor_id, pollutant) DO UPDATE
+        SET last_timestamp = GREATEST(ingest_watermarks.last_timestamp, EXCLUDED.last_timestamp),
+            updated_at = now();
+    """)
+    return inserted, days
+
+
+def incremental_load(mydb, chunks, store=None):
+    """
+    Stage only rows newer than the stored watermarks, then publish them with
+    upserts on (sensor_id, pollutant, timestamp). Re-running over the same
+    input inserts nothing. With `store`, the months the batch touched are
+    rewritten in that Parquet store after the commit.
+    """
+    cur = mydb.cursor()
+    watermarks = load_watermarks(cur)
+    print(f"🔖 {len(watermarks):,} sensor/pollutant watermarks loaded.")
+
+    cur.execute("""
+        CREATE TEMP TABLE staging_raw (
+            sensor_id VARCHAR(50),
+            timestamp TIMESTAMP,
+            pollutant VARCHAR(50),
+            value DOUBLE PRECISION
+        ) ON COMMIT DROP;
+    """)
+    print("💾 Staging new measurements...")
+    staged = copy_chunks(cur, "staging_raw", drop_loaded(chunks, watermarks))
+    if not staged:
+        mydb.rollback()
+        cur.close()
+        print("✅ Nothing new to load.")
+        return 0
+
+    cur.execute("ANALYZE staging_raw;")
+    print("📆 Publishing batch...")
+    inserted, days = publish_batch(cur)
+    cur.execute("SELECT DISTINCT date_trunc('month', timestamp)::date FROM inserted_rows;")
+    months = [row[0] for row in cur.fetchall()]
+    if inserted:
+        cur.execute("""
+            SELECT array_agg(DISTINCT pollutant), array_agg(DISTINCT sensor_id), MIN(timestamp), MAX(timestamp)
+            FROM inserted_rows;
+        """)
+        pollutants, sensors, first, last = cur.fetchone()
+        notify_change(cur, bump_dataset_version(cur), inserted, sorted(pollutants), sorted(sensors), first, last)
+    mydb.commit()
+    if store and months:
+        print(f"🧱 Rewriting {len(months)} month(s) of the Parquet store...")
+        export_store(cur, store, months)
+    cur.close()
+    print(f"✅ {inserted:,} new rows, {days:,} daily aggregates refreshed.")
+    return inserted
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load Dati Lombardia air quality CSVs into PostgreSQL.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--stream", action="store_true",
+                      help="read the measurements CSV in chunks and load it with COPY")
+    mode.add_argument("--incremental", action="store_true",
+                      help="only load rows newer than the stored watermarks; no tables are cleared")
+    mode.add_argument("--parallel", type=positive_int, nargs="?", const=os.cpu_count(), metavar="WORKERS",
+                      help="parse and clean the CSV in WORKERS processes (default: all cores)")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE,
+                        help="rows per chunk in --stream and --incremental mode")
+    parser.add_argument("--range-mb", type=int, default=RANGE_BYTES // (1024 * 1024),
+                        help="megabytes of CSV per task in --parallel mode")
+    parser.add_argument("--sensors-csv", default=SENSORS_CSV, help="stations CSV (Stazioni qualità dell'aria)")
+    parser.add_argument("--measurements-csv", default=MEASUREMENTS_CSV, help="measurements CSV (Dati sensori aria)")
+    parser.add_argument("--parquet-store", metavar="DIR", default=os.environ.get("PARQUET_STORE_DIR"),
+                        help="also write the Parquet store app.py's parquet backend reads")
+    args = parser.parse_args()
+
+    sensors_clean, sensor_pollutants = load_sensors(args.sensors_csv)
+
+    mydb = connect()
+    cur = mydb.cursor()
+
+    # Insert sensor metadata
+    insert_sensors(cur, sensors_clean)
+    mydb.commit()
+
+    if args.incremental:
+        chunks = iter_clean_chunks(args.measurements_csv, pollutant_lookup(sensor_pollutants), args.chunksize)
+        incremental_load(mydb, chunks, args.parquet_store)
+        cur.close()
+        mydb.close()
+        return
+
+    if args.parallel is not None:
+        parallel_load(cur, args.measurements_csv, sensor_pollutants, args.parallel, args.range_mb * 1024 * 1024)
+    elif args.stream:
+        stream_raw_measurements(cur, args.measurements_csv, sensor_pollutants, args.chunksize)
+        aggregate_daily_in_db(cur)
+        map_sensor_pollutants_in_db(cur)
+    else:
+        measurements_merged = load_measurements(args.measurements_csv, sensor_pollutants)
+        insert_raw_measurements(cur, measurements_merged)
+        insert_daily_stats(cur, measurements_merged)
+        insert_sensor_pollutants(cur, measurements_merged)
+    refresh_watermarks(cur)
+    print("🧮 Building daily to yearly rollups...")
+    refresh_rollups(cur)
+    print("⚖️ Computing exceedances and annual statistics...")
+    refresh_analytics(cur)
+    print("🗺 Building map snapshots...")
+    refresh_map_snapshots(cur)
+    print("🌫 Interpolating pollution surfaces...")
+    refresh_surfaces(cur)
+    refresh_coverage_catalog(cur)
+    refresh_pollutant_catalog(cur)
+    notify_change(cur, bump_dataset_version(cur))
+
+    # -----------------------------
+    # Finalize
+    # -----------------------------
+    mydb.commit()
+    if args.parquet_store:
+        print("🧱 Writing Parquet store...")
+        rows = export_store(cur, args.parquet_store)
+        print(f"🧱 {rows:,} rows written to {args.parquet_store}")
+    cur.close()
+    mydb.close()
+    print("✅ All data inserted successfully.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# metrics.py
+#
+# In-process instrumentation, exported in the Prometheus text format on
+# /metrics: request latency per route split into time in SQL and the rest
+# (serialization and transfer), rows returned, response sizes, error counts,
+# connection pool and cache gauges, and Dash callback timings. Each process
+# keeps its own numbers, so scrape every worker.
+#
+# SLOW_REQUEST_MS turns on the slow-request log: requests slower than that
+# are logged (logger "slow_requests", or the file SLOW_REQUEST_LOG) with their
+# normalized SQL and the EXPLAIN ANALYZE of their slowest statements. The
+# plans are captured on a background thread and re-run the statements, so
+# only enable it while investigating.
+
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+ROW_BUCKETS = (0, 1, 10, 100, 1e3, 1e4, 1e5, 1e6)
+
+SLOW_REQUEST_MS = float(os.environ["SLOW_REQUEST_MS"]) if os.environ.get("SLOW_REQUEST_MS") else None
+# Statements per slow request whose plan is captured, slowest first
+SLOW_EXPLAIN_STATEMENTS = 3
+
+slow_log = logging.getLogger("slow_requests")
+
+REGISTRY = []
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                le_label = f'le="{le}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, labels, le_label)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauges:
+    """One gauge per numeric entry of the dict `source()` returns, read at scrape time."""
+
+    def __init__(self, prefix, help, source):
+        self.prefix, self.help, self.source = prefix, help, source
+        REGISTRY.append(self)
+
+    def lines(self):
+        try:
+            values = self.source()
+        except Exception:
+            logging.exception(f"Failed to read {self.prefix} gauges")
+            return
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f"# HELP {self.prefix}_{key} {self.help}: {key}"
+                yield f"# TYPE {self.prefix}_{key} gauge"
+                yield f"{self.prefix}_{key} {value}"
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.lines()) + "\n"
+
+
+REQUESTS = Counter("http_requests_total", "Requests by route and status", ("route", "status"))
+ERRORS = Counter("http_request_errors_total",
+                 "Requests that failed with a 5xx or broke off while streaming", ("route",))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                            "Time from request start until the response body was sent", ("route",))
+SQL_SECONDS = Histogram("http_request_sql_seconds",
+                        "Time spent executing SQL and fetching rows, per request", ("route",))
+OTHER_SECONDS = Histogram("http_request_serialize_seconds",
+                          "Request time outside SQL: handler logic, serialization and transfer", ("route",))
+ROWS = Histogram("http_request_sql_rows", "Rows returned by the database, per request", ("route",), ROW_BUCKETS)
+RESPONSE_BYTES = Histogram("http_response_size_bytes", "Response body size", ("route",), SIZE_BUCKETS)
+SLOW_REQUESTS = Counter("http_slow_requests_total", "Requests over SLOW_REQUEST_MS", ("route",))
+CALLBACK_SECONDS = Histogram("dash_callback_duration_seconds", "Dash server-side callback time", ("callback",))
+CALLBACK_ERRORS = Counter("dash_callback_errors_total", "Dash callbacks that raised", ("callback",))
+
+
+# -----------------------------
+# Per-request SQL accounting
+# -----------------------------
+class RequestStats:
+    def __init__(self, route, url):
+        self.route = route
+        self.url = url
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.failed = False
+        # [sql, params, seconds] per statement, in execution order
+        self.statements = []
+
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+def record_sql(sql, params, seconds, rows=0):
+    """Account one executed statement to the current request, if any."""
+    stats = _current.get()
+    if stats is not None:
+        stats.sql_seconds += seconds
+        stats.rows += max(rows, 0)
+        stats.statements.append([sql, params, seconds])
+
+
+def record_fetch(seconds, rows):
+    """Account a fetch from a server-side cursor to the statement that opened it."""
+    stats = _current.get()
+    if stats is not None:
+        stats.sql_seconds += seconds
+        stats.rows += rows
+        if stats.statements:
+            stats.statements[-1][2] += seconds
+
+
+def mark_failed():
+    stats = _current.get()
+    if stats is not None:
+        stats.failed = True
+
+
+def normalize_sql(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+# -----------------------------
+# Flask integration
+# -----------------------------
+def counted(body, stats):
+    """Pass a streamed body through, adding up its size."""
+    try:
+        for chunk in body:
+            stats.bytes += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+
+def instrument_flask(app, explain=None):
+    """
+    Time every request of `app` and serve /metrics. `explain(sql, params)`
+    returns EXPLAIN ANALYZE lines for the slow-request log.
+    """
+    from flask import Response, request
+
+    slow_queue = None
+    if SLOW_REQUEST_MS is not None:
+        if os.environ.get("SLOW_REQUEST_LOG"):
+            slow_log.addHandler(logging.FileHandler(os.environ["SLOW_REQUEST_LOG"]))
+        slow_queue = queue.Queue(maxsize=64)
+        threading.Thread(target=slow_worker, args=(slow_queue, explain), daemon=True).start()
+
+    def complete(stats, status):
+        _current.set(None)
+        total = time.perf_counter() - stats.started
+        route = stats.route
+        REQUESTS.inc(route, str(status))
+        if status >= 500 or stats.failed:
+            ERRORS.inc(route)
+        REQUEST_SECONDS.observe(total, route)
+        SQL_SECONDS.observe(stats.sql_seconds, route)
+        OTHER_SECONDS.observe(max(total - stats.sql_seconds, 0.0), route)
+        ROWS.observe(stats.rows, route)
+        RESPONSE_BYTES.observe(stats.bytes, route)
+        if slow_queue is not None and total * 1000 >= SLOW_REQUEST_MS:
+            SLOW_REQUESTS.inc(route)
+            try:
+                slow_queue.put_nowait((stats, total))
+            except queue.Full:
+                slow_log.warning("%.0f ms %s (slow log queue full, plan not captured)", total * 1000, stats.url)
+
+    @app.before_request
+    def start_timer():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        _current.set(RequestStats(route, request.full_path))
+
+    @app.after_request
+    def finish_timer(response):
+        stats = _current.get()
+        if stats is None:
+            return response
+        if response.is_streamed:
+            response.response = counted(response.response, stats)
+        else:
+            stats.bytes = response.calculate_content_length() or 0
+        status = response.status_code
+        # Streamed bodies are still being produced here; stop the clock when they are sent
+        response.call_on_close(lambda: complete(stats, status))
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), mimetype=CONTENT_TYPE)
+
+
+def slow_worker(slow_queue, explain):
+    while True:
+        stats, total = slow_queue.get()
+        lines = [f"{total * 1000:.0f} ms {stats.url} "
+                 f"(sql {stats.sql_seconds * 1000:.0f} ms, {stats.rows} rows, {stats.bytes} bytes)"]
+        slowest = sorted(stats.statements, key=lambda s: s[2], reverse=True)[:SLOW_EXPLAIN_STATEMENTS]
+        for sql, params, seconds in slowest:
+            lines.append(f"  {seconds * 1000:.1f} ms  {normalize_sql(sql)}  params={list(params)!r}")
+            if explain is None:
+                continue
+            try:
+                lines.extend(f"    {line}" for line in explain(sql, params))
+            except Exception as e:
+                lines.append(f"    EXPLAIN failed: {e}")
+        slow_log.warning("\n".join(lines))
+
+
+# -----------------------------
+# Dash integration
+# -----------------------------
+def timed_callback(func):
+    """Record the duration and failures of a Dash server-side callback."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            CALLBACK_ERRORS.inc(func.__name__)
+            raise
+        finally:
+            CALLBACK_SECONDS.observe(time.perf_counter() - t0, func.__name__)
+    return wrapper
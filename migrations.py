@@ -0,0 +1,448 @@
+# migrations.py
+#
+# Versioned, non-destructive schema migrations. Each migration runs once, in
+# order, inside its own transaction and is recorded in `schema_migrations`.
+# Every step is written so it is also safe on a database created by an older
+# create_table.py that never recorded a version.
+
+from datetime import date, datetime
+
+from analytics import create_analytics_tables, refresh_analytics
+from interpolation import create_surface_tables, refresh_surfaces
+from rollups import ROLLUP_LEVELS
+from snapshots import refresh_map_snapshots
+
+
+def m001_baseline(cur):
+    cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS sensors (
+            sensor_id VARCHAR(50) PRIMARY KEY,
+            station_name VARCHAR(100) NOT NULL,
+            province VARCHAR(50),
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            geom GEOMETRY(Point, 4326)
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS raw_measurements (
+            measurement_id SERIAL PRIMARY KEY,
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            timestamp TIMESTAMP NOT NULL,
+            pollutant VARCHAR(50) NOT NULL,
+            value DOUBLE PRECISION
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS measurements (
+            measurement_id SERIAL PRIMARY KEY,
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            timestamp DATE NOT NULL,
+            pollutant VARCHAR(50) NOT NULL,
+            daily_avg DOUBLE PRECISION,
+            daily_min DOUBLE PRECISION,
+            daily_max DOUBLE PRECISION
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_pollutants (
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            pollutant VARCHAR(50),
+            PRIMARY KEY (sensor_id, pollutant)
+        );
+    ''')
+
+
+def m002_natural_keys(cur):
+    # Older loads may contain duplicates; keep the first copy of each row
+    for table in ("raw_measurements", "measurements"):
+        cur.execute(f'''
+            DELETE FROM {table} a
+            USING {table} b
+            WHERE a.measurement_id > b.measurement_id
+              AND a.sensor_id = b.sensor_id
+              AND a.timestamp = b.timestamp
+              AND a.pollutant = b.pollutant;
+        ''')
+        cur.execute(f'''
+            CREATE UNIQUE INDEX IF NOT EXISTS {table}_sensor_id_timestamp_pollutant_key
+            ON {table} (sensor_id, timestamp, pollutant);
+        ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_watermarks (
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            pollutant VARCHAR(50),
+            last_timestamp TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (sensor_id, pollutant)
+        );
+    ''')
+    cur.execute('''
+        INSERT INTO ingest_watermarks (sensor_id, pollutant, last_timestamp)
+        SELECT sensor_id, pollutant, MAX(timestamp)
+        FROM raw_measurements
+        GROUP BY sensor_id, pollutant
+        ON CONFLICT DO NOTHING;
+    ''')
+
+
+def m003_partition_raw_measurements(cur):
+    """Rebuild raw_measurements as a table range-partitioned by month on timestamp."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'raw_measurements'::regclass;")
+    if cur.fetchone()[0] == 'p':
+        return
+
+    # Move the old heap table (and the names it owns) out of the way
+    cur.execute("ALTER TABLE raw_measurements RENAME TO raw_measurements_old;")
+    cur.execute("ALTER INDEX IF EXISTS raw_measurements_pkey RENAME TO raw_measurements_old_pkey;")
+    cur.execute('''
+        ALTER INDEX IF EXISTS raw_measurements_sensor_id_timestamp_pollutant_key
+        RENAME TO raw_measurements_old_natural_key;
+    ''')
+    cur.execute("ALTER SEQUENCE raw_measurements_measurement_id_seq OWNED BY NONE;")
+
+    # The natural key leads with (sensor_id, pollutant, timestamp), which is
+    # also the access path for every per-sensor API filter
+    cur.execute('''
+        CREATE TABLE raw_measurements (
+            measurement_id INTEGER NOT NULL DEFAULT nextval('raw_measurements_measurement_id_seq'),
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            timestamp TIMESTAMP NOT NULL,
+            pollutant VARCHAR(50) NOT NULL,
+            value DOUBLE PRECISION,
+            PRIMARY KEY (measurement_id, timestamp),
+            CONSTRAINT raw_measurements_natural_key UNIQUE (sensor_id, pollutant, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+    ''')
+    cur.execute("ALTER SEQUENCE raw_measurements_measurement_id_seq OWNED BY raw_measurements.measurement_id;")
+    cur.execute("CREATE TABLE raw_measurements_default PARTITION OF raw_measurements DEFAULT;")
+
+    cur.execute("SELECT MIN(timestamp), MAX(timestamp) FROM raw_measurements_old;")
+    first, last = cur.fetchone()
+    if first is not None:
+        ensure_month_partitions(cur, first, last)
+    cur.execute('''
+        INSERT INTO raw_measurements (measurement_id, sensor_id, timestamp, pollutant, value)
+        SELECT measurement_id, sensor_id, timestamp, pollutant, value
+        FROM raw_measurements_old;
+    ''')
+    cur.execute("DROP TABLE raw_measurements_old;")
+
+
+def m004_query_indexes(cur):
+    # BRIN keeps time-range scans cheap at a tiny fraction of a btree's size
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS raw_measurements_timestamp_brin
+        ON raw_measurements USING brin (timestamp);
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS measurements_pollutant_ts_idx
+        ON measurements (pollutant, timestamp);
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS sensors_geom_gist
+        ON sensors USING gist (geom);
+    ''')
+    cur.execute("ANALYZE sensors;")
+    cur.execute("ANALYZE raw_measurements;")
+    cur.execute("ANALYZE measurements;")
+
+
+def m005_dataset_version(cur):
+    # Single-row counter the loader bumps on every commit; API caches key on it
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS dataset_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    ''')
+    cur.execute("INSERT INTO dataset_version (version) VALUES (1) ON CONFLICT DO NOTHING;")
+
+
+def m006_pollutant_catalog(cur):
+    # Small per-pollutant summary maintained by the loader for /api/metadata
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS pollutant_catalog (
+            pollutant VARCHAR(50) PRIMARY KEY,
+            sensor_count INTEGER NOT NULL,
+            first_timestamp TIMESTAMP,
+            last_timestamp TIMESTAMP,
+            row_count BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    ''')
+    cur.execute('''
+        INSERT INTO pollutant_catalog
+            (pollutant, sensor_count, first_timestamp, last_timestamp, row_count)
+        SELECT pollutant, COUNT(DISTINCT sensor_id), MIN(timestamp), MAX(timestamp), COUNT(*)
+        FROM raw_measurements
+        GROUP BY pollutant
+        ON CONFLICT DO NOTHING;
+    ''')
+
+
+COVERAGE_REFRESH_SQL = '''
+    INSERT INTO coverage_catalog
+        (sensor_id, pollutant, first_timestamp, last_timestamp, row_count, gap_count)
+    SELECT sensor_id,
+           pollutant,
+           MIN(timestamp),
+           MAX(timestamp),
+           COUNT(*),
+           COUNT(*) FILTER (WHERE gap)
+    FROM (
+        SELECT sensor_id,
+               pollutant,
+               timestamp,
+               timestamp - LAG(timestamp) OVER (
+                   PARTITION BY sensor_id, pollutant ORDER BY timestamp
+               ) > INTERVAL '1 hour' AS gap
+        FROM raw_measurements
+    ) readings
+    GROUP BY sensor_id, pollutant;
+'''
+
+
+def m007_coverage_catalog(cur):
+    # Per (sensor, pollutant) coverage; a gap is a break of more than one hour
+    # between consecutive readings
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS coverage_catalog (
+            sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+            pollutant VARCHAR(50),
+            first_timestamp TIMESTAMP NOT NULL,
+            last_timestamp TIMESTAMP NOT NULL,
+            row_count BIGINT NOT NULL,
+            gap_count INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (sensor_id, pollutant)
+        );
+    ''')
+    cur.execute("SELECT EXISTS (SELECT 1 FROM coverage_catalog);")
+    if not cur.fetchone()[0]:
+        cur.execute(COVERAGE_REFRESH_SQL)
+
+
+# (table, bucket, source, aggregates) of the rollup levels, bottom up, written
+# out here so later changes to rollups.py never change what this step does.
+# Databases migrated before the hourly level was dropped also have
+# rollup_hourly, which m014 removes
+M008_ROLLUPS = (
+    ("rollup_daily", "date_trunc('day', timestamp)::date", "raw_measurements",
+     "COUNT(value), COALESCE(SUM(value), 0), MIN(value), MAX(value)"),
+    ("rollup_weekly", "date_trunc('week', bucket::timestamp)::date", "rollup_daily",
+     "SUM(n), SUM(total), MIN(min), MAX(max)"),
+    ("rollup_monthly", "date_trunc('month', bucket::timestamp)::date", "rollup_daily",
+     "SUM(n), SUM(total), MIN(min), MAX(max)"),
+    ("rollup_yearly", "date_trunc('year', bucket::timestamp)::date", "rollup_monthly",
+     "SUM(n), SUM(total), MIN(min), MAX(max)"),
+)
+
+
+def m008_rollups(cur):
+    for table, _, _, _ in M008_ROLLUPS:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+                pollutant VARCHAR(50) NOT NULL,
+                bucket DATE NOT NULL,
+                n BIGINT NOT NULL,
+                total DOUBLE PRECISION NOT NULL,
+                min DOUBLE PRECISION,
+                max DOUBLE PRECISION,
+                PRIMARY KEY (sensor_id, pollutant, bucket)
+            );
+        ''')
+        cur.execute(f'''
+            CREATE INDEX IF NOT EXISTS {table}_pollutant_bucket_idx
+            ON {table} (pollutant, bucket);
+        ''')
+    cur.execute("SELECT EXISTS (SELECT 1 FROM rollup_daily);")
+    if cur.fetchone()[0]:
+        return
+    for table, bucket, source, aggs in M008_ROLLUPS:
+        cur.execute(f'''
+            INSERT INTO {table} (sensor_id, pollutant, bucket, n, total, min, max)
+            SELECT sensor_id, pollutant, {bucket}, {aggs}
+            FROM {source}
+            GROUP BY 1, 2, 3;
+        ''')
+
+
+def m009_geography_index(cur):
+    # Radius and nearest-neighbour queries measure metres on the spheroid, so
+    # they need the geography cast indexed; bounding boxes keep using
+    # sensors_geom_gist
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS sensors_geog_gist
+        ON sensors USING gist ((geom::geography));
+    ''')
+    cur.execute("ANALYZE sensors;")
+
+
+def m010_map_snapshots(cur):
+    # One sensor x day float32 matrix of daily_avg per pollutant (see snapshots.py)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS map_snapshots (
+            pollutant VARCHAR(50) PRIMARY KEY,
+            first_date DATE NOT NULL,
+            days INTEGER NOT NULL,
+            sensor_ids TEXT[] NOT NULL,
+            grid BYTEA NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    ''')
+    cur.execute("SELECT EXISTS (SELECT 1 FROM map_snapshots);")
+    if not cur.fetchone()[0]:
+        refresh_map_snapshots(cur)
+
+
+def m011_analytics(cur):
+    # Rolling 8-hour maxima and annual compliance statistics (see analytics.py)
+    create_analytics_tables(cur)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM annual_stats);")
+    if not cur.fetchone()[0]:
+        refresh_analytics(cur)
+
+
+def m012_surfaces(cur):
+    # IDW-interpolated daily surfaces per pollutant, quantized to uint8 (see interpolation.py)
+    create_surface_tables(cur)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM surface_grids);")
+    if not cur.fetchone()[0]:
+        refresh_surfaces(cur)
+
+
+def m013_keyset_index(cur):
+    # The keyset order of /api/raw_measurements pages; the primary key leads
+    # with measurement_id, which no unfiltered page could use
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS raw_measurements_keyset_idx
+        ON raw_measurements (timestamp, measurement_id);
+    ''')
+
+
+def m014_drop_hourly_rollup(cur):
+    # The hourly level copied raw_measurements row for row; the daily level
+    # reads raw_measurements directly now (see rollups.py)
+    cur.execute("DROP TABLE IF EXISTS rollup_hourly;")
+
+
+def m015_measurements_key_order(cur):
+    # The key from m002 puts timestamp before pollutant, so a sensor + pollutant
+    # + date range filter walked every pollutant of the sensor; lead with
+    # (sensor_id, pollutant) as raw_measurements_natural_key does
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS measurements_natural_key
+        ON measurements (sensor_id, pollutant, timestamp);
+    ''')
+    cur.execute("DROP INDEX IF EXISTS measurements_sensor_id_timestamp_pollutant_key;")
+    cur.execute("ANALYZE measurements;")
+
+
+# Every table owned by the migrations, in an order that is safe to drop
+MANAGED_TABLES = (
+    "surface_days", "surface_grids", "annual_stats", "daily_max_8h", "map_snapshots",
+) + tuple(level["table"] for level in reversed(ROLLUP_LEVELS)) + (
+    # Left by m008 on a database not yet at m014
+    "rollup_hourly",
+    "coverage_catalog",
+    "pollutant_catalog",
+    "dataset_version",
+    "ingest_watermarks",
+    "sensor_pollutants",
+    "measurements",
+    "raw_measurements",
+    "sensors",
+    "schema_migrations",
+)
+
+MIGRATIONS = [
+    (1, "baseline schema", m001_baseline),
+    (2, "natural keys and ingestion watermarks", m002_natural_keys),
+    (3, "monthly range partitions for raw_measurements", m003_partition_raw_measurements),
+    (4, "composite, BRIN and GiST indexes", m004_query_indexes),
+    (5, "dataset version counter", m005_dataset_version),
+    (6, "pollutant catalog", m006_pollutant_catalog),
+    (7, "sensor coverage catalog", m007_coverage_catalog),
+    (8, "daily/weekly/monthly/yearly rollups", m008_rollups),
+    (9, "geography GiST index on sensors", m009_geography_index),
+    (10, "per-pollutant map snapshots", m010_map_snapshots),
+    (11, "rolling 8-hour maxima and annual compliance statistics", m011_analytics),
+    (12, "interpolated pollution surfaces", m012_surfaces),
+    (13, "keyset index for raw measurement pages", m013_keyset_index),
+    (14, "drop the hourly rollup level", m014_drop_hourly_rollup),
+    (15, "measurements key on (sensor_id, pollutant, timestamp)", m015_measurements_key_order),
+]
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def next_month(d):
+    return date(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def ensure_month_partitions(cur, first, last):
+    """Create any missing monthly partitions of raw_measurements covering [first, last]."""
+    if isinstance(last, datetime):
+        last = last.date()
+    month = month_start(first)
+    while month <= last:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS raw_measurements_{month:%Y_%m}
+            PARTITION OF raw_measurements
+            FOR VALUES FROM ('{month}') TO ('{next_month(month)}');
+        ''')
+        month = next_month(month)
+
+
+def current_version(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    ''')
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations;")
+    return cur.fetchone()[0]
+
+
+def reset(conn):
+    """Drop every managed table. Only used by `create_table.py --reset`."""
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {', '.join(MANAGED_TABLES)} CASCADE;")
+    conn.commit()
+    cur.close()
+
+
+def migrate(conn, target=None):
+    """Apply every pending migration up to `target` (default: latest). Returns the new version."""
+    cur = conn.cursor()
+    version = current_version(cur)
+    conn.commit()
+
+    for number, description, step in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        print(f"⏫ Migration {number}: {description}...")
+        try:
+            step(cur)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                (number, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            cur.close()
+            raise
+        version = number
+
+    cur.close()
+    return version
@@ -0,0 +1,281 @@
+# parquet_store.py
+#
+# Local columnar copy of the measurement tables, written by manage_data.py
+# and readable by app.py without the database:
+#
+#     <root>/raw/pollutant=<p>/year=<y>/month=<m>/part-0.parquet
+#     <root>/daily/pollutant=<p>/year=<y>/month=<m>/part-0.parquet
+#
+# Rows are sorted by sensor_id then time, and written in small row groups, so
+# the per-row-group min/max statistics let a sensor or time filter skip most
+# of a file. Partition directories are pruned from the same filter.
+
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from columnar import record_batch
+from migrations import month_start, next_month
+from queries import RAW_MAX_ROWS, decode_cursor, encode_cursor, parse_resolution
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+except ImportError:  # the Parquet store is optional
+    pa = None
+
+STORAGE_BACKENDS = ("postgres", "parquet")
+# Rows per row group; smaller groups give finer min/max pruning
+STORE_ROW_GROUP = 65_536
+# Seconds a discovered file listing is reused before the directories are re-read
+DISCOVERY_TTL = float(os.environ.get("PARQUET_DISCOVERY_TTL", 30))
+PARTITION_MONTH = re.compile(r"/year=(\d+)/month=(\d+)/")
+
+TABLES = {
+    "raw": {
+        "sql": """
+            SELECT measurement_id, sensor_id, timestamp, pollutant, value
+            FROM raw_measurements
+            WHERE timestamp >= %s AND timestamp < %s
+            ORDER BY pollutant, sensor_id, timestamp;
+        """,
+        "columns": ["measurement_id", "sensor_id", "timestamp", "pollutant", "value"],
+    },
+    "daily": {
+        "sql": """
+            SELECT sensor_id, timestamp AS date, pollutant, daily_avg, daily_min, daily_max
+            FROM measurements
+            WHERE timestamp >= %s AND timestamp < %s
+            ORDER BY pollutant, sensor_id, timestamp;
+        """,
+        "columns": ["sensor_id", "date", "pollutant", "daily_avg", "daily_min", "daily_max"],
+    },
+}
+
+
+# -----------------------------
+# Writing (manage_data.py)
+# -----------------------------
+def write_month(cur, root, table, month):
+    """Rewrite every pollutant's file of `table` for one month, each atomically."""
+    spec = TABLES[table]
+    cur.execute(spec["sql"], (month, next_month(month)))
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    data = pa.Table.from_batches([record_batch(spec["columns"], rows)])
+    for pollutant in pc.unique(data["pollutant"]).to_pylist():
+        part = data.filter(pc.equal(data["pollutant"], pollutant)).drop(["pollutant"])
+        directory = os.path.join(root, table, f"pollutant={quote(pollutant, safe='')}",
+                                 f"year={month.year}", f"month={month.month}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "part-0.parquet")
+        pq.write_table(part, path + ".tmp", row_group_size=STORE_ROW_GROUP,
+                       compression="zstd", write_statistics=True)
+        os.replace(path + ".tmp", path)
+    return len(rows)
+
+
+def export_store(cur, root, months=None):
+    """
+    Write the Parquet store at `root` from PostgreSQL. With `months` only
+    those months are rewritten in place; otherwise the whole store is built
+    next to the old one and swapped in.
+    """
+    if pa is None:
+        raise RuntimeError("the Parquet store needs pyarrow installed")
+
+    if months is not None:
+        for month in sorted(set(months)):
+            for table in TABLES:
+                write_month(cur, root, table, month_start(month))
+        return
+
+    cur.execute("SELECT MIN(first_timestamp), MAX(last_timestamp) FROM coverage_catalog;")
+    first, last = cur.fetchone()
+    staging = root.rstrip("/\\") + ".new"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    total = 0
+    if first is not None:
+        month = month_start(first)
+        while month <= last.date():
+            for table in TABLES:
+                total += write_month(cur, staging, table, month)
+            month = next_month(month)
+
+    previous = root.rstrip("/\\") + ".old"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(root):
+        os.replace(root, previous)
+    os.replace(staging, root)
+    shutil.rmtree(previous, ignore_errors=True)
+    return total
+
+
+# -----------------------------
+# Reading (app.py)
+# -----------------------------
+def after_month(value):
+    """Partition filter keeping months at or after value's month."""
+    return (ds.field("year") > value.year) | (
+        (ds.field("year") == value.year) & (ds.field("month") >= value.month))
+
+
+def before_month(value):
+    """Partition filter keeping months at or before value's month."""
+    return (ds.field("year") < value.year) | (
+        (ds.field("year") == value.year) & (ds.field("month") <= value.month))
+
+
+def combine(filters):
+    expr = None
+    for f in filters:
+        expr = f if expr is None else expr & f
+    return expr
+
+
+class ParquetBackend:
+    """
+    Answers /api/raw_measurements and /api/measurements from the Parquet
+    store. Files are memory-mapped and only the partitions and row groups
+    that can match the filter are read.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._datasets = {}
+
+    def _dataset(self, table, refresh=False):
+        if pa is None:
+            raise ValueError("the parquet backend needs pyarrow installed on the server")
+        with self._lock:
+            cached = self._datasets.get(table)
+            if cached and not refresh and time.monotonic() - cached[1] < DISCOVERY_TTL:
+                return cached[0]
+            path = os.path.join(self.root, table)
+            if not os.path.isdir(path):
+                raise ValueError(f"no Parquet store at {self.root}; run manage_data.py --parquet-store")
+            dataset = ds.dataset(
+                path,
+                format="parquet",
+                filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+                partitioning=ds.partitioning(
+                    pa.schema([("pollutant", pa.string()), ("year", pa.int16()), ("month", pa.int8())]),
+                    flavor="hive"
+                ),
+            )
+            self._datasets[table] = (dataset, time.monotonic())
+            return dataset
+
+    def _scan(self, table, columns, expr):
+        try:
+            return self._dataset(table).to_table(columns=columns, filter=expr)
+        except (FileNotFoundError, OSError):
+            # The loader swapped the store since the files were listed
+            return self._dataset(table, refresh=True).to_table(columns=columns, filter=expr)
+
+    def _months(self, dataset, expr):
+        """(year, month) partitions that can match expr, oldest first."""
+        months = set()
+        for fragment in dataset.get_fragments(filter=expr):
+            match = PARTITION_MONTH.search(fragment.path.replace("\\", "/"))
+            months.add((int(match.group(1)), int(match.group(2))))
+        return sorted(months)
+
+    def _read_in_order(self, dataset, columns, expr, sort_keys, limit):
+        schema = dataset.scanner(columns=columns).projected_schema
+        tables, rows = [], 0
+        for year, month in self._months(dataset, expr):
+            month_expr = combine([f for f in (expr, ds.field("year") == year, ds.field("month") == month)
+                                  if f is not None])
+            batches = dataset.scanner(columns=columns, filter=month_expr).to_batches()
+            data = pa.Table.from_batches(list(batches), schema=schema)
+            tables.append(data.sort_by(sort_keys))
+            rows += data.num_rows
+            if rows >= limit:
+                break
+        return pa.concat_tables(tables) if tables else schema.empty_table()
+
+    def _scan_in_order(self, table, columns, expr, sort_keys, limit):
+        """
+        At least `limit` matching rows (all of them if there are fewer), sorted
+        by sort_keys, whose first key must be the partition month's time. Months
+        are read oldest first, and reading stops at the first month that brings
+        the total to `limit`, so only that month's rows are held beyond the page.
+        """
+        try:
+            return self._read_in_order(self._dataset(table), columns, expr, sort_keys, limit)
+        except (FileNotFoundError, OSError):
+            # The loader swapped the store since the files were listed
+            return self._read_in_order(self._dataset(table, refresh=True), columns, expr, sort_keys, limit)
+
+    def raw_measurements(self, args):
+        """(table, next cursor or None) for /api/raw_measurements' plain row listing."""
+        if args.get("bucket") or args.get("points"):
+            raise ValueError("bucket and points are only supported by the postgres backend")
+        try:
+            limit = min(int(args.get("limit", RAW_MAX_ROWS)), RAW_MAX_ROWS)
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError("limit must be a positive integer")
+        try:
+            after = decode_cursor(args["after"]) if args.get("after") else None
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("invalid cursor")
+
+        ts = ds.field("timestamp")
+        filters = self._common_filters(args)
+        if args.get("start"):
+            start = datetime.fromisoformat(args["start"])
+            filters += [ts >= start, after_month(start)]
+        if args.get("end"):
+            end = datetime.fromisoformat(args["end"]).date()
+            filters += [ts < datetime.combine(end + timedelta(days=1), datetime.min.time()),
+                        before_month(end)]
+        if after:
+            filters += [ts >= after[0], after_month(after[0]),
+                        (ts > after[0]) | ((ts == after[0]) & (ds.field("measurement_id") > after[1]))]
+
+        data = self._scan_in_order("raw", TABLES["raw"]["columns"], combine(filters),
+                                   [("timestamp", "ascending"), ("measurement_id", "ascending")], limit + 1)
+        next_cursor = None
+        if data.num_rows > limit:
+            last = data.slice(limit - 1, 1).to_pylist()[0]
+            next_cursor = encode_cursor(last["timestamp"], last["measurement_id"])
+            data = data.slice(0, limit)
+        return data, next_cursor
+
+    def measurements(self, args):
+        """Table of daily aggregates for /api/measurements (resolution=day)."""
+        if parse_resolution(args) != "day":
+            raise ValueError("the parquet backend serves resolution=day only")
+
+        day = ds.field("date")
+        filters = self._common_filters(args)
+        if args.get("start"):
+            start = datetime.fromisoformat(args["start"]).date()
+            filters += [day >= start, after_month(start)]
+        if args.get("end"):
+            end = datetime.fromisoformat(args["end"]).date()
+            filters += [day <= end, before_month(end)]
+
+        data = self._scan("daily", TABLES["daily"]["columns"], combine(filters))
+        return data.sort_by([("date", "ascending")])
+
+    def _common_filters(self, args):
+        filters = []
+        if args.get("sensor_id"):
+            filters.append(ds.field("sensor_id") == args["sensor_id"])
+        if args.get("pollutant"):
+            filters.append(ds.field("pollutant") == args["pollutant"])
+        return filters
@@ -0,0 +1,759 @@
+# queries.py
+#
+# SQL and query-parameter handling shared by the Flask API (app.py) and its
+# async variant (async_app.py), so both serve identical responses. Statements
+# use $1, $2, ... placeholders: app.py runs them through prepared statements
+# (db.execute_prepared), asyncpg takes them as they are. Invalid parameters
+# raise ValueError with a message meant for a 400 response.
+
+import base64
+import os
+import re
+from collections import namedtuple
+from itertools import groupby
+from datetime import date, datetime, timedelta
+
+from analytics import LIMIT_KINDS, LIMITS
+from interpolation import LEVELS, NODATA
+from rollups import RESOLUTION_TABLES
+
+# Hard cap on rows returned by a single /api/raw_measurements response
+RAW_MAX_ROWS = int(os.environ.get("RAW_MAX_ROWS", 500000))
+# Pages up to this size are read whole before the response starts, so their
+# X-Next-Cursor header can come from the page itself
+RAW_PAGE_ROWS = int(os.environ.get("RAW_PAGE_ROWS", 20000))
+# Units accepted by /api/raw_measurements?bucket=, e.g. 1h, 6h, 1d, 1w
+BUCKET_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+# Bounds for the spatial endpoints' radius (metres) and neighbour count
+SPATIAL_MAX_RADIUS = 500_000
+SPATIAL_MAX_K = 100
+# Most sensor ids one /api/measurements/batch request may list
+BATCH_MAX_SENSORS = int(os.environ.get("BATCH_MAX_SENSORS", 200))
+# Longest window /api/analytics/rolling accepts, per unit
+ROLLING_MAX = {"h": 24 * 31, "d": 366}
+# JSON layouts of the list endpoints: a dict per row (the default), or each
+# column name once with an array of its values
+SHAPES = ("rows", "columns")
+# Query point of /api/spatial/radius and /api/spatial/nearest
+POINT_SQL = "ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography"
+
+SENSORS_SQL = """
+    SELECT
+        sensor_id,
+        station_name,
+        province,
+        latitude,
+        longitude,
+        ST_AsGeoJSON(geom)::json AS geometry
+    FROM sensors;
+"""
+
+SENSOR_SQL = """
+    SELECT
+        sensor_id,
+        station_name,
+        province,
+        latitude,
+        longitude,
+        ST_AsGeoJSON(geom)::json AS geometry
+    FROM sensors
+    WHERE sensor_id = $1;
+"""
+
+# Answered from the loader-maintained coverage catalog (one row per
+# sensor/pollutant) instead of scanning raw_measurements
+DATE_RANGE_SQL = """
+    SELECT
+        MIN(first_timestamp)::date AS first_date,
+        MAX(last_timestamp)::date AS last_date
+    FROM coverage_catalog;
+"""
+
+SENSOR_COVERAGE_SQL = """
+    SELECT
+        pollutant,
+        first_timestamp::date AS first_date,
+        last_timestamp::date AS last_date,
+        first_timestamp,
+        last_timestamp,
+        row_count,
+        gap_count,
+        (EXTRACT(EPOCH FROM last_timestamp - first_timestamp) / 3600)::bigint + 1
+            - row_count AS missing_hours
+    FROM coverage_catalog
+    WHERE sensor_id = $1
+    ORDER BY pollutant;
+"""
+
+METADATA_POLLUTANTS_SQL = """
+    SELECT DISTINCT pollutant
+    FROM sensor_pollutants
+    ORDER BY pollutant;
+"""
+
+METADATA_SENSORS_SQL = """
+    SELECT sensor_id, station_name, province, latitude, longitude
+    FROM sensors
+    ORDER BY station_name;
+"""
+
+METADATA_COVERAGE_SQL = """
+    SELECT pollutant,
+           sensor_count,
+           first_timestamp::date AS first_date,
+           last_timestamp::date AS last_date,
+           row_count
+    FROM pollutant_catalog
+    ORDER BY pollutant;
+"""
+
+SNAPSHOT_SQL = """
+    SELECT first_date, days, grid
+    FROM map_snapshots
+    WHERE pollutant = $1;
+"""
+
+SNAPSHOT_SENSORS_SQL = """
+    SELECT u.sensor_id, s.station_name, s.latitude, s.longitude
+    FROM map_snapshots ms
+    CROSS JOIN unnest(ms.sensor_ids) WITH ORDINALITY AS u(sensor_id, pos)
+    LEFT JOIN sensors s ON s.sensor_id = u.sensor_id
+    WHERE ms.pollutant = $1
+    ORDER BY u.pos;
+"""
+
+# Surface rows are read by name through SurfaceGrid / SurfaceDay, which list
+# the selected columns in order
+SurfaceGrid = namedtuple("SurfaceGrid", ["first_date", "days", "west", "south", "step", "width", "height",
+                                         "value_max"])
+SurfaceDay = namedtuple("SurfaceDay", SurfaceGrid._fields + ("grid",))
+
+SURFACE_SQL = f"""
+    SELECT {", ".join(SurfaceGrid._fields)}
+    FROM surface_grids
+    WHERE pollutant = $1;
+"""
+
+SURFACE_DAY_SQL = f"""
+    SELECT {", ".join("g." + f for f in SurfaceGrid._fields)}, d.grid
+    FROM surface_days d
+    JOIN surface_grids g ON g.pollutant = d.pollutant
+    WHERE d.pollutant = $1 AND d.day = $2;
+"""
+
+# For a page of at most RAW_PAGE_ROWS plain rows, `page` is its size and `sql`
+# returns one row more, whose presence means there is a next page; otherwise None
+RawQuery = namedtuple("RawQuery", ["sql", "params", "page", "what"])
+
+
+def parse_bucket(text):
+    """'6h' -> '6 hours'; raises ValueError for anything else."""
+    match = re.fullmatch(r"([1-9]\d*)([hdw])", text)
+    if not match:
+        raise ValueError(text)
+    return f"{match.group(1)} {BUCKET_UNITS[match.group(2)]}"
+
+
+def encode_cursor(timestamp, measurement_id):
+    token = f"{timestamp.isoformat()}|{measurement_id}".encode()
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    padded = token + "=" * (-len(token) % 4)
+    timestamp, measurement_id = base64.urlsafe_b64decode(padded).decode().split("|")
+    return datetime.fromisoformat(timestamp), int(measurement_id)
+
+
+def raw_measurements_query(args):
+    """Build the /api/raw_measurements statement from its query parameters."""
+    sensor_id = args.get("sensor_id")
+    pollutant = args.get("pollutant")
+    start     = args.get("start")
+    end       = args.get("end")
+    after     = args.get("after")
+
+    if parse_shape(args) != "rows":
+        raise ValueError("shape=columns is not available for streamed raw measurements; "
+                         "use format=arrow or format=csv")
+    try:
+        limit = min(int(args.get("limit", RAW_MAX_ROWS)), RAW_MAX_ROWS)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError("limit must be a positive integer")
+    try:
+        after = decode_cursor(after) if after else None
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+
+    bucket = args.get("bucket")
+    points = args.get("points")
+    if bucket and points:
+        raise ValueError("use either bucket or points, not both")
+    if (bucket or points) and after:
+        raise ValueError("after cannot be combined with bucket or points")
+    try:
+        interval = parse_bucket(bucket) if bucket else None
+    except ValueError:
+        raise ValueError("bucket must look like 1h, 6h, 1d or 1w")
+    try:
+        slices = max(1, int(points) // 4) if points else None
+    except ValueError:
+        raise ValueError("points must be an integer")
+
+    # Placeholders are numbered ($1, $2, ...) for the prepared statement
+    filters, params = [], []
+    if interval:
+        # Bound first because it appears first in the bucketed SELECT list
+        params.append(interval)
+    if sensor_id:
+        params.append(sensor_id);   filters.append(f"sensor_id = ${len(params)}")
+    if pollutant:
+        params.append(pollutant);   filters.append(f"pollutant = ${len(params)}")
+    if start:
+        params.append(start);       filters.append(f"timestamp >= ${len(params)}")
+    if end:
+        params.append(end);         filters.append(f"timestamp < ${len(params)}::date + INTERVAL '1 day'")
+    if after:
+        # The plain timestamp bound keeps partition pruning working
+        params.append(after[0]);    filters.append(f"timestamp >= ${len(params)}")
+        params.extend(after)
+        filters.append(f"(timestamp, measurement_id) > (${len(params) - 1}, ${len(params)})")
+    where = ("WHERE " + " AND ".join(filters)) if filters else ""
+
+    if interval:
+        # Weekly buckets start on Mondays (2000-01-03 was one)
+        sql = f"""
+            SELECT sensor_id,
+                   pollutant,
+                   date_bin($1::interval, timestamp, TIMESTAMP '2000-01-03') AS timestamp,
+                   AVG(value) AS value,
+                   MIN(value) AS min,
+                   MAX(value) AS max,
+                   COUNT(*) AS count
+            FROM raw_measurements
+            {where}
+            GROUP BY 1, 2, 3
+            ORDER BY timestamp, sensor_id, pollutant
+            LIMIT ${len(params) + 1};
+        """
+        return RawQuery(sql, params + [limit], None, "bucketed raw measurements")
+
+    if slices:
+        sql = f"""
+            WITH src AS (
+                SELECT measurement_id, sensor_id, timestamp, pollutant, value
+                FROM raw_measurements
+                {where}
+            ),
+            sliced AS (
+                SELECT src.*,
+                       width_bucket(
+                           EXTRACT(EPOCH FROM src.timestamp),
+                           EXTRACT(EPOCH FROM b.t0),
+                           EXTRACT(EPOCH FROM b.t1) + 1,
+                           ${len(params) + 1}
+                       ) AS slice
+                FROM src,
+                     (SELECT MIN(timestamp) AS t0, MAX(timestamp) AS t1 FROM src) b
+            ),
+            ranked AS (
+                SELECT *,
+                       ROW_NUMBER() OVER (w ORDER BY timestamp)             AS first_rn,
+                       ROW_NUMBER() OVER (w ORDER BY timestamp DESC)        AS last_rn,
+                       ROW_NUMBER() OVER (w ORDER BY value, timestamp)      AS low_rn,
+                       ROW_NUMBER() OVER (w ORDER BY value DESC, timestamp) AS high_rn
+                FROM sliced
+                WINDOW w AS (PARTITION BY sensor_id, pollutant, slice)
+            )
+            SELECT measurement_id, sensor_id, timestamp, pollutant, value
+            FROM ranked
+            WHERE first_rn = 1 OR last_rn = 1 OR low_rn = 1 OR high_rn = 1
+            ORDER BY timestamp, measurement_id
+            LIMIT ${len(params) + 2};
+        """
+        return RawQuery(sql, params + [slices, limit], None, "downsampled raw measurements")
+
+    # raw_measurements_keyset_idx serves this order, with or without filters
+    sql = f"""
+        SELECT measurement_id,
+               sensor_id,
+               timestamp,
+               pollutant,
+               value
+        FROM raw_measurements
+        {where}
+        ORDER BY timestamp, measurement_id
+        LIMIT ${len(params) + 1};
+    """
+    if limit > RAW_PAGE_ROWS:
+        return RawQuery(sql, params + [limit], None, "raw measurements")
+    return RawQuery(sql, params + [limit + 1], limit, "raw measurements")
+
+
+def page_cursor(rows, page):
+    """(the page's rows, X-Next-Cursor or None) from the `page + 1` rows of a RawQuery."""
+    if len(rows) <= page:
+        return rows, None
+    rows = rows[:page]
+    return rows, encode_cursor(rows[-1][2], rows[-1][0])
+
+
+def parse_resolution(args):
+    resolution = args.get("resolution", "day")
+    if resolution != "day" and resolution not in RESOLUTION_TABLES:
+        raise ValueError(f"resolution must be one of day, {', '.join(RESOLUTION_TABLES)}")
+    return resolution
+
+
+def rollup_query(resolution, sensor_id=None, pollutant=None, start=None, end=None, with_sensor=True):
+    """
+    SQL and params for week/month/year aggregates from the rollup tables.
+    `start` and `end` select every bucket overlapping that date range.
+    """
+    table, unit = RESOLUTION_TABLES[resolution]
+    filters, params = [], []
+    if sensor_id:
+        params.append(sensor_id);   filters.append(f"sensor_id = ${len(params)}")
+    if pollutant:
+        params.append(pollutant);   filters.append(f"pollutant = ${len(params)}")
+    if start:
+        params.append(start);       filters.append(f"bucket >= date_trunc('{unit}', ${len(params)}::timestamp)::date")
+    if end:
+        params.append(end);         filters.append(f"bucket < ${len(params)}::date + INTERVAL '1 day'")
+    where = ("WHERE " + " AND ".join(filters)) if filters else ""
+
+    sql = f"""
+        SELECT
+            {"sensor_id," if with_sensor else ""}
+            bucket AS date,
+            pollutant,
+            ROUND((total / NULLIF(n, 0))::numeric, 3)::double precision AS avg,
+            min,
+            max,
+            n AS count
+        FROM {table}
+        {where}
+        ORDER BY date;
+    """
+    return sql, params
+
+
+def measurements_query(args):
+    """Build the /api/measurements statement from its query parameters."""
+    sensor_id = args.get("sensor_id")
+    pollutant = args.get("pollutant")
+    start     = args.get("start")
+    end       = args.get("end")
+    resolution = parse_resolution(args)
+    if resolution != "day":
+        return rollup_query(resolution, sensor_id, pollutant, start, end)
+
+    filters, params = [], []
+    if sensor_id:
+        params.append(sensor_id);   filters.append(f"sensor_id = ${len(params)}")
+    if pollutant:
+        params.append(pollutant);   filters.append(f"pollutant = ${len(params)}")
+    if start:
+        params.append(start);       filters.append(f"timestamp >= ${len(params)}")
+    if end:
+        params.append(end);         filters.append(f"timestamp < ${len(params)}::date + INTERVAL '1 day'")
+    where = ("WHERE " + " AND ".join(filters)) if filters else ""
+
+    sql = f"""
+        SELECT
+            sensor_id,
+            timestamp AS date,
+            pollutant,
+            daily_avg,
+            daily_min,
+            daily_max
+        FROM measurements
+        {where}
+        ORDER BY date;
+    """
+    return sql, params
+
+
+def sensor_measurements_query(sensor_id, args):
+    """Build the /api/sensors/<sensor_id>/measurements statement."""
+    start = args.get("start")
+    end   = args.get("end")
+    resolution = parse_resolution(args)
+    if resolution != "day":
+        return rollup_query(resolution, sensor_id, start=start, end=end, with_sensor=False)
+
+    filters = ["sensor_id = $1"]
+    params  = [sensor_id]
+    if start:
+        params.append(start);       filters.append(f"timestamp >= ${len(params)}")
+    if end:
+        params.append(end);         filters.append(f"timestamp < ${len(params)}::date + INTERVAL '1 day'")
+    where = " AND ".join(filters)
+
+    sql = f"""
+        SELECT
+            timestamp::date AS date,
+            pollutant,
+            daily_avg,
+            daily_min,
+            daily_max
+        FROM measurements
+        WHERE {where}
+        ORDER BY date;
+    """
+    return sql, params
+
+
+def batch_measurements_query(args):
+    """
+    Build the /api/measurements/batch statement: one query over every listed
+    sensor and/or every sensor of a province, ordered so each sensor's series
+    is contiguous.
+    """
+    pollutant = args.get("pollutant")
+    start     = args.get("start")
+    end       = args.get("end")
+    if not args.get("sensor_ids", "").strip(", ") and not args.get("province"):
+        raise ValueError("sensor_ids or province is required")
+    resolution = parse_resolution(args)
+
+    if resolution == "day":
+        table, day = "measurements", "m.timestamp"
+        values = "m.daily_avg AS avg, m.daily_min AS min, m.daily_max AS max"
+        start_filter = "m.timestamp >= ${}"
+    else:
+        table, unit = RESOLUTION_TABLES[resolution]
+        day = "m.bucket"
+        values = "ROUND((m.total / NULLIF(m.n, 0))::numeric, 3)::double precision AS avg, m.min, m.max"
+        start_filter = f"m.bucket >= date_trunc('{unit}', ${{}}::timestamp)::date"
+
+    params = []
+    filters = sensor_filters(args, params, alias="m")
+    if pollutant:
+        params.append(pollutant);   filters.append(f"m.pollutant = ${len(params)}")
+    if start:
+        params.append(start);       filters.append(start_filter.format(len(params)))
+    if end:
+        params.append(end);         filters.append(f"{day} < ${len(params)}::date + INTERVAL '1 day'")
+
+    sql = f"""
+        SELECT m.sensor_id,
+               s.station_name,
+               s.province,
+               m.pollutant,
+               {day}::date AS date,
+               {values}
+        FROM {table} m
+        JOIN sensors s ON s.sensor_id = m.sensor_id
+        WHERE {" AND ".join(filters)}
+        ORDER BY m.sensor_id, m.pollutant, date;
+    """
+    return sql, params, resolution
+
+
+def sensor_filters(args, params, alias="a"):
+    """sensor_ids (comma-separated) and province filters on `alias` joined to sensors `s`."""
+    sensor_ids = [s.strip() for s in args.get("sensor_ids", "").split(",") if s.strip()]
+    if len(sensor_ids) > BATCH_MAX_SENSORS:
+        raise ValueError(f"at most {BATCH_MAX_SENSORS} sensor_ids per request")
+    filters = []
+    if sensor_ids:
+        params.append(sensor_ids);  filters.append(f"{alias}.sensor_id = ANY(${len(params)}::varchar[])")
+    if args.get("province"):
+        params.append(args["province"]); filters.append(f"s.province = ${len(params)}")
+    return filters
+
+
+def annual_stats_query(args):
+    """
+    Build the /api/analytics/annual statement: materialized per-year
+    statistics, optionally narrowed by sensor_ids, province, pollutant and
+    year or from_year/to_year.
+    """
+    params = []
+    filters = sensor_filters(args, params)
+    if args.get("pollutant"):
+        params.append(args["pollutant"]); filters.append(f"a.pollutant = ${len(params)}")
+    try:
+        for name, op in (("year", "="), ("from_year", ">="), ("to_year", "<=")):
+            if args.get(name):
+                params.append(int(args[name])); filters.append(f"a.year {op} ${len(params)}")
+    except ValueError:
+        raise ValueError("year, from_year and to_year must be integers")
+    where = ("WHERE " + " AND ".join(filters)) if filters else ""
+
+    sql = f"""
+        SELECT a.sensor_id,
+               s.station_name,
+               s.province,
+               a.pollutant,
+               a.year,
+               a.hours,
+               a.days,
+               a.mean,
+               a.p50,
+               a.p90,
+               a.p98,
+               a.max_hourly,
+               a.max_daily_mean,
+               a.max_8h_mean,
+               a.hourly_exceedances,
+               a.daily_exceedances,
+               a.max_8h_exceedances
+        FROM annual_stats a
+        JOIN sensors s ON s.sensor_id = a.sensor_id
+        {where}
+        ORDER BY a.pollutant, a.year, s.province, s.station_name;
+    """
+    return sql, params
+
+
+def rolling_query(args):
+    """
+    Build the /api/analytics/rolling statement: a trailing moving average of
+    one sensor's series, over hourly readings (window=8h, 24h, ...) or daily
+    means (window=7d, 30d, ...). Rows before `start` feed the first windows
+    but are not returned.
+    """
+    sensor_id = args.get("sensor_id")
+    pollutant = args.get("pollutant")
+    start     = args.get("start")
+    end       = args.get("end")
+    if not sensor_id or not pollutant:
+        raise ValueError("sensor_id and pollutant are required")
+    match = re.fullmatch(r"([1-9]\d*)([hd])", args.get("window", "24h"))
+    if not match or int(match.group(1)) > ROLLING_MAX[match.group(2)]:
+        raise ValueError(f"window must look like 8h or 7d, at most {ROLLING_MAX['h']}h or {ROLLING_MAX['d']}d")
+    size, unit = int(match.group(1)), match.group(2)
+
+    if unit == "h":
+        table, value, preceding = "raw_measurements", "value", f"INTERVAL '{size - 1} hours'"
+    else:
+        table, value, preceding = "measurements", "daily_avg", f"INTERVAL '{size - 1} days'"
+
+    filters, params = ["sensor_id = $1", "pollutant = $2"], [sensor_id, pollutant]
+    shown = ""
+    if start:
+        params.append(start)
+        filters.append(f"timestamp >= ${len(params)}::timestamp - {preceding}")
+        shown = f"WHERE timestamp >= ${len(params)}"
+    if end:
+        params.append(end);         filters.append(f"timestamp < ${len(params)}::date + INTERVAL '1 day'")
+
+    sql = f"""
+        SELECT timestamp, value, rolling_mean, n
+        FROM (
+            SELECT timestamp,
+                   {value} AS value,
+                   ROUND((AVG({value}) OVER w)::numeric, 3)::double precision AS rolling_mean,
+                   COUNT({value}) OVER w AS n
+            FROM {table}
+            WHERE {" AND ".join(filters)}
+            WINDOW w AS (ORDER BY timestamp RANGE BETWEEN {preceding} PRECEDING AND CURRENT ROW)
+        ) windows
+        {shown}
+        ORDER BY timestamp;
+    """
+    return sql, params
+
+
+def limits_payload():
+    return [
+        {"pollutant": pollutant,
+         **{f"{kind}_limit": spec.get(f"{kind}_limit") for kind in LIMIT_KINDS},
+         **{f"{kind}_allowed": spec.get(f"{kind}_allowed") for kind in LIMIT_KINDS}}
+        for pollutant, spec in LIMITS.items()
+    ]
+
+
+def float_arg(args, name, low, high, default=None):
+    """Float query parameter within [low, high]; raises ValueError otherwise."""
+    raw = args.get(name)
+    if raw is None:
+        if default is None:
+            raise ValueError(f"{name} is required")
+        return default
+    value = float(raw)
+    if not low <= value <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return value
+
+
+def spatial_sensors_query(args, region, params, distance=None, order="s.sensor_id", limit=None):
+    """
+    Sensors matching the PostGIS predicate `region` (written against alias
+    `s`). Optional query params narrow them to a pollutant and, with
+    date=YYYY-MM-DD, join that pollutant's daily aggregates for the day.
+    `distance` is an expression in metres returned as distance_m.
+    """
+    pollutant = args.get("pollutant")
+    day       = args.get("date")
+    if day and not pollutant:
+        raise ValueError("date requires pollutant")
+
+    cols = ["s.sensor_id", "s.station_name", "s.province", "s.latitude", "s.longitude"]
+    if distance:
+        cols.append(f"ROUND(({distance})::numeric, 1)::double precision AS distance_m")
+    joins, filters = "", [region]
+    if pollutant:
+        params.append(pollutant)
+        pollutant_param = len(params)
+    if day:
+        params.append(day)
+        joins = (f"JOIN measurements m ON m.sensor_id = s.sensor_id "
+                 f"AND m.pollutant = ${pollutant_param} AND m.timestamp = ${len(params)}::date")
+        cols += ["m.pollutant", "m.daily_avg", "m.daily_min", "m.daily_max"]
+    elif pollutant:
+        filters.append(f"EXISTS (SELECT 1 FROM sensor_pollutants sp "
+                       f"WHERE sp.sensor_id = s.sensor_id AND sp.pollutant = ${pollutant_param})")
+    sql = f"""
+        SELECT {", ".join(cols)}
+        FROM sensors s
+        {joins}
+        WHERE {" AND ".join(filters)}
+        ORDER BY {order}
+    """
+    if limit:
+        params.append(limit)
+        sql += f" LIMIT ${len(params)}"
+    return sql, params
+
+
+def bbox_query(args):
+    bounds = [float_arg(args, "min_lon", -180, 180), float_arg(args, "min_lat", -90, 90),
+              float_arg(args, "max_lon", -180, 180), float_arg(args, "max_lat", -90, 90)]
+    if bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+        raise ValueError("min_lon/min_lat must not exceed max_lon/max_lat")
+    return spatial_sensors_query(args, "s.geom && ST_MakeEnvelope($1, $2, $3, $4, 4326)", bounds)
+
+
+def radius_query(args):
+    point = [float_arg(args, "lon", -180, 180), float_arg(args, "lat", -90, 90)]
+    radius = float_arg(args, "radius", 0, SPATIAL_MAX_RADIUS)
+    return spatial_sensors_query(args, f"ST_DWithin(s.geom::geography, {POINT_SQL}, $3)",
+                                 point + [radius],
+                                 distance=f"ST_Distance(s.geom::geography, {POINT_SQL})",
+                                 order="distance_m")
+
+
+def nearest_query(args):
+    point = [float_arg(args, "lon", -180, 180), float_arg(args, "lat", -90, 90)]
+    k = int(float_arg(args, "k", 1, SPATIAL_MAX_K, default=5))
+    return spatial_sensors_query(args, "s.geom IS NOT NULL", point,
+                                 distance=f"ST_Distance(s.geom::geography, {POINT_SQL})",
+                                 order=f"s.geom::geography <-> {POINT_SQL}",
+                                 limit=k)
+
+
+def parse_shape(args):
+    shape = args.get("shape", "rows")
+    if shape not in SHAPES:
+        raise ValueError(f"shape must be one of {', '.join(SHAPES)}")
+    return shape
+
+
+def rows_payload(cols, rows, shape="rows"):
+    """
+    Row tuples as a list of row dicts, or for shape=columns as
+    {column: [values]}, which skips the per-row dicts and key names.
+    """
+    if shape == "columns":
+        columns = list(zip(*rows)) if rows else [()] * len(cols)
+        return {col: list(values) for col, values in zip(cols, columns)}
+    return [dict(zip(cols, row)) for row in rows]
+
+
+def coverage_payload(rows):
+    for row in rows:
+        row["first_date"] = row["first_date"].isoformat()
+        row["last_date"] = row["last_date"].isoformat()
+        row["first_timestamp"] = row["first_timestamp"].isoformat()
+        row["last_timestamp"] = row["last_timestamp"].isoformat()
+    return rows
+
+
+def metadata_payload(pollutants, sensors, coverage):
+    first_dates = [c["first_date"] for c in coverage if c["first_date"]]
+    last_dates = [c["last_date"] for c in coverage if c["last_date"]]
+    for c in coverage:
+        c["first_date"] = c["first_date"].isoformat() if c["first_date"] else None
+        c["last_date"] = c["last_date"].isoformat() if c["last_date"] else None
+    return {
+        "pollutants": pollutants,
+        "sensors": sensors,
+        "date_range": {
+            "first_date": min(first_dates).isoformat() if first_dates else None,
+            "last_date": max(last_dates).isoformat() if last_dates else None,
+        },
+        "coverage": coverage,
+    }
+
+
+def batch_payload(rows, resolution):
+    """
+    Group batch rows per sensor and pollutant, one array per column, so the
+    station fields are sent once per series instead of once per row.
+    """
+    series = []
+    for (sensor_id, pollutant), group in groupby(rows, key=lambda r: (r["sensor_id"], r["pollutant"])):
+        group = list(group)
+        series.append({
+            "sensor_id": sensor_id,
+            "station_name": group[0]["station_name"],
+            "province": group[0]["province"],
+            "pollutant": pollutant,
+            "date": [r["date"].isoformat() for r in group],
+            "avg": [None if r["avg"] is None else float(r["avg"]) for r in group],
+            "min": [None if r["min"] is None else float(r["min"]) for r in group],
+            "max": [None if r["max"] is None else float(r["max"]) for r in group],
+        })
+    return {"resolution": resolution, "series": series}
+
+
+def parse_surface_day(day):
+    """The /api/surfaces/<pollutant>/<day> date, as given (YYYY-MM-DD)."""
+    try:
+        date.fromisoformat(day)
+    except ValueError:
+        raise ValueError("day must be a date (YYYY-MM-DD)")
+    return day
+
+
+def surface_payload(pollutant, header):
+    """Grid geometry and scale (a SurfaceGrid or SurfaceDay) of a pollutant's surfaces, as needed to place and read them."""
+    return {
+        "pollutant": pollutant,
+        "first_date": header.first_date.isoformat(),
+        "last_date": (header.first_date + timedelta(days=header.days - 1)).isoformat(),
+        "bounds": [header.west, header.south,
+                   header.west + header.width * header.step, header.south + header.height * header.step],
+        "width": header.width,
+        "height": header.height,
+        "value_max": header.value_max,
+        "levels": LEVELS,
+        "nodata": NODATA,
+    }
+
+
+def surface_day_payload(pollutant, day, row):
+    """One day's surface (a SurfaceDay): level / levels * value_max, row-major, north first; nodata where unknown."""
+    return {
+        **surface_payload(pollutant, row),
+        "date": day,
+        "dtype": "uint8",
+        "grid": base64.b64encode(bytes(row.grid)).decode(),
+    }
+
+
+def snapshot_payload(pollutant, snapshot, sensors):
+    first_date, days, grid = snapshot
+    return {
+        "pollutant": pollutant,
+        "first_date": first_date.isoformat(),
+        "days": days,
+        "sensors": sensors,
+        "dtype": "float32",
+        "grid": base64.b64encode(bytes(grid)).decode(),
+    }
@@ -0,0 +1,294 @@
+# response_cache.py
+#
+# Response cache for the read-only API endpoints. Entries are keyed on the
+# route, the normalized query string and the dataset version that
+# manage_data.py bumps on every commit, so nothing ever needs invalidating:
+# a new load simply makes the old keys unreachable. Bodies are cached already
+# compressed in the encoding the client negotiated, so a hit is sent as it is.
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import Response, request
+
+from db import execute_prepared
+from serialization import (
+    COMPRESS_MIN_BYTES, COMPRESSIBLE, compress, encoded_etag, etag_variants, negotiate_encoding,
+)
+
+# `etag` is that of the uncompressed body; `encoding` is the body's content coding or None
+CacheEntry = namedtuple("CacheEntry", ["body", "etag", "mimetype", "encoding"])
+# Seconds a shared-store query waits for another worker's write lock before
+# the request carries on without the store
+STORE_TIMEOUT = 0.5
+
+
+class DatasetVersion:
+    """
+    Current `dataset_version.version`, re-read at most every `ttl` seconds.
+    One request re-reads it, outside the lock; the others keep using the
+    previous value meanwhile instead of queueing behind the round trip.
+    """
+
+    def __init__(self, pool, ttl=5.0):
+        self.pool = pool
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = 0.0
+        self._refreshing = False
+
+    def current(self):
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._checked < self.ttl:
+                return self._version
+            self._refreshing = True
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                execute_prepared(cur, "SELECT version FROM dataset_version;")
+                row = cur.fetchone()
+                cur.close()
+            version = row[0] if row else None
+        except Exception:
+            # Without a version the cache is bypassed rather than trusted
+            logging.exception("Failed to read dataset version")
+            version = None
+        with self._lock:
+            # A version pushed by set() while we were reading may be newer
+            if version is None or self._version is None or version > self._version:
+                self._version = version
+            self._checked = time.monotonic()
+            self._refreshing = False
+            return self._version
+
+    def set(self, version):
+        """Take a version pushed by the change feed, without waiting for the TTL."""
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+            self._checked = time.monotonic()
+
+
+class ResponseCache:
+    """
+    In-process LRU bounded by total body size, optionally backed by a SQLite
+    file shared by every worker process on the host and bounded by
+    `store_max_bytes`. The store is only a second chance: it is read and
+    written outside the lock, and when it is busy or broken a lookup counts
+    as a miss and a write is skipped.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, store_path=None, store_max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.store_path = store_path
+        self.store_max_bytes = store_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "shared_hits": 0, "misses": 0, "not_modified": 0, "evictions": 0,
+                          "store_errors": 0}
+        # One SQLite connection per thread, so store I/O needs no lock of ours
+        self._local = threading.local()
+        self._pruned_version = None
+        self._stored_bytes = 0
+        if store_path:
+            store = self._store()
+            store.execute("PRAGMA journal_mode=WAL;")
+            # A store written before bodies were cached compressed is just dropped
+            columns = [row[1] for row in store.execute("PRAGMA table_info(responses);")]
+            if columns and "encoding" not in columns:
+                store.execute("DROP TABLE responses;")
+            store.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    etag TEXT NOT NULL,
+                    mimetype TEXT NOT NULL,
+                    encoding TEXT,
+                    body BLOB NOT NULL
+                );
+            """)
+            store.commit()
+
+    def _store(self):
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = sqlite3.connect(self.store_path, timeout=STORE_TIMEOUT)
+        return store
+
+    def _store_failed(self, action):
+        logging.warning("Response cache store %s failed", action, exc_info=True)
+        with self._lock:
+            self._counters["store_errors"] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry
+        row = None
+        if self.store_path:
+            try:
+                row = self._store().execute(
+                    "SELECT body, etag, mimetype, encoding FROM responses WHERE key = ?;", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                self._store_failed("read")
+        with self._lock:
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["shared_hits"] += 1
+            entry = CacheEntry(*row)
+            self._remember(key, entry)
+            return entry
+
+    def put(self, key, version, entry):
+        with self._lock:
+            self._remember(key, entry)
+            # Rows from older dataset versions can never be hit again; each
+            # process drops them once per version it sees
+            prune = self._pruned_version is None or version > self._pruned_version
+            if prune:
+                self._pruned_version = version
+        if not self.store_path or len(entry.body) > self.store_max_bytes:
+            return
+        try:
+            store = self._store()
+            if prune:
+                store.execute("DELETE FROM responses WHERE version < ?;", (version,))
+            store.execute(
+                "INSERT OR REPLACE INTO responses (key, version, etag, mimetype, encoding, body) "
+                "VALUES (?, ?, ?, ?, ?, ?);",
+                (key, version, entry.etag, entry.mimetype, entry.encoding, entry.body)
+            )
+            store.commit()
+        except sqlite3.Error:
+            self._store_failed("write")
+            return
+        with self._lock:
+            self._stored_bytes += len(entry.body)
+            # Measured again only after this process has written a tenth of the cap
+            check = self._stored_bytes >= self.store_max_bytes // 10
+            if check:
+                self._stored_bytes = 0
+        if check:
+            self._trim_store()
+
+    def _trim_store(self):
+        """Delete the oldest rows until the store is back under store_max_bytes."""
+        try:
+            store = self._store()
+            total = store.execute("SELECT COALESCE(SUM(length(body)), 0) FROM responses;").fetchone()[0]
+            excess = total - self.store_max_bytes
+            if excess <= 0:
+                return
+            # INSERT OR REPLACE gives every write a new rowid, so rowids run oldest first
+            last = None
+            for rowid, size in store.execute("SELECT rowid, length(body) FROM responses ORDER BY rowid;"):
+                last = rowid
+                excess -= size
+                if excess <= 0:
+                    break
+            store.execute("DELETE FROM responses WHERE rowid <= ?;", (last,))
+            store.commit()
+        except sqlite3.Error:
+            self._store_failed("trim")
+
+    def count_not_modified(self):
+        with self._lock:
+            self._counters["not_modified"] += 1
+
+    def _remember(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.body)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+            self._counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "shared_store": bool(self.store_path),
+                **self._counters,
+            }
+
+
+def cache_key(req, version, encoding=None):
+    """Route + sorted query parameters + Accept header + negotiated content coding + dataset version."""
+    args = "&".join(f"{k}={v}" for k, v in sorted(req.args.items(multi=True)))
+    raw = f"{version}|{req.path}|{args}|{req.headers.get('Accept', '')}|{encoding or ''}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _conditional(entry):
+    # The client may hold the ETag of a compressed copy of the same body; the
+    # 304 repeats the one it matched, as that is the representation it has
+    for tag in etag_variants(entry.etag.strip('"')):
+        if request.if_none_match.contains(tag):
+            return Response(status=304, headers={"ETag": f'"{tag}"'})
+    return None
+
+
+def cached_response(cache, current_version):
+    """
+    Decorator for GET views whose output only changes when the dataset
+    version does. Adds strong ETags and answers If-None-Match with 304.
+    Bodies are compressed here, once per encoding, rather than on every hit
+    by serialization.compress_response. Streamed and non-200 responses pass
+    through uncached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = current_version()
+            if version is None:
+                return view(*args, **kwargs)
+
+            encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+            key = cache_key(request, version, encoding)
+            entry = cache.get(key)
+            if entry is None:
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple) or response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if response.mimetype in COMPRESSIBLE and len(body) >= COMPRESS_MIN_BYTES and encoding:
+                    entry = CacheEntry(compress(body, encoding), etag, response.mimetype, encoding)
+                else:
+                    entry = CacheEntry(body, etag, response.mimetype, None)
+                cache.put(key, version, entry)
+
+            not_modified = _conditional(entry)
+            if not_modified is not None:
+                cache.count_not_modified()
+                return not_modified
+            response = Response(entry.body, mimetype=entry.mimetype)
+            response.headers["ETag"] = entry.etag
+            if entry.encoding is not None:
+                response.headers["Content-Encoding"] = entry.encoding
+                response.headers["ETag"] = encoded_etag(entry.etag, entry.encoding)
+            response.vary.add("Accept-Encoding")
+            # Clients must revalidate, which costs a 304 until the data changes
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
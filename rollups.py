@@ -0,0 +1,121 @@
+# rollups.py
+#
+# Multi-resolution rollups of raw_measurements:
+#
+#     raw (hourly) -> daily -> weekly
+#                           -> monthly -> yearly
+#
+# Every level stores count / sum / min / max, so each one is built exactly
+# from the level below it and averages stay mergeable (avg = total / n).
+# The readings are hourly already, so there is no hourly level: it would be
+# a row-for-row copy of raw_measurements, and hourly data is served from there.
+
+ROLLUP_LEVELS = [
+    {
+        "table": "rollup_daily",
+        "source": "raw_measurements",
+        "time_col": "timestamp",
+        "bucket": "date_trunc('day', {col})::date",
+        "span": "1 day",
+        "aggs": "COUNT({s}value), COALESCE(SUM({s}value), 0), MIN({s}value), MAX({s}value)",
+    },
+    {
+        "table": "rollup_weekly",
+        "source": "rollup_daily",
+        "time_col": "bucket",
+        "bucket": "date_trunc('week', {col}::timestamp)::date",
+        "span": "7 days",
+        "aggs": "SUM({s}n), SUM({s}total), MIN({s}min), MAX({s}max)",
+    },
+    {
+        "table": "rollup_monthly",
+        "source": "rollup_daily",
+        "time_col": "bucket",
+        "bucket": "date_trunc('month', {col}::timestamp)::date",
+        "span": "1 month",
+        "aggs": "SUM({s}n), SUM({s}total), MIN({s}min), MAX({s}max)",
+    },
+    {
+        "table": "rollup_yearly",
+        "source": "rollup_monthly",
+        "time_col": "bucket",
+        "bucket": "date_trunc('year', {col}::timestamp)::date",
+        "span": "1 year",
+        "aggs": "SUM({s}n), SUM({s}total), MIN({s}min), MAX({s}max)",
+    },
+]
+
+# API `resolution` -> (rollup table, date_trunc unit). `day` keeps reading the
+# `measurements` table so existing clients see no change.
+RESOLUTION_TABLES = {
+    "week": ("rollup_weekly", "week"),
+    "month": ("rollup_monthly", "month"),
+    "year": ("rollup_yearly", "year"),
+}
+
+
+def create_rollup_tables(cur):
+    for level in ROLLUP_LEVELS:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {level["table"]} (
+                sensor_id VARCHAR(50) REFERENCES sensors(sensor_id),
+                pollutant VARCHAR(50) NOT NULL,
+                bucket DATE NOT NULL,
+                n BIGINT NOT NULL,
+                total DOUBLE PRECISION NOT NULL,
+                min DOUBLE PRECISION,
+                max DOUBLE PRECISION,
+                PRIMARY KEY (sensor_id, pollutant, bucket)
+            );
+        ''')
+        cur.execute(f'''
+            CREATE INDEX IF NOT EXISTS {level["table"]}_pollutant_bucket_idx
+            ON {level["table"]} (pollutant, bucket);
+        ''')
+
+
+def refresh_rollups(cur):
+    """Rebuild every level from scratch, bottom up."""
+    for level in ROLLUP_LEVELS:
+        cur.execute(f"TRUNCATE {level['table']};")
+        bucket = level["bucket"].format(col=level["time_col"])
+        cur.execute(f'''
+            INSERT INTO {level["table"]} (sensor_id, pollutant, bucket, n, total, min, max)
+            SELECT sensor_id, pollutant, {bucket}, {level["aggs"].format(s="")}
+            FROM {level["source"]}
+            GROUP BY 1, 2, 3;
+        ''')
+
+
+def merge_rollups(cur):
+    """
+    Recompute only the buckets touched by the current incremental batch
+    (the `inserted_rows` temp table), level by level.
+    """
+    # source table -> (temp table of its touched rows/buckets, time column)
+    touched = {"raw_measurements": ("inserted_rows", "timestamp")}
+    for level in ROLLUP_LEVELS:
+        table = level["table"]
+        source_touched, source_col = touched[level["source"]]
+        cur.execute(f'''
+            CREATE TEMP TABLE touched_{table} ON COMMIT DROP AS
+            SELECT DISTINCT sensor_id, pollutant, {level["bucket"].format(col=source_col)} AS bucket
+            FROM {source_touched};
+        ''')
+        cur.execute(f'''
+            INSERT INTO {table} (sensor_id, pollutant, bucket, n, total, min, max)
+            SELECT t.sensor_id, t.pollutant, t.bucket, {level["aggs"].format(s="s.")}
+            FROM touched_{table} t
+            JOIN {level["source"]} s
+              ON s.sensor_id = t.sensor_id
+             AND s.pollutant = t.pollutant
+             AND s.{level["time_col"]} >= t.bucket
+             AND s.{level["time_col"]} < t.bucket + INTERVAL '{level["span"]}'
+            GROUP BY t.sensor_id, t.pollutant, t.bucket
+            ON CONFLICT (sensor_id, pollutant, bucket) DO UPDATE
+            SET n = EXCLUDED.n,
+                total = EXCLUDED.total,
+                min = EXCLUDED.min,
+                max = EXCLUDED.max;
+        ''')
+        touched[table] = (f"touched_{table}", "bucket")
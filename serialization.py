@@ -0,0 +1,144 @@
+# serialization.py
+#
+# Fast JSON encoding and negotiated response compression for app.py.
+#
+# With orjson installed, every jsonify() and streamed JSON row goes through it
+# instead of the stdlib encoder. Dates, decimals and key order come out as
+# Flask's own encoder writes them, so clients parse the same values either way.
+# JSON, NDJSON, CSV and Arrow responses are compressed with brotli (when
+# installed) or gzip, whichever the client's Accept-Encoding prefers. Streamed
+# bodies are compressed batch by batch as they are sent.
+
+import json
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+try:
+    import orjson
+except ImportError:  # falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Bodies smaller than this are sent as they are
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Parquet is compressed already
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/csv", "application/vnd.apache.arrow.stream")
+
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def dumps(obj, sort_keys=False):
+    """`obj` as UTF-8 JSON bytes, formatted like Flask's encoder."""
+    if orjson is None:
+        return json.dumps(obj, default=DefaultJSONProvider.default, separators=(",", ":"),
+                          sort_keys=sort_keys).encode()
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    # Dates go through Flask's default too, so they keep its HTTP-date format
+    return orjson.dumps(obj, default=DefaultJSONProvider.default, option=option)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, encoding with orjson when it is installed."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, kwargs.get("sort_keys", self.sort_keys)).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, self.sort_keys) + b"\n", mimetype=self.mimetype)
+
+
+def negotiate_encoding(accept_encoding):
+    """The content coding to answer an Accept-Encoding header with, or None."""
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding, Accept).best_match(ENCODINGS)
+
+
+class Compressor:
+    def __init__(self, encoding):
+        if encoding == "br":
+            c = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.flush, self.finish = c.process, c.flush, c.finish
+        else:
+            # wbits 31: a gzip header and trailer around the deflate stream
+            c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress, self.finish = c.compress, c.flush
+            self.flush = lambda: c.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compress(body, encoding):
+    c = Compressor(encoding)
+    return c.compress(body) + c.finish()
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed body; each chunk is flushed so clients get it as soon as it is ready."""
+    c = Compressor(encoding)
+    try:
+        for chunk in chunks:
+            data = c.compress(chunk.encode() if isinstance(chunk, str) else chunk) + c.flush()
+            if data:
+                yield data
+        yield c.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def encoded_etag(etag, encoding):
+    """A compressed body is a different representation, so it gets its own ETag."""
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else f"{etag}-{encoding}"
+
+
+def etag_variants(tag):
+    """`tag` and its compressed forms, any of which a client may send back in If-None-Match."""
+    return [tag] + [f"{tag}-{encoding}" for encoding in ENCODINGS]
+
+
+def compress_response(response):
+    """after_request hook: compress the body if the client accepts it."""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    if "ETag" in response.headers:
+        response.headers["ETag"] = encoded_etag(response.headers["ETag"], encoding)
+    return response
+
+
+def install(app):
+    """Use the fast JSON provider and compress responses of `app`."""
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
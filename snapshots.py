@@ -0,0 +1,115 @@
+# snapshots.py
+#
+# Per-pollutant map snapshots: a dense sensor x day matrix of daily_avg,
+# stored as little-endian float32 (row-major, one row per sensor) next to the
+# sensor index. The dashboard fetches one snapshot per pollutant and switches
+# days in the browser, so scrubbing dates costs no server round-trip.
+# Days without a reading are NaN.
+#
+# The full load rebuilds every snapshot; an incremental batch only patches the
+# (sensor, day) cells it re-aggregated, growing the matrix when the batch
+# brings a new sensor or days outside it.
+
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+SNAPSHOT_DTYPE = "<f4"
+
+
+def build_snapshot(rows):
+    """(sensor_id, day, daily_avg) rows -> (sensor_ids, first_day, days, float32 grid)."""
+    frame = pd.DataFrame(rows, columns=["sensor_id", "day", "daily_avg"])
+    codes, sensor_ids = pd.factorize(frame["sensor_id"], sort=True)
+    days = pd.to_datetime(frame["day"])
+    first = days.min()
+    offsets = (days - first).dt.days.to_numpy()
+
+    grid = np.full((len(sensor_ids), offsets.max() + 1), np.nan, dtype=SNAPSHOT_DTYPE)
+    grid[codes, offsets] = frame["daily_avg"].to_numpy(dtype=SNAPSHOT_DTYPE)
+    return list(sensor_ids), first.date(), grid.shape[1], grid
+
+
+def refresh_map_snapshots(cur, pollutants=None):
+    """Rebuild the snapshots of `pollutants` (default: all of them) from `measurements`."""
+    if pollutants is None:
+        cur.execute("DELETE FROM map_snapshots;")
+        cur.execute("SELECT DISTINCT pollutant FROM measurements;")
+        pollutants = [row[0] for row in cur.fetchall()]
+
+    for pollutant in pollutants:
+        cur.execute("""
+            SELECT sensor_id, timestamp, daily_avg
+            FROM measurements
+            WHERE pollutant = %s AND daily_avg IS NOT NULL;
+        """, (pollutant,))
+        rows = cur.fetchall()
+        if not rows:
+            cur.execute("DELETE FROM map_snapshots WHERE pollutant = %s;", (pollutant,))
+            continue
+        sensor_ids, first, days, grid = build_snapshot(rows)
+        cur.execute("""
+            INSERT INTO map_snapshots (pollutant, first_date, days, sensor_ids, grid)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (pollutant) DO UPDATE
+            SET first_date = EXCLUDED.first_date,
+                days = EXCLUDED.days,
+                sensor_ids = EXCLUDED.sensor_ids,
+                grid = EXCLUDED.grid,
+                updated_at = now();
+        """, (pollutant, first, days, sensor_ids, psycopg2.Binary(grid.tobytes())))
+
+
+def merge_map_snapshots(cur):
+    """
+    Write the days in the `touched_days` temp table (see manage_data.publish_batch)
+    into the existing snapshots; pollutants without one are built from scratch.
+    """
+    cur.execute("SELECT DISTINCT pollutant FROM touched_days;")
+    for (pollutant,) in cur.fetchall():
+        cur.execute("SELECT first_date, days, sensor_ids, grid FROM map_snapshots WHERE pollutant = %s;",
+                    (pollutant,))
+        snapshot = cur.fetchone()
+        if snapshot is None:
+            refresh_map_snapshots(cur, [pollutant])
+            continue
+        first, days, sensor_ids, grid = snapshot
+        cur.execute("""
+            SELECT m.sensor_id, m.timestamp, m.daily_avg
+            FROM touched_days t
+            JOIN measurements m
+              ON m.sensor_id = t.sensor_id
+             AND m.pollutant = t.pollutant
+             AND m.timestamp = t.day
+            WHERE t.pollutant = %s AND m.daily_avg IS NOT NULL;
+        """, (pollutant,))
+        rows = cur.fetchall()
+        if not rows:
+            continue
+
+        # New sensors get rows at the end, so existing row positions stay valid
+        rows_of = {sensor_id: i for i, sensor_id in enumerate(sensor_ids)}
+        for sensor_id, _, _ in rows:
+            if sensor_id not in rows_of:
+                rows_of[sensor_id] = len(rows_of)
+                sensor_ids.append(sensor_id)
+        offsets = [(day - first).days for _, day, _ in rows]
+        shift = max(0, -min(offsets))
+        width = max(days + shift, max(offsets) + shift + 1)
+
+        old = np.frombuffer(bytes(grid), dtype=SNAPSHOT_DTYPE).reshape(-1, days)
+        if shift or width != days or len(sensor_ids) != old.shape[0]:
+            matrix = np.full((len(sensor_ids), width), np.nan, dtype=SNAPSHOT_DTYPE)
+            matrix[:old.shape[0], shift:shift + days] = old
+        else:
+            matrix = old.copy()
+        matrix[[rows_of[r[0]] for r in rows], [o + shift for o in offsets]] = \
+            np.array([r[2] for r in rows], dtype=SNAPSHOT_DTYPE)
+
+        cur.execute("""
+            UPDATE map_snapshots
+            SET first_date = %s, days = %s, sensor_ids = %s, grid = %s, updated_at = now()
+            WHERE pollutant = %s;
+        """, (first - timedelta(days=shift), width, sensor_ids, psycopg2.Binary(matrix.tobytes()), pollutant))